@@ -0,0 +1,150 @@
+#
+# Exercise banks: big sets of pre-generated exercises in a compact binary file
+# that is read with numpy.memmap, so opening a bank costs the same however many
+# exercises it holds, any exercise can be read by its index, and processes
+# reading the same bank share the pages of the file instead of each having a
+# copy.
+#
+# File layout (all little-endian):
+#   preamble  : BANK_MAGIC, version (uint16), 0 (uint16), header length (uint32),
+#               number of exercises (uint64)
+#   header    : json with the spec, the seed, the row width and the dtype
+#   padding   : zeroes up to a multiple of BANK_ALIGNMENT
+#   table     : one row per exercise, the width numbers of the exercise
+#               followed by its answer, all int16 or int32 (see bank_dtype)
+#
+
+import json
+import struct
+import numpy as np
+
+from abacus_core import ExerciseSpec, get_row_sampler, spec_to_dict
+from abacus_batch import iter_row_chunks
+import abacus_stats as stats
+
+BANK_MAGIC = b'ABACBANK'
+BANK_VERSION = 1
+BANK_PREAMBLE = struct.Struct('<8sHHIQ')
+# the table starts at a multiple of this, so rows are aligned in memory
+BANK_ALIGNMENT = 64
+
+# where the table starts for a header of the given length
+def _table_offset(header_length):
+    return -(-(BANK_PREAMBLE.size + header_length) // BANK_ALIGNMENT) * BANK_ALIGNMENT
+
+#
+# Returns the smallest integer type (int16 or int32) that can hold every
+# number and every answer of exercises for the given ExerciseSpec.
+#
+def bank_dtype(spec):
+    sampler = get_row_sampler(spec)
+    largest = max([spec.max_sum, abs(spec.min_answer)] +
+                  [max(abs(domain[0]), abs(domain[-1])) for domain in sampler.domains])
+    if largest <= np.iinfo(np.int16).max:
+        return np.dtype('<i2')
+    return np.dtype('<i4')
+
+#
+# Writes exercises to a bank file.
+#
+# chunks : iterable of numpy arrays of rows (e.g. iter_row_chunks), written as
+#          they come
+# spec : the ExerciseSpec the rows were generated for
+# seed : the seed they were generated with (None if not known)
+# output_path : the bank file to write
+#
+# Returns how many exercises were written.
+#
+@stats.timed('write_bank')
+def write_bank(chunks, spec, seed = None, output_path = 'res.bank'):
+    width = spec.term_count + len(spec.buffer_prefill)
+    dtype = bank_dtype(spec)
+    header = json.dumps({'spec': spec_to_dict(spec), 'seed': seed, 'width': width, 'dtype': dtype.str}).encode('utf-8')
+    table_offset = _table_offset(len(header))
+    limit = np.iinfo(dtype).max
+
+    exercise_count = 0
+    with open(output_path, 'wb') as f:
+        # the number of exercises is filled in at the end
+        f.write(BANK_PREAMBLE.pack(BANK_MAGIC, BANK_VERSION, 0, len(header), 0))
+        f.write(header)
+        f.write(b'\0' * (table_offset - BANK_PREAMBLE.size - len(header)))
+
+        for rows in chunks:
+            rows = np.asarray(rows, dtype=np.int64).reshape(-1, width)
+            table = np.empty((len(rows), width + 1), dtype=np.int64)
+            table[:, :width] = rows
+            table[:, width] = rows.sum(axis=1)
+            if len(table) > 0 and np.abs(table).max() > limit:
+                raise ValueError("Exercises don't fit the " + dtype.name + " bank of the given spec.")
+            f.write(table.astype(dtype).tobytes())
+            exercise_count += len(rows)
+
+        f.seek(0)
+        f.write(BANK_PREAMBLE.pack(BANK_MAGIC, BANK_VERSION, 0, len(header), exercise_count))
+    return exercise_count
+
+#
+# Generates count exercises for the given ExerciseSpec and seed into a bank
+# file. The bank holds the same exercises as gen_numbers_parallel(spec, count,
+# seed), so exercise i of it is also get_exercise(seed, spec, i).
+#
+def gen_bank(spec, count, seed, output_path = 'res.bank', workers = 1):
+    return write_bank(iter_row_chunks(spec, count, seed, workers), spec, seed, output_path)
+
+#
+# A bank file opened for reading. Nothing is read from the table until it is
+# used; rows, answers and table are read-only views of the memory-mapped file.
+#
+# path : the bank file
+#
+# spec, seed : what the exercises were generated with
+# width : how many numbers each exercise has
+# table : array of shape [len(bank), width + 1], the numbers and the answer
+# rows, answers : the numbers and the answers alone
+#
+class ExerciseBank:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            preamble = f.read(BANK_PREAMBLE.size)
+            if len(preamble) < BANK_PREAMBLE.size or preamble[:len(BANK_MAGIC)] != BANK_MAGIC:
+                raise ValueError(str(path) + " is not an exercise bank.")
+            (magic, version, reserved, header_length, count) = BANK_PREAMBLE.unpack(preamble)
+            if version != BANK_VERSION:
+                raise ValueError(str(path) + " is a version " + str(version) + " exercise bank, only version " +
+                                 str(BANK_VERSION) + " can be read.")
+            header = json.loads(f.read(header_length).decode('utf-8'))
+            file_size = f.seek(0, 2)
+
+        self.spec = ExerciseSpec(**header['spec'])
+        self.seed = header['seed']
+        self.width = header['width']
+        self.dtype = np.dtype(header['dtype'])
+        table_offset = _table_offset(header_length)
+        shape = (count, self.width + 1)
+        if file_size < table_offset + count * shape[1] * self.dtype.itemsize:
+            raise ValueError(str(path) + " is shorter than its " + str(count) + " exercises, it may not have been written completely.")
+
+        if count == 0:
+            # an empty file region can't be memory-mapped
+            self.table = np.empty(shape, dtype=self.dtype)
+        else:
+            self.table = np.memmap(path, dtype=self.dtype, mode='r', offset=table_offset, shape=shape)
+        self.rows = self.table[:, :self.width]
+        self.answers = self.table[:, self.width]
+
+    def __len__(self):
+        return len(self.table)
+
+    # Exercise i as a list of numbers.
+    def __getitem__(self, i):
+        return self.rows[i].tolist()
+
+    # Exercises [start, stop) as an int64 array, e.g. to write a worksheet.
+    def get_range(self, start, stop):
+        return np.array(self.rows[start:stop], dtype=np.int64)
+
+    # Other processes open the file again instead of getting a copy of it.
+    def __reduce__(self):
+        return (ExerciseBank, (self.path,))
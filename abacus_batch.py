@@ -0,0 +1,760 @@
+#
+# Batch generation with numpy: many exercises at once from the row sampler,
+# counter-based random streams (any exercise of a run can be made on its own),
+# exercise pools and generation in several processes.
+#
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+import threading
+
+from dataclasses import replace
+
+from abacus_core import (make_spec, get_row_sampler, stream_key, make_seed, FormulaRowSampler, InfeasibleSpecError,
+                         analyze_spec)
+import abacus_stats as stats
+
+#
+# Checks which of the given values have all their digits less or equal to
+# max_digit. Works on whole numpy arrays at once and looks at absolute values,
+# so negative answers are checked the same way as positive ones.
+#
+def digits_within(values, max_digit = 8):
+    values = np.abs(np.asarray(values))
+    within = np.ones(values.shape, dtype=bool)
+    while np.any(values > 0):
+        within &= (values % 10) <= max_digit
+        values = values // 10
+    return within
+
+#
+# Vectorized membership test for AnswerIndex: which of the given values are
+# allowed answers. Checks the range and the digits, like AnswerIndex does.
+#
+def answers_allowed(answer_index, values):
+    values = np.asarray(values)
+    allowed = (values >= answer_index.min_answer) & (values <= answer_index.max_answer)
+    if answer_index.limited:
+        allowed &= digits_within(values, answer_index.max_answer_digit)
+    return allowed
+
+# How many rows sample_rows_batch works on at a time, to keep the temporary
+# arrays small however many rows are asked for.
+BATCH_CHUNK_ROWS = 65536
+
+#
+# Turns counts (or running totals of counts) of a sampler into a numpy array.
+# For sampling they are floats, scaled down first if they are bigger than a
+# float can hold (only the ratios between them matter); for unranking
+# (exact) they are int64, or Python ints if they don't fit in 64 bits.
+#
+def _counts_to_array(counts, exact = False):
+    largest = max(counts) if len(counts) else 0
+    if exact:
+        return np.array(counts, dtype=np.int64 if largest < 2 ** 63 else object)
+    shift = max(largest.bit_length() - 1000, 0)
+    return np.array([float(count >> shift) for count in counts])
+
+# Up to how many intervals of numbers a position may have for its running
+# totals per running sum to be kept as a table (see _build_batch_tables).
+MAX_TABLE_INTERVALS = 64
+
+#
+# Builds, for each position of the row, what sample_rows_batch and
+# unrank_rows_batch need to pick its number. For a RowSampler this is the
+# same representation the sampler itself uses: the running totals (prefix) of
+# the counts of the next position, and the runs of numbers (intervals) that
+# are allowed. Picking a number is then a binary search in the prefix, so
+# nothing grows with running sums times numbers.
+#
+# Returns a list of dicts per position with
+#   firsts, lasts : the first and last number of each interval
+#   prefix : running totals of the counts of the next position
+#   totals : the number of ways to finish the row per running sum before the
+#            position (minus low[i])
+#   cum : running totals of the weights of the intervals per running sum
+#         (None if there are more than MAX_TABLE_INTERVALS intervals and more
+#         than one running sum, then they are worked out when picking), and
+#         its columns but the last one as cum_columns
+#   low, next_low : the lowest running sum before and after the position
+#
+# exact : exact counts (see _counts_to_array), for unrank_rows_batch
+#
+@stats.timed('build_batch_tables')
+def _build_batch_tables(sampler, exact = False):
+    if isinstance(sampler, FormulaRowSampler):
+        return _build_formula_batch_tables(sampler, exact)
+
+    tables = []
+    for i in range(len(sampler.domains)):
+        prefix = _counts_to_array(sampler.prefix[i + 1], exact)
+        firsts = np.array([first for (first, last) in sampler.intervals[i]], dtype=np.int64)
+        lasts = np.array([last for (first, last) in sampler.intervals[i]], dtype=np.int64)
+        bases = np.arange(sampler.low[i], sampler.high[i] + 1) - sampler.low[i + 1]
+        cum = None
+        if len(bases) == 1 or len(firsts) <= MAX_TABLE_INTERVALS:
+            cum = np.cumsum(prefix[bases[:, None] + lasts[None, :] + 1] - prefix[bases[:, None] + firsts[None, :]], axis=1)
+            totals = cum[:, -1]
+        else:
+            totals = np.zeros(len(bases), dtype=prefix.dtype)
+            for (first, last) in zip(firsts, lasts):
+                totals = totals + prefix[bases + last + 1] - prefix[bases + first]
+        table = {'firsts': firsts, 'lasts': lasts, 'prefix': prefix, 'totals': totals, 'cum': cum,
+                 'low': sampler.low[i], 'next_low': sampler.low[i + 1]}
+        if cum is not None:
+            # the ways before each interval but the first, one array each
+            table['cum_columns'] = [np.ascontiguousarray(cum[:, k]) for k in range(len(firsts) - 1)]
+        if not exact:
+            # the largest floats below the totals, so that rounding can't
+            # take a draw past the end of what it may pick from
+            table['below_totals'] = np.nextafter(totals, 0)
+            table['below_prefix'] = np.nextafter(prefix, -np.inf)
+        tables.append(table)
+    return tables
+
+#
+# Picks the number at one position for a chunk of rows of a RowSampler.
+#
+# table : the position's table from _build_batch_tables
+# sums : the running sums of the rows before the position
+# targets : which of the ways to finish each row to take, as a float in
+#           [0, total) for sampling or an int for unranking (exact)
+#
+# Returns (numbers, targets left), the latter being which of the ways to
+# finish the row after the picked number to take (used when exact).
+#
+def _pick_numbers(table, sums, targets, exact = False):
+    (firsts, lasts, prefix, cum) = (table['firsts'], table['lasts'], table['prefix'], table['cum'])
+    bases = sums - table['next_low']
+    if not exact:
+        targets = np.minimum(targets, table['below_totals'][sums - table['low']])
+
+    # the interval of numbers the target falls into and the ways before it
+    if cum is None:
+        picked = np.full(len(sums), len(firsts) - 1)
+        before = np.zeros(len(sums), dtype=prefix.dtype)
+        ways = np.zeros(len(sums), dtype=prefix.dtype)
+        done = np.zeros(len(sums), dtype=bool)
+        for k in range(len(firsts)):
+            weights = prefix[bases + lasts[k] + 1] - prefix[bases + firsts[k]]
+            found = ~done & (ways + weights > targets)
+            picked[found] = k
+            before[found | ~done] = ways[found | ~done]
+            done |= found
+            ways = ways + weights
+    elif cum.shape[0] == 1:
+        picked = np.minimum(np.searchsorted(cum[0], targets, side='right'), len(firsts) - 1)
+        before = np.where(picked > 0, cum[0][np.maximum(picked - 1, 0)], 0)
+    else:
+        # a few intervals: the ones the target is past, column by column
+        states = sums - table['low']
+        picked = np.zeros(len(sums), dtype=np.int64)
+        before = np.zeros(len(sums), dtype=prefix.dtype)
+        for column in table['cum_columns']:
+            ways = column[states]
+            past = targets >= ways
+            picked += past
+            before = np.where(past, ways, before)
+
+    # the number in the interval, by a binary search in the prefix
+    starts = bases + firsts[picked]
+    positions = prefix[starts] + (targets - before)
+    if not exact:
+        positions = np.minimum(positions, table['below_prefix'][bases + lasts[picked] + 1])
+        return (np.searchsorted(prefix, positions, side='right') - 1 - bases, None)
+    found = np.searchsorted(prefix, positions, side='right')
+    return (found - 1 - bases, positions - prefix[found - 1])
+
+#
+# Builds the tables of a FormulaRowSampler. Its state is a running sum and how
+# many times the formula was used, and whether a number uses the formula
+# depends on both, so the weights are kept per state and number, all in one
+# flat array: state k's running totals are offset so that the whole array
+# stays sorted and one binary search finds the number for any state.
+#
+# Returns a list of (values, flat, offsets, next_states) per position, where
+# next_states is a table [state, value index] of the next states and
+# offsets[k] is where state k's running totals start.
+#
+def _build_formula_batch_tables(sampler, exact = False):
+    times = sampler.times
+    tables = []
+    for i in range(len(sampler.domains)):
+        values = np.array(sampler.domains[i], dtype=np.int64)
+        next_counts = _counts_to_array([count for by_used in sampler.counts[i + 1] for count in by_used], exact)
+        sums = np.arange(sampler.low[i], sampler.high[i] + 1)
+        hits = np.array(sampler.hits[i], dtype=np.int64).reshape(len(sums), len(values))
+        # state (s - low[i]) * (times + 1) + used, for every s and used
+        used = np.arange(times + 1)
+        next_sums = (sums[:, None] + values[None, :] - sampler.low[i + 1])[:, None, :]
+        next_used = np.minimum(used[None, :, None] + hits[:, None, :], times)
+        next_states = (next_sums * (times + 1) + next_used).reshape(len(sums) * (times + 1), len(values))
+        weights = next_counts[next_states]
+        if i in sampler.at_steps:
+            weights = weights * np.repeat(hits, times + 1, axis=0)
+        cum = np.cumsum(weights, axis=1)
+        if exact:
+            # each state's ways start where the previous state's end
+            offsets = np.concatenate([np.zeros(1, dtype=cum.dtype), np.cumsum(cum[:, -1])[:-1]])
+            if len(cum) and int(offsets[-1]) + int(cum[-1, -1]) >= 2 ** 63:
+                (cum, offsets) = (cum.astype(object), offsets.astype(object))
+        else:
+            # probabilities, the last number that can be picked gets exactly
+            # 1.0 so that a draw never lands on the zero-weight numbers after
+            # it, and each state is 2 higher than the one before
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cum = np.where(cum >= cum[:, -1:], 1.0, cum / cum[:, -1:])
+            offsets = 2.0 * np.arange(len(cum))
+        tables.append((values, (cum + offsets[:, None]).ravel(), offsets, next_states))
+    return tables
+
+# Picks the value index at one position for a chunk of rows of a
+# FormulaRowSampler (see _pick_numbers).
+def _pick_formula_values(table, states, targets, exact = False):
+    (values, flat, offsets, next_states) = table
+    width = len(values)
+    positions = offsets[states] + targets
+    picked = np.searchsorted(flat, positions, side='right') - states * width
+    picked = np.clip(picked, 0, width - 1)
+    if not exact:
+        # a draw that rounded up to the state's last running total takes the
+        # first number that gets it, not a zero-weight one after it
+        row_ends = flat[states * width + width - 1]
+        first_end = np.searchsorted(flat, row_ends, side='left') - states * width
+        return (np.minimum(picked, first_end), None)
+    before = np.where(picked > 0, flat[states * width + np.maximum(picked - 1, 0)] - offsets[states], 0)
+    return (picked, targets - before)
+
+#
+# Vectorized RowSampler.sample() (and FormulaRowSampler.sample()). Turns a
+# [n, row length] array of uniform numbers in [0, 1) into n valid rows, one
+# column at a time.
+#
+@stats.timed('sample_rows')
+def sample_rows_batch(sampler, uniforms):
+    if sampler.total == 0:
+        raise ValueError("No row of numbers satisfies the given parameters.")
+    stats.count('rows_sampled', uniforms.shape[0])
+    if sampler.batch_tables is None:
+        sampler.batch_tables = _build_batch_tables(sampler)
+    return _walk_rows(sampler, sampler.batch_tables, uniforms.shape[0], uniforms, False)
+
+#
+# Returns the valid rows with the given ranks (numpy array of ints in [0,
+# sampler.total)): numbering the valid rows in the order of the numbers in
+# the domains, row k is the one with rank k. Like sample_rows_batch, but
+# exact, so different ranks always give different rows.
+#
+def unrank_rows_batch(sampler, ranks):
+    if sampler.total >= 2 ** 63:
+        raise ValueError("There are too many valid rows to number them with 64-bit integers.")
+    if sampler.rank_tables is None:
+        sampler.rank_tables = _build_batch_tables(sampler, exact = True)
+
+    ranks = np.array(ranks, dtype=np.int64)
+    if np.any((ranks < 0) | (ranks >= sampler.total)):
+        raise ValueError("Ranks must be in range [0, " + str(sampler.total) + ").")
+    return _walk_rows(sampler, sampler.rank_tables, len(ranks), ranks, True)
+
+#
+# Fills in row_count rows one column at a time, BATCH_CHUNK_ROWS rows at a
+# time. draws are uniform numbers [row, position] when sampling, or the
+# ranks of the rows when exact.
+#
+def _walk_rows(sampler, tables, row_count, draws, exact):
+    formula = isinstance(sampler, FormulaRowSampler)
+    rows = np.empty((row_count, len(sampler.domains)), dtype=np.int64)
+    for start in range(0, row_count, BATCH_CHUNK_ROWS):
+        stop = min(start + BATCH_CHUNK_ROWS, row_count)
+        # running sums (RowSampler) or states (FormulaRowSampler) of the rows
+        states = np.zeros(stop - start, dtype=np.int64)
+        targets = draws[start:stop] if exact else None
+        for (i, table) in enumerate(tables):
+            if formula:
+                if not exact:
+                    targets = draws[start:stop, i]
+                (picked, targets) = _pick_formula_values(table, states, targets, exact)
+                rows[start:stop, i] = table[0][picked]
+                states = table[3][states, picked]
+            else:
+                if not exact:
+                    targets = draws[start:stop, i] * table['totals'][states - table['low']]
+                (numbers, targets) = _pick_numbers(table, states, targets, exact)
+                rows[start:stop, i] = numbers
+                states = states + numbers
+    return rows
+
+#
+# Generates n exercise rows at once. Takes the same parameters as gen_numbers
+# and returns a numpy array of shape [n, how_many_numbers].
+#
+# All the random numbers for the batch are drawn as one array and turned into
+# rows with sample_rows_batch, so there is no per-row Python work at all.
+#
+# n : how many rows to generate
+# rng : numpy random Generator to use (a new one is created if None)
+#
+def gen_numbers_batch(n,
+                      how_many_numbers = 4,
+                      max_number = 5,
+                      max_sum = 15,
+                      first_number_digit_count = 2,
+                      max_digit_in_multi_digit_number = 8,
+                      max_answer_digit = 8,
+                      buffer_prefill = [],
+                      use_negative = True,
+                      answer_can_be_negative = True,
+                      rng = None):
+    spec = make_spec(how_many_numbers,
+                     max_number,
+                     max_sum,
+                     first_number_digit_count,
+                     max_digit_in_multi_digit_number,
+                     max_answer_digit,
+                     buffer_prefill,
+                     use_negative,
+                     answer_can_be_negative)
+    return gen_numbers_batch_from_spec(spec, n, rng)
+
+#
+# Generates n exercise rows for the given ExerciseSpec as a numpy array of
+# shape [n, how_many_numbers].
+#
+# rng : numpy random Generator to use (a new one is created if None)
+#
+def gen_numbers_batch_from_spec(spec, n, rng = None):
+    if rng is None:
+        rng = np.random.default_rng()
+
+    sampler = get_row_sampler(spec)
+    return sample_rows_batch(sampler, rng.random((n, len(sampler.domains))))
+
+#
+# Counter-based random numbers: the random numbers of exercise k of a run come
+# only from (seed, spec, k), so any exercise (or range of exercises) can be
+# made on its own, in any order and in any process, and it comes out the same
+# as in a full run.
+#
+# Each number is the SplitMix64 output for counter (k * 2^16 + position) under
+# a 64-bit key made from the seed and the spec.
+#
+
+SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SPLITMIX_MUL1 = np.uint64(0xBF58476D1CE4E5B9)
+SPLITMIX_MUL2 = np.uint64(0x94D049BB133111EB)
+
+#
+# Returns the random numbers in [0, 1) for exercises start .. stop - 1 as an
+# array of shape [stop - start, width].
+#
+@stats.timed('random_numbers')
+def counter_uniforms(key, start, stop, width):
+    counters = (np.arange(start, stop, dtype=np.uint64)[:, None] << np.uint64(16)) + np.arange(width, dtype=np.uint64)[None, :]
+    z = _mix64(np.uint64(key) + (counters + np.uint64(1)) * SPLITMIX_GAMMA)
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+# The SplitMix64 finalizer, on a numpy array of uint64.
+def _mix64(z):
+    z = (z ^ (z >> np.uint64(30))) * SPLITMIX_MUL1
+    z = (z ^ (z >> np.uint64(27))) * SPLITMIX_MUL2
+    return z ^ (z >> np.uint64(31))
+
+#
+# Returns exercises start .. stop - 1 (counting from 0) of the run with the
+# given seed and ExerciseSpec as a numpy array, without generating the ones
+# before them.
+#
+def get_range(seed, spec, start, stop):
+    sampler = get_row_sampler(spec)
+    uniforms = counter_uniforms(stream_key(seed, spec), start, max(start, stop), len(sampler.domains))
+    return sample_rows_batch(sampler, uniforms)
+
+#
+# Returns exercise k (counting from 0, so 'Exercise 1' on the worksheet is k = 0)
+# of the run with the given seed and ExerciseSpec as a list of numbers.
+#
+def get_exercise(seed, spec, k):
+    return get_range(seed, spec, k, k + 1)[0].tolist()
+
+#
+# Yields the exercises of the run with the given seed and ExerciseSpec in
+# blocks, as tuples of (rows, answers) numpy arrays of block_size exercises
+# (the last block can be shorter). Blocks are only generated when asked for,
+# so a consumer can start on the first block straight away and memory stays
+# bounded by the block size.
+#
+# block_size : how many exercises in a block
+# n : how many exercises in total (None - go on forever)
+# seed : seed of the run (a random one if None)
+# start : exercise to start from (counting from 0)
+#
+def iter_exercise_blocks(spec, block_size = 1024, n = None, seed = None, start = 0):
+    seed = make_seed(seed)
+    k = start
+    while n is None or k < start + n:
+        stop = k + block_size
+        if n is not None:
+            stop = min(stop, start + n)
+        rows = get_range(seed, spec, k, stop)
+        yield (rows, rows.sum(axis=1))
+        k = stop
+
+#
+# Yields the exercises of the run with the given seed and ExerciseSpec one at
+# a time as (numbers, answer) tuples. Same parameters as iter_exercise_blocks;
+# exercises are generated block_size at a time behind the scenes.
+#
+def iter_exercises(spec, n = None, seed = None, block_size = 1024):
+    for (rows, answers) in iter_exercise_blocks(spec, block_size, n, seed):
+        for (numbers, answer) in zip(rows.tolist(), answers.tolist()):
+            yield (numbers, answer)
+
+#
+# Exercises for one ExerciseSpec, generated in advance.
+#
+# spec : the ExerciseSpec of the exercises
+# size : how many exercises to keep ready
+# low_water : when fewer exercises than this are left, the pool gets topped up
+# seed : seed of the pool's random stream (a random one if None)
+#
+class ExercisePool:
+    def __init__(self, spec, size = 10000, low_water = 2000, seed = None):
+        self.spec = spec
+        self.size = size
+        self.low_water = low_water
+        self.seed = make_seed(seed)
+        self.rows = deque()
+        self.refill = None
+        # the next exercise of the stream that nobody has taken yet. Exercises
+        # come from the counter-based streams, so reserving a range of them is
+        # all that needs the lock; generating can then run in any thread.
+        self._next_exercise = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _reserve(self, count):
+        with self._lock:
+            start = self._next_exercise
+            self._next_exercise += count
+        return start
+
+    # Generates count exercises and returns them as a list of rows.
+    def generate(self, count):
+        start = self._reserve(count)
+        return get_range(self.seed, self.spec, start, start + count).tolist()
+
+    # Tops the pool up to its size (blocking, meant to run in a thread).
+    def fill(self):
+        missing = self.size - len(self.rows)
+        if missing > 0:
+            self.rows.extend(self.generate(missing))
+
+    # Takes n exercises out of the pool. Whatever the pool does not have is
+    # generated on the spot. Safe to call from several threads at once.
+    def take(self, n):
+        taken = []
+        try:
+            while len(taken) < n:
+                taken.append(self.rows.popleft())
+        except IndexError:
+            pass
+        if len(taken) < n:
+            taken += self.generate(n - len(taken))
+        return taken
+
+    # Starts topping the pool up in the background if it is below low_water
+    # (and it is not being topped up already).
+    def schedule_refill(self, loop):
+        if len(self.rows) < self.low_water and (self.refill is None or self.refill.done()):
+            self.refill = loop.run_in_executor(None, self.fill)
+        return self.refill
+
+#
+# In-process cache of ExercisePools keyed by ExerciseSpec, i.e. by the
+# parameters after normalization, so that e.g. max_sum = 100 and max_sum = 88
+# with max_answer_digit = 8 share a pool. Only the max_pools most recently used
+# pools are kept. Exercises drawn from a pool are removed from it, so two draws
+# never give the same exercise twice.
+#
+# max_pools : how many pools to keep before evicting the least recently used
+# pool_size, pool_low_water : size and low-water mark of each pool
+#
+class ExercisePoolCache:
+    def __init__(self, max_pools = 32, pool_size = 10000, pool_low_water = 2000):
+        self.max_pools = max_pools
+        self.pool_size = pool_size
+        self.pool_low_water = pool_low_water
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pools)
+
+    def __contains__(self, spec):
+        return spec in self._pools
+
+    def items(self):
+        with self._lock:
+            return list(self._pools.items())
+
+    # Returns the pool for spec without counting it as a use.
+    def peek(self, spec):
+        return self._pools.get(spec)
+
+    # Returns the pool for spec, creating it (empty) if it isn't cached.
+    def get_pool(self, spec):
+        with self._lock:
+            pool = self._pools.get(spec)
+            if pool is not None:
+                self.hits += 1
+                self._pools.move_to_end(spec)
+                return pool
+
+            self.misses += 1
+            pool = ExercisePool(spec, self.pool_size, self.pool_low_water)
+            self._pools[spec] = pool
+            if len(self._pools) > self.max_pools:
+                self._pools.popitem(last=False)
+                self.evictions += 1
+            return pool
+
+    # Draws n exercises for spec that no other draw from this cache has
+    # returned. An empty pool is filled first.
+    def draw(self, spec, n):
+        pool = self.get_pool(spec)
+        if len(pool) < n:
+            pool.fill()
+        return pool.take(n)
+
+    def stats(self):
+        return {'pools': len(self._pools), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# the cache draw_exercises uses
+pool_cache = ExercisePoolCache()
+
+#
+# Returns n exercises (rows of numbers) for the given gen_numbers parameters
+# from pool_cache. Repeated requests with the same parameters are served from
+# the cached pool instead of being generated from scratch.
+#
+def draw_exercises(n,
+                   how_many_numbers = 4,
+                   max_number = 5,
+                   max_sum = 15,
+                   first_number_digit_count = 2,
+                   max_digit_in_multi_digit_number = 8,
+                   max_answer_digit = 8,
+                   buffer_prefill = [],
+                   use_negative = True,
+                   answer_can_be_negative = True):
+    return pool_cache.draw(make_spec(how_many_numbers,
+                                     max_number,
+                                     max_sum,
+                                     first_number_digit_count,
+                                     max_digit_in_multi_digit_number,
+                                     max_answer_digit,
+                                     buffer_prefill,
+                                     use_negative,
+                                     answer_can_be_negative), n)
+
+# How many rows make one chunk of parallel generation.
+PARALLEL_CHUNK_ROWS = 8192
+
+#
+# Generates rows start .. start + count - 1 of a run with the given root seed.
+# The rows come from the counter-based random streams (see get_range), so it
+# does not matter which process generates them or how a run is split.
+#
+def gen_chunk(spec, start, count, seed):
+    return get_range(seed, spec, start, start + count)
+
+def _gen_chunk_task(task):
+    return gen_chunk(*task)
+
+#
+# Generates count rows for the given ExerciseSpec in chunks of
+# PARALLEL_CHUNK_ROWS and yields the chunks (numpy arrays) in order.
+#
+# With workers > 1 the chunks are generated by a pool of processes, but only a
+# few chunks per worker are ever waiting to be consumed, so memory stays bounded.
+# The rows for a given seed are the same whatever the number of workers.
+#
+# seed : root seed of the run (see make_seed)
+# workers : how many processes to generate with
+#
+def iter_row_chunks(spec, count, seed, workers = 1):
+    tasks = [(spec, start, min(PARALLEL_CHUNK_ROWS, count - start), seed)
+             for start in range(0, count, PARALLEL_CHUNK_ROWS)]
+
+    if workers <= 1 or len(tasks) <= 1:
+        for (rows, answers) in iter_exercise_blocks(spec, PARALLEL_CHUNK_ROWS, count, seed):
+            yield rows
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = 2 * workers
+        for start in range(0, len(tasks), window):
+            for chunk in pool.map(_gen_chunk_task, tasks[start:start + window]):
+                yield chunk
+
+#
+# Generates count rows for the given ExerciseSpec as one numpy array, using
+# workers processes. See iter_row_chunks.
+#
+def gen_numbers_parallel(spec, count, seed, workers = 1):
+    chunks = list(iter_row_chunks(spec, count, seed, workers))
+    if not chunks:
+        return np.empty((0, spec.term_count + len(spec.buffer_prefill)), dtype=np.int64)
+    return np.concatenate(chunks)
+
+#
+# Same as iter_row_chunks, but yields the rows one by one as lists.
+#
+def gen_rows_in_chunks(spec, count, seed, workers = 1):
+    for chunk in iter_row_chunks(spec, count, seed, workers):
+        for numbers in chunk.tolist():
+            yield numbers
+
+#
+# Returns a 64-bit hash (numpy uint64) of each of the given rows (numpy array
+# of shape [rows, numbers]). The hash only depends on the numbers of the row,
+# so it is the same whatever spec the row was generated for.
+#
+def hash_rows(rows):
+    rows = np.asarray(rows, dtype=np.int64)
+    hashes = np.full(len(rows), rows.shape[1], dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(rows.shape[1]):
+            hashes = _mix64((hashes ^ rows[:, i].astype(np.uint64)) + SPLITMIX_GAMMA)
+    return hashes
+
+#
+# Returns a 64-bit key (numpy int64) for each of the given rows (valid rows of
+# the ExerciseSpec), so that rows can be compared and looked up as single
+# integers instead of tuples of Python ints. If the numbers of the domains
+# fit, the key is the row packed as a mixed-radix number, so different rows
+# always have different keys; otherwise it is the row's hash (see hash_rows).
+#
+def row_keys(spec, rows):
+    sampler = get_row_sampler(spec)
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.ndim != 2 or rows.shape[1] != len(sampler.domains):
+        raise ValueError("Rows must have " + str(len(sampler.domains)) + " numbers.")
+
+    widths = [domain[-1] - domain[0] + 1 for domain in sampler.domains]
+    if np.prod([float(width) for width in widths]) < 2.0 ** 62:
+        keys = np.zeros(len(rows), dtype=np.int64)
+        for (i, domain) in enumerate(sampler.domains):
+            keys = keys * widths[i] + (rows[:, i] - domain[0])
+        return keys
+    return hash_rows(rows).view(np.int64)
+
+# Up to how many valid rows the rows of a unique run (or one that excludes
+# some rows) are picked from the enumerated valid rows (see gen_unique_rows).
+UNIQUE_ENUMERATE_ROWS = 1 << 22
+
+# How many chunks of PARALLEL_CHUNK_ROWS rows in a row may bring no new row
+# before generation gives up (see gen_unique_rows).
+MAX_EMPTY_CHUNKS = 100
+
+#
+# Generates count different rows for the given ExerciseSpec as one numpy
+# array, so that no exercise is repeated on a worksheet.
+#
+# If the valid rows are few (up to UNIQUE_ENUMERATE_ROWS) or count is a good
+# part of them, count of their ranks are drawn without replacement and turned
+# into rows (see unrank_rows_batch). Otherwise rows come from the run's random
+# stream (see get_range) and the ones already seen are skipped; the rows seen
+# so far are kept as a sorted array of their keys (see row_keys), 8 bytes a
+# row. With exclude, the valid rows are only all enumerated (and the excluded
+# ones left out) if count is a good part of them or if most of the rows of the
+# stream are excluded.
+#
+# Raises InfeasibleSpecError if there are fewer than count valid rows.
+#
+# seed : root seed of the run (see make_seed)
+# exclude : function that takes rows and returns a boolean array of the ones
+#           that must not be used (e.g. SeenFilter.contains), None - none
+#
+def gen_unique_rows(spec, count, seed, exclude = None):
+    return _gen_rows_excluding(spec, count, seed, exclude, True)
+
+#
+# Generates count rows for the given ExerciseSpec as one numpy array, none of
+# them one of the rows that exclude (see gen_unique_rows) rules out. Rows can
+# repeat, as in gen_numbers_parallel.
+#
+def gen_rows_excluding(spec, count, seed, exclude):
+    return _gen_rows_excluding(spec, count, seed, exclude, False)
+
+def _too_few_rows_error(spec, reason):
+    return InfeasibleSpecError(replace(analyze_spec(spec), reasons = (reason,)))
+
+def _gen_rows_excluding(spec, count, seed, exclude, unique):
+    sampler = get_row_sampler(spec)
+    if unique and count > sampler.total:
+        raise _too_few_rows_error(spec, "there are only " + str(sampler.total) + " different valid rows, but " + str(count) +
+                                  " different exercises were asked for")
+    if count == 0:
+        return np.empty((0, len(sampler.domains)), dtype=np.int64)
+
+    rng = np.random.default_rng(stream_key(seed, spec))
+    # enumerating costs the same however few rows are asked for, so it is only
+    # worth it if they are a good part of the valid rows (or, see below, most
+    # of the valid rows are excluded)
+    can_enumerate = sampler.total <= UNIQUE_ENUMERATE_ROWS
+    if exclude is not None and can_enumerate and 4 * count > sampler.total:
+        return _draw_from_remaining_rows(spec, sampler, count, exclude, unique, rng)
+
+    if unique and exclude is None and sampler.total < 2 ** 63 and (sampler.total <= UNIQUE_ENUMERATE_ROWS or 4 * count > sampler.total):
+        stats.count('unique_rows_enumerated', count)
+        return unrank_rows_batch(sampler, rng.choice(sampler.total, count, replace=False))
+
+    seen = np.empty(0, dtype=np.int64)
+    chunks = []
+    found = 0
+    start = 0
+    empty_chunks = 0
+    while found < count:
+        if empty_chunks >= MAX_EMPTY_CHUNKS:
+            raise _too_few_rows_error(spec, "only " + str(found) + " of " + str(count) + " exercises were found in " + str(start) +
+                                      " rows, the rest are repeats or excluded")
+        rows = get_range(seed, spec, start, start + PARALLEL_CHUNK_ROWS)
+        start += PARALLEL_CHUNK_ROWS
+        keep = np.ones(len(rows), dtype=bool)
+        if exclude is not None:
+            keep = ~np.asarray(exclude(rows), dtype=bool)
+            if start == PARALLEL_CHUNK_ROWS and can_enumerate and 4 * keep.sum() < len(keep):
+                # most rows are excluded, skipping them would take long
+                return _draw_from_remaining_rows(spec, sampler, count, exclude, unique, rng)
+        if unique:
+            # first time each key is in the chunk, and not in an earlier one
+            (keys, first) = np.unique(row_keys(spec, rows[keep]), return_index=True)
+            at = np.searchsorted(seen, keys)
+            new = seen[np.minimum(at, len(seen) - 1)] != keys if len(seen) else np.ones(len(keys), dtype=bool)
+            picked = np.flatnonzero(keep)[np.sort(first[new])]
+            seen = np.insert(seen, at[new], keys[new])
+        else:
+            picked = np.flatnonzero(keep)
+        picked = picked[:count - found]
+        stats.count('rows_skipped', len(rows) - len(picked))
+        empty_chunks = 0 if len(picked) else empty_chunks + 1
+        chunks.append(rows[picked])
+        found += len(picked)
+    return np.concatenate(chunks)
+
+# Draws count rows from all the valid rows that exclude leaves, enumerated.
+def _draw_from_remaining_rows(spec, sampler, count, exclude, unique, rng):
+    rows = unrank_rows_batch(sampler, np.arange(sampler.total))
+    rows = rows[~np.asarray(exclude(rows), dtype=bool)]
+    stats.count('unique_rows_enumerated', len(rows))
+    if len(rows) < (count if unique else 1):
+        raise _too_few_rows_error(spec, "only " + str(len(rows)) + " of the " + str(sampler.total) +
+                                  " valid rows are not excluded, but " + str(count) + " exercises were asked for")
+    return rows[rng.choice(len(rows), count, replace=not unique)]
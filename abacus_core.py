@@ -0,0 +1,1269 @@
+#
+# Generation core of the abacus exercise generator: parameter handling,
+# ExerciseSpec and the exact row sampler. Only needs the standard library, so
+# importing it is quick; numpy based batch generation is in abacus_batch and
+# the workbook / csv / json writers are in abacus_export.
+#
+
+import random as r
+import copy as c
+import math as m
+import hashlib
+import warnings
+from bisect import bisect_right
+from functools import lru_cache
+from dataclasses import dataclass, field, fields, replace
+
+from abacus_formulas import FORMULA_BITS, find_formula, step_formulas
+import abacus_stats as stats
+
+#
+# Generates a sequence of numbers that can be then used for creating an abacus
+# exercise.
+#
+# how_many_numbers : how many numbers to generate
+# max_number : maximum giving us numbers in range [-max_number, max_number]
+# max_sum : maximum sum that the generated numbers must add up to
+# first_number_digit_count : how many digits we want in the first number (0 - don't care)
+# max_digit_in_multi_digit_number : what is the maximum digit that we want in the multi digit number (the one at the front of the row)
+# max_answer_digit : maximum digit in the answer (e.g. if this value is 4 and max_sum=100, then max_sum really is 44 and answer can be 34, 32, etc, but not 39 for instance.)
+# buffer_prefill : numbers that must be present in the final list
+# use_negative : do we want to use negative numbers
+# answer_can_be_negative : do we want to have exercises with negative answer
+# rng : random number generator to use (anything with randrange(), e.g. a
+#       random.Random instance), the module-global random by default
+#
+# NOTE: ATM it is assumed that both max_number and max_sum are positive.
+def gen_numbers(how_many_numbers = 4,
+                max_number = 5,
+                max_sum = 15,
+                first_number_digit_count = 2,
+                max_digit_in_multi_digit_number = 8,
+                max_answer_digit = 8,
+                buffer_prefill = [],
+                use_negative = True,
+                answer_can_be_negative = True,
+                rng = r):
+    # Rows are drawn directly from the set of rows that obey all the rules
+    # (see RowSampler), so there is nothing to repair afterwards. The sampler
+    # is built once for a given set of parameters and then reused.
+    return gen_numbers_from_spec(make_spec(how_many_numbers,
+                                           max_number,
+                                           max_sum,
+                                           first_number_digit_count,
+                                           max_digit_in_multi_digit_number,
+                                           max_answer_digit,
+                                           buffer_prefill,
+                                           use_negative,
+                                           answer_can_be_negative),
+                                 rng)
+
+#
+# Generates a row of numbers for the given ExerciseSpec. This is what gen_numbers
+# does once the parameters are turned into a spec.
+#
+# rng : anything with a randrange() method (the random module by default)
+#
+def gen_numbers_from_spec(spec, rng = r):
+    stats.count('rows_sampled')
+    return get_row_sampler(spec).sample(rng)
+
+#
+# Generates a row of numbers for the given ExerciseSpec the way gen_numbers did
+# before the row sampler: random numbers that are then repaired with the
+# enforce_* functions. The repairs don't always manage, so the rows can break
+# the rules; kept to compare with and to measure how often (see abacus_verify).
+#
+def gen_numbers_repaired(spec, rng = r):
+    if spec.term_count == 0:
+        return list(spec.buffer_prefill)
+    numbers = [gen_non_zero(spec.max_number, spec.use_negative, rng) for cnt in range(spec.term_count)]
+    numbers = enforce_positive_number_first(numbers, spec.max_number, rng)
+    numbers = enforce_max_sum(numbers, spec.max_number, spec.max_answer_digit, spec.budget, spec.use_negative, spec.answer_can_be_negative)
+    if spec.first_number_digit_count > 0:
+        numbers = enforce_given_number_first(spec.first_number_digit_count, spec.max_digit_in_multi_digit_number, numbers,
+                                             spec.max_number, spec.budget, spec.max_answer_digit, spec.use_negative,
+                                             spec.answer_can_be_negative, rng)
+    return numbers + list(spec.buffer_prefill)
+
+#
+# Brings the parameters of gen_numbers (and gen_numbers_batch) into a sane
+# state and caps max_sum so that it obeys max_answer_digit.
+#
+# Returns a tuple of (how_many_numbers, max_number, max_sum, max_answer_digit).
+#
+def sanitize_parameters(how_many_numbers = 4, max_number = 5, max_sum = 15, max_answer_digit = 8):
+    # input sanity
+    if max_number >= max_sum:
+        max_number = max_sum - 1
+    # input sanity
+    if how_many_numbers <= 0:
+        how_many_numbers = 1
+    # input sanity
+    if max_sum <= max_number:
+        max_sum = max_number + 1
+    # sanitize input
+    if max_answer_digit > 9 or max_answer_digit < 0:
+        max_answer_digit = 9
+
+    max_sum = cap_max_sum_by_answer_digit(max_sum, max_answer_digit)
+
+    return (how_many_numbers, max_number, max_sum, max_answer_digit)
+
+#
+# Caps max_sum so that it obeys max_answer_digit (see gen_numbers), e.g.
+# max_sum = 500 and max_answer_digit = 4 gives 444.
+#
+def cap_max_sum_by_answer_digit(max_sum = 15, max_answer_digit = 8):
+    # if max_answer_digit > 0 then that means we want the answer to consist of
+    # carefully bounded digits. We may need to re-calculate max_sum, because for
+    # example if max_sum == 500, but max_answer_digit == 4, then it's immediately
+    # clear that max_sum cannot be greater than 444. And even then we can't allow
+    # numbers like 395 as digits 9 and 5 would violate the rule.
+    if max_answer_digit > 0:
+        # first find out how many digits we have in max_sum
+        max_sum_digit_count = 0
+        while 10 ** max_sum_digit_count < max_sum:
+            max_sum_digit_count += 1
+
+        # now find the most significant number in the max_sum
+        most_significant_digit_in_max_sum = m.floor(max_sum / (10 ** (max_sum_digit_count - 1)))
+
+        # if most_significant_digit_in_max_sum is greater than max_answer_digit,
+        # then we will reduce the most_significant_digit_in_max_sum to be
+        # max_answer_digit. If it is smaller though, then we need to preserve
+        # it so that the resulting max_sum is something 244, instead of 444, when
+        # max_answer_digit == 4 and most_significant_digit_in_max_sum == 2.
+        if most_significant_digit_in_max_sum > max_answer_digit:
+            # max bound of max_sum if we obey max_answer_digit
+            max_bound_of_max_sum_with_digits = sum([max_answer_digit * 10 ** i for i in range(max_sum_digit_count)])
+        else:
+            max_bound_of_max_sum_with_digits = most_significant_digit_in_max_sum * 10 ** (max_sum_digit_count - 1)
+            max_bound_of_max_sum_with_digits += sum([max_answer_digit * 10 ** i for i in range(max_sum_digit_count - 1)])
+
+        if max_sum > max_bound_of_max_sum_with_digits:
+            max_sum = max_bound_of_max_sum_with_digits
+        # Now our max_sum will be something like 444 if max_answer_digit = 4 and initial max_sum was greater than 444.
+        # Or something like 244 if max_sum was only something like 299. But if max_sum was something like 219, then
+        # we now have 219 as max_sum and of course digit 9 clearly violates the max_answer_digit rule.
+        # In other ways too that doesn't guarantee that our result will obey max_answer_digit. It could be for
+        # instance 349 or 299, so at the moment only the most significant digit will be strictly obeying
+        # max_answer_digit rule. Let's fix that.
+
+        # Explanation via an example: Assume that max_sum_digit_count == 3,
+        # so we'll have 100's, 10's and 1's.
+        # In the beginning we have max_sum, which we divide by 100. We get quotient,
+        # which is the current number in max_sum moving from left to right and we
+        # also get remainder, which is what we divide furhter by 10 this time.
+        # That yields us the next current number in max_sum moving from left to
+        # right. And finally we divide the remainder of that division by 1 and that
+        # is our last digit in the max_sum. We can now compare all the digits and make
+        # adjustments.
+        current_digit_in_max_sum = 0
+        remainder_of_max_sum = max_sum
+        new_max_sum = 0
+        for cnt in reversed(range(max_sum_digit_count)):
+            (current_digit_in_max_sum, remainder_of_max_sum) = divmod(remainder_of_max_sum, 10 ** cnt)
+            if current_digit_in_max_sum > max_answer_digit:
+                new_max_sum += max_answer_digit * 10 ** cnt
+            else:
+                new_max_sum += current_digit_in_max_sum * 10 ** cnt
+
+        max_sum = new_max_sum
+
+    return max_sum
+
+#
+# All the parameters of an exercise, validated and normalized once, together
+# with everything that can be worked out from them in advance: the effective
+# max_sum, the budget left after buffer_prefill, the bounds of the first number
+# and the index of the answers that are allowed.
+#
+# ExerciseSpec is immutable and two specs with the same normalized parameters
+# are equal and hash the same, so a spec can be used as a cache key (see
+# get_row_sampler). Build one with make_spec() or directly, e.g.
+# ExerciseSpec(max_number = 5, max_sum = 15, buffer_prefill = (4,)).
+#
+@dataclass(frozen=True)
+class ExerciseSpec:
+    how_many_numbers: int = 4
+    max_number: int = 5
+    max_sum: int = 15
+    first_number_digit_count: int = 2
+    max_digit_in_multi_digit_number: int = 8
+    max_answer_digit: int = 8
+    buffer_prefill: tuple = ()
+    use_negative: bool = True
+    answer_can_be_negative: bool = True
+    # drill one abacus rule: a name from abacus_formulas.FORMULAS that every
+    # row uses in at least formula_count steps, and at each of the positions in
+    # formula_steps (1 being the step that adds the second number). These are
+    # left out of repr so that the random streams of specs without a formula
+    # stay the same (see stream_key).
+    formula: str = field(default='', repr=False)
+    formula_count: int = field(default=1, repr=False)
+    formula_steps: tuple = field(default=(), repr=False)
+    # hold every running total (what the abacus shows after each number) to
+    # the same rules as the answer: within [min_answer, max_sum] and no digit
+    # above max_answer_digit
+    check_running_totals: bool = field(default=False, repr=False)
+
+    # worked out from the parameters above in __post_init__
+    term_count: int = field(init=False, compare=False, repr=False)
+    budget: int = field(init=False, compare=False, repr=False)
+    min_answer: int = field(init=False, compare=False, repr=False)
+    first_number_lower_bound: int = field(init=False, compare=False, repr=False)
+    first_number_upper_bound: int = field(init=False, compare=False, repr=False)
+    answer_index: 'AnswerIndex' = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        # the class is frozen, so normalized values have to be set this way
+        def set_value(name, value):
+            object.__setattr__(self, name, value)
+
+        (how_many_numbers, max_number, max_sum, max_answer_digit) = sanitize_parameters(self.how_many_numbers, self.max_number, self.max_sum, self.max_answer_digit)
+        set_value('how_many_numbers', how_many_numbers)
+        set_value('max_number', max_number)
+        set_value('max_sum', max_sum)
+        set_value('max_answer_digit', max_answer_digit)
+        set_value('buffer_prefill', tuple(self.buffer_prefill))
+        set_value('use_negative', bool(self.use_negative))
+        set_value('answer_can_be_negative', bool(self.answer_can_be_negative))
+        if self.first_number_digit_count < 0:
+            set_value('first_number_digit_count', 0)
+        if self.max_digit_in_multi_digit_number > 9 or self.max_digit_in_multi_digit_number < 0:
+            set_value('max_digit_in_multi_digit_number', 9)
+        if self.formula:
+            set_value('formula', find_formula(self.formula))
+            set_value('formula_count', max(int(self.formula_count), 0))
+            set_value('formula_steps', tuple(sorted(set(int(step) for step in self.formula_steps))))
+            row_len = max(how_many_numbers, len(self.buffer_prefill))
+            if any(step < 1 or step >= row_len for step in self.formula_steps):
+                raise ValueError("formula_steps must be positions 1 .. " + str(row_len - 1) + " of the row.")
+        else:
+            set_value('formula', '')
+            set_value('formula_count', 1)
+            set_value('formula_steps', ())
+        set_value('check_running_totals', bool(self.check_running_totals))
+
+        # the generated part of the row is followed by buffer_prefill
+        set_value('term_count', max(how_many_numbers - len(self.buffer_prefill), 0))
+        set_value('budget', max_sum - sum(self.buffer_prefill))
+        set_value('min_answer', -1 * max_sum if self.answer_can_be_negative else 0)
+
+        # bounds of the multi-digit first number, same as in enforce_given_number_first.
+        # Both are 0 if the first number is just a positive number up to max_number.
+        lower_bound = 0
+        upper_bound = 0
+        if self.first_number_digit_count > 0:
+            lower_bound = 10 ** (self.first_number_digit_count - 1)
+            upper_bound = self.budget - (self.term_count - 1)
+            if (upper_bound <= lower_bound or
+                count_multi_digit_numbers_in_range(self.first_number_digit_count, self.max_digit_in_multi_digit_number, lower_bound, upper_bound) == 0):
+                lower_bound = 0
+                upper_bound = 0
+        set_value('first_number_lower_bound', lower_bound)
+        set_value('first_number_upper_bound', upper_bound)
+
+        set_value('answer_index', get_answer_index(self.min_answer, max_sum, max_answer_digit))
+
+    # Is the first number a multi-digit number?
+    def has_multi_digit_first_number(self):
+        return self.first_number_upper_bound > 0
+
+#
+# Returns the ExerciseSpec for the given gen_numbers parameters. Specs are
+# cached, so calling this for every exercise costs only a lookup.
+#
+def make_spec(how_many_numbers = 4,
+              max_number = 5,
+              max_sum = 15,
+              first_number_digit_count = 2,
+              max_digit_in_multi_digit_number = 8,
+              max_answer_digit = 8,
+              buffer_prefill = [],
+              use_negative = True,
+              answer_can_be_negative = True,
+              formula = '',
+              formula_count = 1,
+              formula_steps = (),
+              check_running_totals = False):
+    return _make_spec(how_many_numbers,
+                      max_number,
+                      max_sum,
+                      first_number_digit_count,
+                      max_digit_in_multi_digit_number,
+                      max_answer_digit,
+                      tuple(buffer_prefill),
+                      use_negative,
+                      answer_can_be_negative,
+                      formula,
+                      formula_count,
+                      tuple(formula_steps),
+                      check_running_totals)
+
+@lru_cache(maxsize=256)
+def _make_spec(*params):
+    return ExerciseSpec(*params)
+
+#
+# Returns the parameters of spec as a dict of plain values (buffer_prefill as
+# a list), e.g. to store them as json. ExerciseSpec(**spec_to_dict(spec)) gives
+# the same spec back.
+#
+def spec_to_dict(spec):
+    return {f.name: (list(getattr(spec, f.name)) if f.name == 'buffer_prefill' else getattr(spec, f.name))
+            for f in fields(spec) if f.init}
+
+def enforce_positive_number_first(numbers=[-1,2,3], max_number = 5, rng = r):
+    # We have to make sure that our list doesn't start with a negative number.
+    # For that we'll find first positive number and re-make the list so that
+    # the found positive number is at the beginning.
+    pos_loc = -1
+    for cnt in range(len(numbers)):
+        if numbers[cnt] > 0:
+            pos_loc = cnt
+            break
+
+    if (pos_loc > -1):
+        numbers = numbers[pos_loc:] + numbers[:pos_loc]
+        stats.count('positive_first_rotations')
+    else:
+        stats.count('positive_first_regenerations')
+        # if there are no positive numbers at all, then make the first positive
+        # and subtract from all others equally
+        first_num = gen_non_zero(max_number, False, rng)
+        
+        diff = first_num - numbers[0]
+        numbers[0] = first_num
+        
+        # a row of one number has nothing else to take the difference from
+        if len(numbers) > 1:
+            cnt = 1
+            while diff > 0:
+                numbers[cnt] -= 1
+                diff -= 1
+                cnt += 1
+                if cnt >= len(numbers): cnt = 1
+        
+    return numbers
+
+#
+# Will try to enforce a given first number in the list retaining max_sum constraint.
+#
+# first_number_digit_count : How many digits we want in the first number
+# max_digit_in_multi_digit_number : what is the maximum digit in the first number
+# numbers : current numbers in the row
+# max_number : maximum number to use
+# max_sum : maximum sum allowed for the whole row
+# max_answer_digit : maximum digit in answer.
+# use_negative : can we use negative numbers?
+# answer_can_be_negative : can answer be negative?
+# rng : random number generator to use (the module-global random by default)
+#
+def enforce_given_number_first(first_number_digit_count, max_digit_in_multi_digit_number = 8, numbers = [], max_number = 10, max_sum = 100, max_answer_digit = 8, use_negative = False, answer_can_be_negative = False, rng = r):
+    # if we want the first number to have certain number of digits, then
+    # generate those digits now and try to keep enforcement of max sum.
+    if (first_number_digit_count > 0):
+        # sanitize input
+        if max_digit_in_multi_digit_number > 9 or max_digit_in_multi_digit_number < 0:
+            max_digit_in_multi_digit_number = 9
+
+        new_first_number = numbers[0]
+        # we'll generate a multi-digit number, but to make sure that max_sum remains
+        # enforceable, this new number needs to be less than max_sum and leave at least
+        # a value of 1 (better 5) for each of the remaining numbers.
+        multi_digit_number_upper_bound = max_sum - 1 * (len(numbers) - 1)
+
+        # and of course the lower bound for multi-digit number must be 10 ^ (first_number_digit_count - 1)
+        # so that for example if we want to generate a 3 digit number, then we generate at least 100.
+        # We may want to change this in the future through a parameter.
+        multi_digit_number_lower_bound = 10 ** (first_number_digit_count - 1)
+
+        # making sure that generation will be sane. If there is no number with the
+        # required digits in the range, then the first number stays as it was.
+        if (multi_digit_number_upper_bound > multi_digit_number_lower_bound and
+            count_multi_digit_numbers_in_range(first_number_digit_count, max_digit_in_multi_digit_number,
+                                               multi_digit_number_lower_bound, multi_digit_number_upper_bound) > 0):
+            new_first_number = gen_multi_digit_number(first_number_digit_count, max_digit_in_multi_digit_number,
+                                                      multi_digit_number_lower_bound, multi_digit_number_upper_bound, rng)
+            numbers[0] = new_first_number
+        else:
+            stats.count('multi_digit_first_number_failures')
+
+        # The first number is now with the required digit count.
+        # Now we need to enforce the max_sum on this new row of numbers.
+        max_sum_for_remainder_of_row = max_sum - new_first_number
+        numbers = numbers[:1] + enforce_max_sum(numbers[1:], max_number, max_answer_digit, max_sum_for_remainder_of_row, use_negative, answer_can_be_negative)
+    return numbers
+
+#
+# Counts the numbers that have exactly digit_count digits, all of them in range
+# [1, max_digit], and that are less or equal to value.
+#
+# Works one digit of value at a time from the left: at each digit we count all
+# the numbers that have a smaller allowed digit there (the digits after it can
+# then be anything allowed), and carry on only if the digit itself is allowed.
+#
+def count_multi_digit_numbers_up_to(value, digit_count, max_digit):
+    if value >= 10 ** digit_count:
+        return max_digit ** digit_count
+    if value < 10 ** (digit_count - 1):
+        return 0
+
+    count = 0
+    digits = str(value)
+    for cnt in range(digit_count):
+        digit = int(digits[cnt])
+        count += min(max(digit - 1, 0), max_digit) * max_digit ** (digit_count - cnt - 1)
+        if digit < 1 or digit > max_digit:
+            return count
+    # value itself is one of the numbers too
+    return count + 1
+
+#
+# How many numbers with digit_count digits, all in range [1, max_digit], there
+# are in range [lower_bound, upper_bound]. 0 means there are none to choose from.
+#
+def count_multi_digit_numbers_in_range(digit_count, max_digit, lower_bound, upper_bound):
+    if upper_bound < lower_bound:
+        return 0
+    return (count_multi_digit_numbers_up_to(upper_bound, digit_count, max_digit) -
+            count_multi_digit_numbers_up_to(lower_bound - 1, digit_count, max_digit))
+
+#
+# Returns the index-th (counting from 0) smallest number with digit_count digits,
+# all in range [1, max_digit]. These numbers are just the numbers 0, 1, 2, ...
+# written in base max_digit, with 1 added to every digit.
+#
+def nth_multi_digit_number(index, digit_count, max_digit):
+    number = 0
+    for cnt in reversed(range(digit_count)):
+        (digit, index) = divmod(index, max_digit ** cnt)
+        number = number * 10 + digit + 1
+    return number
+
+#
+# Generates a number with digit_count digits, all in range [1, max_digit], in
+# range [lower_bound, upper_bound]. All such numbers are equally likely and
+# there is no re-generating, so it takes the same time however narrow the range.
+#
+# Raises ValueError if there is no such number.
+#
+def gen_multi_digit_number(digit_count, max_digit, lower_bound, upper_bound, rng = r):
+    first_index = count_multi_digit_numbers_up_to(lower_bound - 1, digit_count, max_digit)
+    count = count_multi_digit_numbers_in_range(digit_count, max_digit, lower_bound, upper_bound)
+    if count <= 0:
+        raise ValueError("No " + str(digit_count) + "-digit number with digits up to " + str(max_digit) +
+                         " in range [" + str(lower_bound) + ", " + str(upper_bound) + "].")
+    return nth_multi_digit_number(first_index + rng.randrange(count), digit_count, max_digit)
+
+# The repair loops give up (with a warning) after this many rounds over the
+# row, so that they can't keep a worker busy for ever.
+MAX_REPAIR_ROUNDS = 10000
+
+# Reduces the sum of the numbers given in numbers list by the given subtractor
+# For example if we have a list of [9, 8, 7], the sum of which is 24, and
+# we want to reduce that list so that the sum is 4 less, then we will end up
+# with something like [7, 7, 6], giving a sum of 20.
+def reduce_sum_of_numbers_by_this(numbers = [9, 8, 7], reduce_by = 4, use_negative = False):
+    # To avoid eternal cycles, we'll use these vars.
+    row_changed = True
+    number_changed = False
+
+    start_sum = sum(numbers) #8
+    end_sum = start_sum - reduce_by # -17
+    difference = reduce_by # 25
+
+    rounds = 0
+    while (difference > 0 and row_changed and rounds < MAX_REPAIR_ROUNDS):
+        rounds += 1
+        row_changed = False
+        subtractor = m.ceil(difference / len(numbers))
+        for cnt in range(len(numbers)):
+            number_changed = False
+            # if we're not allowed to use negative numbers then make sure that we don't
+            # and only optimize if difference is still there.
+            if difference > 0:
+                numbers[cnt] -= subtractor
+                difference -= subtractor
+                number_changed = True # we just changed a number at index cnt.
+                
+                # if we ended up with 0 and are allowed to use negative numbers, then reduce further
+                # but if negative numbers are not allowed, then make it 1 and carry on.
+                if (numbers[cnt] == 0):
+                    if use_negative:
+                        numbers[cnt] -= 1
+                        difference -= 1
+                    else:
+                        numbers[cnt] += 1
+                        difference += 1
+                        # If subtractor is 1, then we've just restored the row to what was decreased before.
+                        if subtractor == 1:
+                            number_changed = False
+                else: # but if we ended up less than 0 and are not allowed negative numbers, then restore.
+                    if (numbers[cnt] < 0 and not use_negative):
+                        numbers[cnt] += subtractor
+                        difference += subtractor
+                        number_changed = False
+            # if there were changes, then we'll need to rerun it again if we're still below threshold
+            if number_changed:
+                row_changed = True
+
+        # figure out how much is over and subtract equal share from each number in the row.
+        difference = sum(numbers) - end_sum
+    stats.count('reduce_sum_rounds', rounds)
+    if difference > 0:
+        stats.count('reduce_sum_failures')
+        warnings.warn("Could not reduce sum fully. It is still " + str(difference) + " too high.", RuntimeWarning)
+        
+    return numbers
+
+#
+# Enforces that the sum of the given list is more than the given minimum
+# numbers : current numbers
+# max_number : maximum number allowed in the row
+# min_sum : lower bound of the sum of the row of numbers.
+def enforce_min_sum(numbers = [], max_number = 10, min_sum = 5):
+    # The numbers are increased by one at a time, going round the row and
+    # skipping the ones that are already at max_number, until the sum is high
+    # enough. Instead of going round one step at a time (which takes as long
+    # as the difference is big) we find how many full rounds are needed and
+    # then finish the last round from the front of the row.
+    difference = min_sum - sum(numbers)
+    room = [max(max_number - number, 0) for number in numbers]
+
+    if difference > 0:
+        needed = difference
+        # the most full rounds that don't add more than difference
+        (low, high) = (0, max(room, default=0))
+        while low < high:
+            rounds = (low + high + 1) // 2
+            if sum(min(rounds, space) for space in room) <= difference:
+                low = rounds
+            else:
+                high = rounds - 1
+        for cnt in range(len(numbers)):
+            step = min(low, room[cnt])
+            numbers[cnt] += step
+            difference -= step
+        for cnt in range(len(numbers)):
+            if difference > 0 and room[cnt] > low:
+                numbers[cnt] += 1
+                difference -= 1
+        # the increments the one at a time loop would have made
+        stats.count('enforce_min_sum_increments', needed - difference)
+
+    # There is a chance that the enforcement was not possible. Given the
+    # context of usage of this method, it is not worth raising an exception
+    # and denying the output of this method. The result will already be better
+    # even if full enforcement was not possible. But a warning should be issued.
+    if (difference > 0):
+        stats.count('enforce_min_sum_failures')
+        warnings.warn("Could not enforce min sum. Sum is " + str(difference) + " less than needed.", RuntimeWarning)
+        
+    return numbers
+
+#
+# numbers: a row of numbers to optimize
+# max_number : maximum number giving us numbers in range [-max_number, max_number]
+# max_sum : maximum sum that the generated numbers must add up to
+# max_answer_digit : highest digit that is allowed in the answer.
+# use_negative : do we want to use negative numbers
+# answer_can_be_negative : do we want to have exercises with negative answer
+#
+def enforce_max_sum(numbers = [], max_number = 10, max_answer_digit = 8, max_sum = 100, use_negative = False, answer_can_be_negative = False):
+    # sanitize input
+    if max_answer_digit > 9 or max_answer_digit < 0:
+        max_answer_digit = 9
+
+    # first let's establish the minimum bound
+    if answer_can_be_negative:
+        min_sum = -1 * max_sum
+    else:
+        min_sum = 0
+
+    # first reduce the sum to comply with the max_sum parameter
+    numbers = reduce_sum_of_numbers_by_this(numbers, sum(numbers) - max_sum, use_negative)
+    # now get it above the lower bound
+    numbers = enforce_min_sum(numbers, max_number, min_sum)
+
+    # now all that's left is to enforce max_answer_digit in the answer.
+    # So how much are we over if we want to enforce the max_answer_digit?
+    # That is how far the current sum is from the nearest allowed answer below it.
+    # max_sum is different for nearly every row (see enforce_given_number_first),
+    # so the answer is worked out from the digits instead of an AnswerIndex.
+    cur_sum = sum(numbers)
+    over_by = 0
+    allowed_answer = floor_allowed_answer(cur_sum, min_sum, cap_max_sum_by_answer_digit(max_sum, max_answer_digit), max_answer_digit)
+    if allowed_answer is not None:
+        over_by = cur_sum - allowed_answer
+
+    # finally reduce the whole list by what is over
+    numbers = reduce_sum_of_numbers_by_this(numbers, over_by, use_negative)
+
+    return numbers
+
+def gen_non_zero(max_number, use_negative = False, rng = r):
+    # We don't normally want to generate 0-es, so the numbers are drawn from
+    # the non-zero ones only and there is nothing to re-generate. When
+    # negative numbers are used, 1 .. max_number stay as they are and
+    # max_number + 1 .. 2 * max_number become -1 .. -max_number.
+    stats.count('gen_non_zero_draws')
+    if max_number < 1:
+        raise ValueError("There is no non-zero number up to max_number " + str(max_number) + ".")
+    if use_negative:
+        tmp_num = rng.randint(1, 2 * max_number)
+        if tmp_num > max_number:
+            tmp_num = max_number - tmp_num
+    else:
+        tmp_num = rng.randint(1, max_number)
+    return tmp_num
+
+#
+# Returns all the numbers in range [0, upper_bound] whose digits are all less or
+# equal to max_digit, in ascending order. These are just the numbers 0, 1, 2, ...
+# written in base (max_digit + 1) and read as decimal numbers, so there is no
+# need to check every number in the range.
+#
+def _numbers_with_digits_up_to(upper_bound, max_digit):
+    numbers = []
+    base = max_digit + 1
+    index = 0
+    while True:
+        (rest, number, place) = (index, 0, 1)
+        while rest > 0:
+            (rest, digit) = divmod(rest, base)
+            number += digit * place
+            place *= 10
+        if number > upper_bound:
+            return numbers
+        numbers.append(number)
+        index += 1
+
+#
+# Returns the largest number up to value (>= 0) whose digits are all less or
+# equal to max_digit: the first digit that is too big becomes max_digit and so
+# do all the digits after it, e.g. 395 -> 344 for max_digit 4.
+#
+def _floor_with_digits_up_to(value, max_digit):
+    digits = str(value)
+    for (i, digit) in enumerate(digits):
+        if int(digit) > max_digit:
+            return int(digits[:i] + str(max_digit) * (len(digits) - i))
+    return value
+
+# Same, but the smallest number from value (>= 0) up, e.g. 395 -> 400.
+def _ceil_with_digits_up_to(value, max_digit):
+    below = _floor_with_digits_up_to(value, max_digit)
+    if below == value:
+        return value
+    # the number after below, i.e. below + 1 counted in base max_digit + 1
+    (rest, number, place, carry) = (below, 0, 1, 1)
+    while rest > 0 or carry:
+        (rest, digit) = divmod(rest, 10)
+        digit += carry
+        carry = 1 if digit > max_digit else 0
+        number += (0 if carry else digit) * place
+        place *= 10
+    return number
+
+#
+# Returns the largest allowed answer less or equal to answer, the same as
+# AnswerIndex(min_answer, max_answer, max_answer_digit).floor(answer), but
+# without building the index (None if there is none).
+#
+def floor_allowed_answer(answer, min_answer, max_answer, max_answer_digit = 8):
+    answer = min(answer, max_answer)
+    if 0 < max_answer_digit < 9:
+        if answer >= 0:
+            answer = _floor_with_digits_up_to(answer, max_answer_digit)
+        else:
+            answer = -1 * _ceil_with_digits_up_to(-1 * answer, max_answer_digit)
+    return answer if answer >= min_answer else None
+
+#
+# Index of all the answers in range [min_answer, max_answer] whose digits are
+# all less or equal to max_answer_digit (0 - any digits allowed). Negative
+# answers are checked by their absolute value.
+#
+# Checking whether an answer is allowed and finding the nearest allowed answer
+# are worked out from the digits of the answer, so the answers never have to be
+# listed, however wide the range. The sorted list (a range without a digit limit)
+# is only made if answers is asked for. Use get_answer_index() to share indexes.
+#
+class AnswerIndex:
+    def __init__(self, min_answer, max_answer, max_answer_digit = 8):
+        self.min_answer = min_answer
+        self.max_answer = max_answer
+        self.max_answer_digit = max_answer_digit
+        self.limited = 0 < max_answer_digit < 9
+        # sorted allowed answers, made when first needed
+        self._answers = None
+
+    @property
+    def answers(self):
+        if self._answers is None:
+            if not self.limited:
+                self._answers = range(self.min_answer, self.max_answer + 1)
+            else:
+                answers = []
+                if self.min_answer < 0:
+                    answers = [-1 * a for a in reversed(_numbers_with_digits_up_to(-1 * self.min_answer, self.max_answer_digit))
+                               if 0 < a and -1 * a <= self.max_answer]
+                answers += [a for a in _numbers_with_digits_up_to(self.max_answer, self.max_answer_digit) if a >= self.min_answer]
+                self._answers = answers
+        return self._answers
+
+    def __contains__(self, answer):
+        if answer < self.min_answer or answer > self.max_answer:
+            return False
+        if self.limited:
+            answer = abs(answer)
+            while answer > 0:
+                (answer, digit) = divmod(answer, 10)
+                if digit > self.max_answer_digit:
+                    return False
+        return True
+
+    def __iter__(self):
+        return iter(self.answers)
+
+    def __len__(self):
+        return len(self.answers)
+
+    # The largest allowed answer less or equal to answer (None if there is none).
+    def floor(self, answer):
+        return floor_allowed_answer(answer, self.min_answer, self.max_answer, self.max_answer_digit)
+
+    # The smallest allowed answer greater or equal to answer (None if there is none).
+    def ceil(self, answer):
+        answer = max(answer, self.min_answer)
+        if self.limited:
+            if answer >= 0:
+                answer = _ceil_with_digits_up_to(answer, self.max_answer_digit)
+            else:
+                answer = -1 * _floor_with_digits_up_to(-1 * answer, self.max_answer_digit)
+        return answer if answer <= self.max_answer else None
+
+    # The allowed answer closest to answer, the smaller one if there are two.
+    def nearest(self, answer):
+        below = self.floor(answer)
+        above = self.ceil(answer)
+        if below is None or (above is not None and above - answer < answer - below):
+            return above
+        return below
+
+@lru_cache(maxsize=64)
+def get_answer_index(min_answer, max_answer, max_answer_digit = 8):
+    return AnswerIndex(min_answer, max_answer, max_answer_digit)
+
+#
+# Turns a sorted list of numbers into a list of (first, last) tuples of its
+# consecutive runs, e.g. [-2, -1, 1, 2, 3] -> [(-2, -1), (1, 3)].
+#
+def _to_intervals(values):
+    intervals = []
+    for value in values:
+        if intervals and intervals[-1][1] == value - 1:
+            intervals[-1] = (intervals[-1][0], value)
+        else:
+            intervals.append((value, value))
+    return intervals
+
+#
+# Samples rows of numbers from all the rows that satisfy the rules instead of
+# generating a row and repairing it afterwards.
+#
+# For every position in the row and every running sum before that position we
+# count (going from the end of the row backwards) in how many ways the row can
+# still be finished so that the answer is one of allowed_answers. A row is then
+# drawn number by number, picking each number with a weight equal to the count
+# of valid ways to finish the row after it. Every row drawn like that is valid
+# and all the valid rows are equally likely. The counting is done once, drawing
+# a row afterwards only costs a few lookups per number.
+#
+# domains : list of sorted lists, the numbers allowed at each position of the row
+# allowed_answers : the answers that the whole row is allowed to add up to
+# allowed_running_totals : the sums every part of the row from its start is
+#                          allowed to add up to (None for any)
+#
+class RowSampler:
+    def __init__(self, domains, allowed_answers, allowed_running_totals = None):
+        self.domains = [list(domain) for domain in domains]
+        self.intervals = [_to_intervals(domain) for domain in self.domains]
+        # numpy tables for sample_rows_batch and unrank_rows_batch, built when
+        # first needed
+        self.batch_tables = None
+        self.rank_tables = None
+
+        # lowest and highest running sum possible before each position
+        self.low = [0]
+        self.high = [0]
+        for domain in self.domains:
+            self.low.append(self.low[-1] + domain[0])
+            self.high.append(self.high[-1] + domain[-1])
+
+        # counts[i][s - low[i]] : in how many ways we can finish the row from
+        # position i if the numbers before it add up to s. prefix[i] holds the
+        # running totals of counts[i], so that a sum over a range of them is
+        # just a difference of two values.
+        row_len = len(self.domains)
+        if not isinstance(allowed_answers, AnswerIndex):
+            allowed_answers = set(allowed_answers)
+        self.counts = [None] * (row_len + 1)
+        self.prefix = [None] * (row_len + 1)
+        self.counts[row_len] = [1 if s in allowed_answers else 0 for s in range(self.low[row_len], self.high[row_len] + 1)]
+        for i in reversed(range(row_len)):
+            self.prefix[i + 1] = _prefix_sums(self.counts[i + 1])
+            next_prefix = self.prefix[i + 1]
+            next_low = self.low[i + 1]
+            counts = []
+            for s in range(self.low[i], self.high[i] + 1):
+                total = 0
+                for (first, last) in self.intervals[i]:
+                    total += next_prefix[s + last - next_low + 1] - next_prefix[s + first - next_low]
+                counts.append(total)
+            self.counts[i] = _drop_running_totals(counts, self.low[i], i, allowed_running_totals)
+
+        # how many different valid rows there are
+        self.total = self.counts[0][0]
+
+    #
+    # Draws one valid row.
+    #
+    # rng : anything with a randrange() method (the random module by default)
+    #
+    def sample(self, rng = r):
+        if self.total == 0:
+            raise ValueError("No row of numbers satisfies the given parameters.")
+
+        numbers = []
+        cur_sum = 0
+        for i in range(len(self.domains)):
+            choice = rng.randrange(self.counts[i][cur_sum - self.low[i]])
+            numbers.append(self._pick(i, cur_sum, choice))
+            cur_sum += numbers[-1]
+        return numbers
+
+    # The first numbers of the valid rows, in increasing order.
+    def first_numbers(self):
+        return [value for value in self.domains[0] if self.counts[1][value - self.low[1]] > 0]
+
+    # The answers that the valid rows add up to, in increasing order. Bit k of
+    # reachable is set if the running sum low[i] + k can be reached with the
+    # numbers before position i and the row can still be finished from it.
+    def answers(self):
+        reachable = 1 if self.total > 0 else 0
+        for i in range(len(self.domains)):
+            spread = 0
+            for (first, last) in self.intervals[i]:
+                # a run of numbers spreads the bits over a run of sums, done
+                # by doubling the width of the spread
+                (run, width) = (reachable, 1)
+                while width < last - first + 1:
+                    step = min(width, last - first + 1 - width)
+                    run |= run << step
+                    width += step
+                spread |= run << (first - self.domains[i][0])
+            reachable = spread & _count_bits(self.counts[i + 1])
+        return [self.low[-1] + k for k in range(reachable.bit_length()) if (reachable >> k) & 1]
+
+    # Finds the number at position i that the choice-th way of finishing the
+    # row (out of all the ways from running sum cur_sum) starts with.
+    def _pick(self, i, cur_sum, choice):
+        next_prefix = self.prefix[i + 1]
+        base = cur_sum - self.low[i + 1]
+        for (first, last) in self.intervals[i]:
+            weight = next_prefix[base + last + 1] - next_prefix[base + first]
+            if choice < weight:
+                pos = bisect_right(next_prefix, next_prefix[base + first] + choice, base + first + 1, base + last + 2)
+                return pos - 1 - base
+            choice -= weight
+
+#
+# Like RowSampler, but every row also has to use the given abacus formula
+# (see abacus_formulas) in at least times of its steps, and in each of the
+# steps at_steps. The state of a partly drawn row is its running sum together
+# with how many times the formula was used so far (counted up to times), so
+# the counting is over (running sum, count) pairs instead of running sums.
+#
+# domains, allowed_answers : as in RowSampler
+# formula : name of the formula, one of abacus_formulas.FORMULAS
+# times : in how many steps at least the formula must be used
+# at_steps : positions of the row whose steps must use the formula
+# allowed_running_totals : as in RowSampler
+#
+class FormulaRowSampler:
+    def __init__(self, domains, allowed_answers, formula, times = 1, at_steps = (), allowed_running_totals = None):
+        self.domains = [list(domain) for domain in domains]
+        self.formula = formula
+        self.times = times
+        self.at_steps = frozenset(at_steps)
+        # numpy tables for sample_rows_batch and unrank_rows_batch, built when
+        # first needed
+        self.batch_tables = None
+        self.rank_tables = None
+
+        self.low = [0]
+        self.high = [0]
+        for domain in self.domains:
+            self.low.append(self.low[-1] + domain[0])
+            self.high.append(self.high[-1] + domain[-1])
+
+        # hits[i][s - low[i]][j] : does adding domains[i][j] to the running sum
+        # s use the formula. Setting the first number is not a step.
+        bit = FORMULA_BITS[formula]
+        self.hits = [[[i > 0 and (step_formulas(s, value) & bit) != 0 for value in self.domains[i]]
+                      for s in range(self.low[i], self.high[i] + 1)]
+                     for i in range(len(self.domains))]
+
+        # counts[i][s - low[i]][used] : in how many ways we can finish the row
+        # from position i if the numbers before it add up to s and used the
+        # formula used times
+        row_len = len(self.domains)
+        if not isinstance(allowed_answers, AnswerIndex):
+            allowed_answers = set(allowed_answers)
+        self.counts = [None] * (row_len + 1)
+        self.counts[row_len] = [[1 if used == times and s in allowed_answers else 0 for used in range(times + 1)]
+                                for s in range(self.low[row_len], self.high[row_len] + 1)]
+        for i in reversed(range(row_len)):
+            next_counts = self.counts[i + 1]
+            next_low = self.low[i + 1]
+            counts = []
+            for s in range(self.low[i], self.high[i] + 1):
+                hits = self.hits[i][s - self.low[i]]
+                by_used = []
+                for used in range(times + 1):
+                    total = 0
+                    for (value, hit) in zip(self.domains[i], hits):
+                        if hit or i not in self.at_steps:
+                            total += next_counts[s + value - next_low][min(used + hit, times)]
+                    by_used.append(total)
+                counts.append(by_used)
+            self.counts[i] = _drop_running_totals(counts, self.low[i], i, allowed_running_totals, [0] * (times + 1))
+
+        # how many different valid rows there are
+        self.total = self.counts[0][0][0]
+
+    #
+    # Draws one valid row.
+    #
+    # rng : anything with a randrange() method (the random module by default)
+    #
+    def sample(self, rng = r):
+        if self.total == 0:
+            raise ValueError("No row of numbers satisfies the given parameters.")
+
+        numbers = []
+        cur_sum = 0
+        used = 0
+        for i in range(len(self.domains)):
+            choice = rng.randrange(self.counts[i][cur_sum - self.low[i]][used])
+            next_counts = self.counts[i + 1]
+            for (value, hit) in zip(self.domains[i], self.hits[i][cur_sum - self.low[i]]):
+                if not hit and i in self.at_steps:
+                    continue
+                next_used = min(used + hit, self.times)
+                weight = next_counts[cur_sum + value - self.low[i + 1]][next_used]
+                if choice < weight:
+                    break
+                choice -= weight
+            numbers.append(value)
+            cur_sum += value
+            used = next_used
+        return numbers
+
+    # The first numbers of the valid rows, in increasing order.
+    def first_numbers(self):
+        return [value for value in self.domains[0] if self.counts[1][value - self.low[1]][0] > 0]
+
+    # The answers that the valid rows add up to, in increasing order, found by
+    # following the (running sum, count) pairs that valid rows go through.
+    def answers(self):
+        states = {(0, 0)} if self.total > 0 else set()
+        for i in range(len(self.domains)):
+            next_states = set()
+            for (cur_sum, used) in states:
+                for (value, hit) in zip(self.domains[i], self.hits[i][cur_sum - self.low[i]]):
+                    if not hit and i in self.at_steps:
+                        continue
+                    state = (cur_sum + value, min(used + hit, self.times))
+                    if self.counts[i + 1][state[0] - self.low[i + 1]][state[1]] > 0:
+                        next_states.add(state)
+            states = next_states
+        return sorted(set(cur_sum for (cur_sum, used) in states))
+
+#
+# Takes out of counts (one per running sum from low on) the running sums that
+# are not allowed before position i. Before position 0 nothing has been added
+# yet, so nothing is taken out there.
+#
+def _drop_running_totals(counts, low, i, allowed_running_totals, zero = 0):
+    if allowed_running_totals is None or i == 0:
+        return counts
+    return [count if s in allowed_running_totals else zero for (s, count) in enumerate(counts, low)]
+
+# The counts as bits of an int, bit k set if counts[k] is not 0.
+def _count_bits(counts):
+    return int('0' + ''.join('1' if count else '0' for count in reversed(counts)), 2)
+
+def _prefix_sums(values):
+    prefix = [0]
+    for value in values:
+        prefix.append(prefix[-1] + value)
+    return prefix
+
+# Largest amount of work (about one step per running sum and number, see
+# estimate_sampler_work) that building the tables of a sampler may take, a few
+# seconds at most. Specs that would need more are refused instead of keeping a
+# worker busy for minutes.
+MAX_SAMPLER_WORK = 10 ** 7
+
+# What one running sum and number cost a FormulaRowSampler, in the steps of
+# MAX_SAMPLER_WORK: looking up the formulas of the step (step_formulas) plus
+# FORMULA_COUNT_WORK for each formula count it is added up for. Both are
+# measured against the RowSampler, which sums up whole runs of numbers at once.
+FORMULA_STEP_WORK = 14
+FORMULA_COUNT_WORK = 2
+
+#
+# Returns the RowSampler for the given ExerciseSpec (a FormulaRowSampler if the
+# spec drills a formula). Samplers are cached, so a
+# run generating many exercises with the same spec builds the tables only once.
+#
+# Raises InfeasibleSpecError (with the FeasibilityReport of the spec) if no row
+# satisfies the spec or its tables would be too big to build.
+#
+@lru_cache(maxsize=64)
+def get_row_sampler(spec):
+    work = estimate_sampler_work(spec)
+    if work > MAX_SAMPLER_WORK:
+        stats.count('too_large_specs')
+        raise InfeasibleSpecError(FeasibilityReport(spec, None, reasons = (_too_much_work_reason(work),)))
+    reasons = _empty_domain_reasons(spec)
+    if reasons:
+        stats.count('infeasible_specs')
+        raise InfeasibleSpecError(FeasibilityReport(spec, 0, reasons = tuple(reasons)))
+    with stats.timer('build_sampler'):
+        sampler = _build_row_sampler(spec)
+    stats.count('samplers_built')
+    stats.count('sampler_work', work)
+    if sampler.total == 0:
+        stats.count('infeasible_specs')
+        raise InfeasibleSpecError(FeasibilityReport(spec, 0, reasons = tuple(_infeasibility_reasons(spec, sampler))))
+    return sampler
+
+def _build_row_sampler(spec):
+    (first_domain, term_domain) = _spec_domains(spec)
+    domains = []
+    if spec.term_count > 0:
+        domains = [first_domain] + [term_domain] * (spec.term_count - 1)
+    domains += [[number] for number in spec.buffer_prefill]
+
+    allowed_running_totals = spec.answer_index if spec.check_running_totals else None
+    if spec.formula:
+        return FormulaRowSampler(domains, spec.answer_index, spec.formula, spec.formula_count, spec.formula_steps, allowed_running_totals)
+    return RowSampler(domains, spec.answer_index, allowed_running_totals)
+
+# The numbers allowed first and at the other generated positions of the row.
+def _spec_domains(spec):
+    positive_terms = list(range(1, spec.max_number + 1))
+    if spec.use_negative:
+        term_domain = list(range(-1 * spec.max_number, 0)) + positive_terms
+    else:
+        term_domain = positive_terms
+
+    # the first number must be positive and, if asked for, a multi-digit number
+    first_domain = positive_terms
+    if spec.has_multi_digit_first_number():
+        first_index = count_multi_digit_numbers_up_to(spec.first_number_lower_bound - 1, spec.first_number_digit_count, spec.max_digit_in_multi_digit_number)
+        count = count_multi_digit_numbers_in_range(spec.first_number_digit_count, spec.max_digit_in_multi_digit_number,
+                                                   spec.first_number_lower_bound, spec.first_number_upper_bound)
+        first_domain = [nth_multi_digit_number(index, spec.first_number_digit_count, spec.max_digit_in_multi_digit_number)
+                        for index in range(first_index, first_index + count)]
+    return (first_domain, term_domain)
+
+# Works out which positions of the row have no number allowed at all (e.g.
+# max_number = 0), so that there is nothing to build a sampler from.
+def _empty_domain_reasons(spec):
+    if spec.term_count == 0:
+        return []
+    (first_domain, term_domain) = _spec_domains(spec)
+    reasons = []
+    if not first_domain:
+        reasons.append("no allowed first number values (max_number " + str(spec.max_number) + ")")
+    if spec.term_count > 1 and not term_domain:
+        reasons.append("no allowed term values (max_number " + str(spec.max_number) + ")")
+    return reasons
+
+#
+# Works out, from the parameters alone and without building anything, about
+# how many steps building the sampler tables of spec takes: for every position
+# of the row, the number of running sums before it times the number of ways it
+# is filled in (runs of numbers for a RowSampler, which sums them up at once,
+# numbers and formula counts for a FormulaRowSampler, weighted by
+# FORMULA_STEP_WORK and FORMULA_COUNT_WORK).
+# The batch tables (see abacus_batch) take about as much as the sampler's
+# own, so this bounds them too.
+#
+def estimate_sampler_work(spec):
+    term_size = 2 * spec.max_number if spec.use_negative else spec.max_number
+    term_low = -1 * spec.max_number if spec.use_negative else 1
+    first = (1, spec.max_number, spec.max_number)
+    if spec.has_multi_digit_first_number():
+        first = (spec.first_number_lower_bound, spec.first_number_upper_bound,
+                 count_multi_digit_numbers_in_range(spec.first_number_digit_count, spec.max_digit_in_multi_digit_number,
+                                                    spec.first_number_lower_bound, spec.first_number_upper_bound))
+    positions = []
+    if spec.term_count > 0:
+        positions = [first] + [(term_low, spec.max_number, term_size)] * (spec.term_count - 1)
+    positions += [(number, number, 1) for number in spec.buffer_prefill]
+
+    (low, high) = (0, 0)
+    work = 0
+    for (first_value, last_value, size) in positions:
+        if spec.formula:
+            work += (high - low + 1) * size * (FORMULA_STEP_WORK + FORMULA_COUNT_WORK * (spec.formula_count + 1))
+        else:
+            work += (high - low + 1) * (2 if size > 1 else 1) + size
+        low += first_value
+        high += last_value
+    return work + high - low + 1
+
+def _too_much_work_reason(work):
+    return ("building the tables for these parameters would take about " + str(work) + " steps, more than MAX_SAMPLER_WORK = " +
+            str(MAX_SAMPLER_WORK) + " (lower max_number, max_sum or how_many_numbers)")
+
+#
+# What a spec allows, worked out once before generating anything.
+#
+# spec : the ExerciseSpec
+# row_count : how many different valid rows there are (None if the spec is too
+#             big to count them)
+# min_answer, max_answer : lowest and highest answer of a valid row
+# min_first_number, max_first_number : same for the first number
+# reasons : why no exercise can be generated (empty if some can)
+# notes : parameters that were changed to make them sane, or can't be kept
+#
+@dataclass(frozen=True)
+class FeasibilityReport:
+    spec: ExerciseSpec
+    row_count: int = 0
+    min_answer: int = None
+    max_answer: int = None
+    min_first_number: int = None
+    max_first_number: int = None
+    reasons: tuple = ()
+    notes: tuple = ()
+
+    @property
+    def feasible(self):
+        return not self.reasons
+
+#
+# Raised when no exercise can be generated for a spec (or not as many
+# different ones as asked for, see gen_unique_rows). The FeasibilityReport is
+# in report, what is wrong in reasons.
+#
+class InfeasibleSpecError(ValueError):
+    def __init__(self, report):
+        self.report = report
+        self.spec = report.spec
+        self.reasons = report.reasons
+        if report.row_count == 0:
+            message = "No row of numbers satisfies the given parameters: "
+        else:
+            message = "The given parameters can't be used: "
+        super().__init__(message + "; ".join(report.reasons) + ".")
+
+#
+# Works out whether any exercise can be generated for the given ExerciseSpec
+# and the tightest bounds of the exercises that can. Counting the valid rows
+# uses the tables of the spec's sampler, so they are built (and cached) here
+# once, and generating afterwards costs nothing extra.
+#
+# Returns a FeasibilityReport, see check_feasibility for one that raises.
+#
+@stats.timed('analyze_spec')
+def analyze_spec(spec):
+    try:
+        sampler = get_row_sampler(spec)
+    except InfeasibleSpecError as e:
+        return replace(e.report, notes = tuple(_spec_notes(spec)))
+    answers = sampler.answers()
+    first_numbers = sampler.first_numbers()
+    return FeasibilityReport(spec, sampler.total, answers[0], answers[-1], first_numbers[0], first_numbers[-1],
+                             notes = tuple(_spec_notes(spec)))
+
+#
+# Like analyze_spec, but raises InfeasibleSpecError straight away if no
+# exercise can be generated for spec. Meant to be called before generating.
+#
+def check_feasibility(spec):
+    report = analyze_spec(spec)
+    if not report.feasible:
+        raise InfeasibleSpecError(report)
+    return report
+
+# Works out which of the rules of spec can't be met (its sampler has no rows).
+def _infeasibility_reasons(spec, sampler):
+    (low, high) = (sampler.low[-1], sampler.high[-1])
+    if low > spec.max_sum:
+        return ["the smallest numbers allowed add up to " + str(low) + ", more than max_sum " + str(spec.max_sum)]
+    if high < spec.min_answer:
+        return ["the largest numbers allowed add up to " + str(high) + ", less than the lowest answer " + str(spec.min_answer)]
+    answer = spec.answer_index.ceil(low)
+    if answer is None or answer > high:
+        return ["no answer from " + str(low) + " to " + str(high) + " has all its digits up to max_answer_digit " +
+                str(spec.max_answer_digit)]
+
+    if ((not spec.formula and not spec.check_running_totals) or
+        _build_row_sampler(replace(spec, formula = '', check_running_totals = False)).total == 0):
+        return ["no row of these numbers adds up to an allowed answer"]
+
+    reasons = []
+    drill = "no row uses " + spec.formula + " " + str(spec.formula_count) + " time(s)"
+    if spec.formula_steps:
+        drill += " and at steps " + ", ".join(str(step) for step in spec.formula_steps)
+    if spec.formula and _build_row_sampler(replace(spec, check_running_totals = False)).total == 0:
+        if spec.formula.startswith('-') and not spec.use_negative:
+            drill += " (the formula subtracts, so use_negative is needed)"
+        reasons.append(drill)
+    if spec.check_running_totals and _build_row_sampler(replace(spec, formula = '')).total == 0:
+        reasons.append("the running totals can't all keep to the rules of the answer")
+    if not reasons:
+        reasons.append(drill + " while keeping the running totals to the rules of the answer")
+    return reasons
+
+# Parameters of spec that were changed or can't be kept (see ExerciseSpec).
+def _spec_notes(spec):
+    notes = []
+    if spec.first_number_digit_count > 0 and not spec.has_multi_digit_first_number():
+        notes.append("no " + str(spec.first_number_digit_count) + "-digit first number with digits up to " +
+                     str(spec.max_digit_in_multi_digit_number) + " leaves room for the other numbers, "
+                     "the first number is any number up to max_number")
+    return notes
+
+#
+# Returns the 64-bit key of the random streams of a run with the given seed and
+# ExerciseSpec. It is made from the text of both, so it is the same in every
+# process and every session (unlike hash()).
+#
+def stream_key(seed, spec):
+    text = str(seed) + ':' + repr(spec)
+    # parameters left out of repr only count once they are set, so that specs
+    # that don't use them keep their streams
+    for f in fields(spec):
+        if f.init and not f.repr and getattr(spec, f.name) != f.default:
+            text += ':' + f.name + '=' + str(getattr(spec, f.name))
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+#
+# Returns a root seed for a run, a random one if seed is None.
+#
+def make_seed(seed = None):
+    if seed is None:
+        return r.SystemRandom().getrandbits(128)
+    return seed
@@ -0,0 +1,191 @@
+#
+# Writers for generated exercises: Excel workbooks (wide, long and streaming)
+# and plain csv / json files. pandas and xlsxwriter are only imported by the
+# functions that need them, so the csv and json writers work without either.
+#
+
+import csv
+import json
+
+import abacus_stats as stats
+
+#
+# Writes exercises to an Excel workbook while they are being generated instead
+# of collecting them all first. Uses xlsxwriter's constant_memory mode, which
+# flushes every finished row to disk, so memory use stays the same however many
+# exercises there are. Because rows have to be written in order, each exercise
+# is a row here ("Exercise N" followed by its numbers) and its answer is the
+# same row in the Answers sheet.
+#
+# rows : iterable of rows of numbers
+# output_path : where to write the workbook
+#
+# Returns how many exercises were written.
+#
+@stats.timed('write_streaming_workbook')
+def write_exercises_streaming(rows, output_path = 'res.xlsx'):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+    ex_worksheet = workbook.add_worksheet('Exercises')
+    ans_worksheet = workbook.add_worksheet('Answers')
+
+    # Add a header format.
+    header_format = workbook.add_format({
+        'bold': True,
+        'text_wrap': True,
+        'valign': 'top',
+        'fg_color': '#D7E4BC',
+        'border': 1})
+
+    exercise_count = 0
+    for numbers in rows:
+        if exercise_count == 0:
+            # one format for the whole column range instead of one call per column
+            ex_worksheet.set_column(0, len(numbers), 12)
+            ans_worksheet.set_column(0, 1, 12)
+            ex_worksheet.write_row(0, 0, ['Exercise'] + ['Number ' + str(cnt + 1) for cnt in range(len(numbers))], header_format)
+            ans_worksheet.write_row(0, 0, ['Exercise', 'Answer'], header_format)
+
+        exercise_count += 1
+        name = 'Exercise ' + str(exercise_count)
+        ex_worksheet.write_string(exercise_count, 0, name)
+        ex_worksheet.write_row(exercise_count, 1, numbers)
+        ans_worksheet.write_string(exercise_count, 0, name)
+        ans_worksheet.write_number(exercise_count, 1, sum(numbers))
+
+    workbook.close()
+    return exercise_count
+
+# A sheet can have at most 16384 columns, so that is the most exercises that
+# fit the wide layout.
+MAX_WIDE_EXERCISES = 16384
+
+#
+# Puts exercises into the long (tidy) layout: one row per exercise with columns
+# term_1 .. term_k and answer. The table is filled in as one preallocated
+# integer array, so building it costs about the same as copying the rows.
+#
+# rows : numpy array of shape [number of exercises, k]
+#
+@stats.timed('build_long_frame')
+def exercises_to_long_frame(rows):
+    import numpy as np
+    import pandas as pd
+
+    rows = np.asarray(rows, dtype=np.int64)
+    (exercise_count, term_count) = rows.shape
+    table = np.empty((exercise_count, term_count + 1), dtype=np.int64)
+    table[:, :term_count] = rows
+    table[:, term_count] = rows.sum(axis=1)
+    columns = ['term_' + str(cnt + 1) for cnt in range(term_count)] + ['answer']
+    index = pd.RangeIndex(1, exercise_count + 1, name='exercise')
+    return pd.DataFrame(table, columns=columns, index=index)
+
+#
+# Derives the wide printable layout (one column per exercise, 'Exercise 1' ..
+# 'Exercise N') from the long layout. Returns a tuple of the exercises frame
+# and the answers frame.
+#
+@stats.timed('build_wide_frames')
+def long_to_wide_frames(long_df):
+    import pandas as pd
+
+    column_names = ['Exercise ' + str(i) for i in long_df.index]
+    ex_df = pd.DataFrame(long_df.drop(columns='answer').values.T, columns=column_names)
+    ans_df = pd.DataFrame(long_df[['answer']].values.T, columns=column_names)
+    return (ex_df, ans_df)
+
+#
+# Writes the long layout into one 'Exercises' sheet with a header row.
+#
+@stats.timed('write_long_workbook')
+def write_long_workbook(long_df, output_path = 'res.xlsx'):
+    import pandas as pd
+
+    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+        long_df.to_excel(writer, sheet_name='Exercises')
+        writer.sheets['Exercises'].set_column(0, len(long_df.columns), 12)
+
+#
+# Writes the wide layout: exercises one per column in the 'Exercises' sheet,
+# their answers in the 'Answers' sheet.
+#
+@stats.timed('write_wide_workbook')
+def write_wide_workbook(ex_df, ans_df, output_path = 'res.xlsx'):
+    import pandas as pd
+
+    #df.to_csv("res.csv")
+    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+        # Turn off the default header and skip one row to allow us to insert a
+        # user defined header.
+        ex_df.to_excel(writer, sheet_name='Exercises', startrow=1, header=False, index=False)
+        ans_df.to_excel(writer, sheet_name='Answers', index=False)
+
+        # Get the xlsxwriter workbook and worksheet objects.
+        workbook  = writer.book
+        ex_worksheet = writer.sheets['Exercises']
+        ans_worksheet = writer.sheets['Answers']
+        
+        # Add a header format.
+        header_format = workbook.add_format({
+            'bold': True,
+            'text_wrap': True,
+            'valign': 'top',
+            'fg_color': '#D7E4BC',
+            'border': 1})
+        
+        idx = 0
+        # Write the column headers with the defined format.
+        for col_num, value in enumerate(ex_df.columns.values):
+            ex_worksheet.write(0, col_num, value, header_format)
+            ex_worksheet.set_column(idx, idx, 12)
+            ans_worksheet.set_column(idx, idx, 12)
+            idx += 1
+        # the workbook is saved when the with block closes the writer
+        
+        #print(writer.sheets['Exercises'].column_dimensions.)
+        
+        #for ndx in range(len(col_names)):
+        #    writer.sheets['Exercises'].column_dimensions[col_names[ndx]].width = 15
+
+#
+# Writes exercises as csv in the long layout: a header row 'exercise',
+# 'term_1' .. 'term_k', 'answer' and then one line per exercise. Rows are
+# written as they come, so rows can be a generator.
+#
+# Returns how many exercises were written.
+#
+@stats.timed('write_csv')
+def write_exercises_csv(rows, output_path = 'res.csv'):
+    exercise_count = 0
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for numbers in rows:
+            numbers = [int(n) for n in numbers]
+            if exercise_count == 0:
+                writer.writerow(['exercise'] + ['term_' + str(cnt + 1) for cnt in range(len(numbers))] + ['answer'])
+            exercise_count += 1
+            writer.writerow([exercise_count] + numbers + [sum(numbers)])
+    return exercise_count
+
+#
+# Writes exercises as a json list of {"numbers": [...], "answer": ...}
+# objects, the same shape as the exercises the worksheet service returns.
+# Rows are written as they come, so rows can be a generator.
+#
+# Returns how many exercises were written.
+#
+@stats.timed('write_json')
+def write_exercises_json(rows, output_path = 'res.json'):
+    exercise_count = 0
+    with open(output_path, 'w') as f:
+        f.write('[')
+        for numbers in rows:
+            numbers = [int(n) for n in numbers]
+            if exercise_count > 0:
+                f.write(',\n')
+            f.write(json.dumps({'numbers': numbers, 'answer': sum(numbers)}))
+            exercise_count += 1
+        f.write(']\n')
+    return exercise_count
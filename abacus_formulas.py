@@ -0,0 +1,282 @@
+#
+# Abacus (soroban) formulas: which bead rule a child needs for each step of an
+# exercise. A rod shows a digit with one heaven bead (5) and four earth beads
+# (1 each). Adding or subtracting a digit on a rod is either
+#
+#   direct       : the beads can just be moved, e.g. 2 + 2
+#   small_friend : the 5-complement, e.g. 2 + 4 done as +5 - 1
+#   big_friend   : the 10-complement, e.g. 7 + 4 done as +10 - 6
+#   mixed        : the 10-complement where the rest needs the 5-complement,
+#                  e.g. 5 + 6 done as +10 - 5 + 1
+#
+# Every rule other than direct has a name (see FORMULAS) and a bit in a formula
+# mask, so the rules used by an exercise fit in one integer.
+#
+
+from functools import lru_cache
+
+DIRECT = 'direct'
+SMALL_FRIEND = 'small_friend'
+BIG_FRIEND = 'big_friend'
+MIXED = 'mixed'
+# the kinds of steps from the easiest to the hardest
+KINDS = [DIRECT, SMALL_FRIEND, BIG_FRIEND, MIXED]
+
+#
+# Returns the name of the rule for adding (or subtracting) digit with the
+# given kind of step, e.g. '+4 = +5 - 1' or '-7 = -10 + 3'. None for direct.
+#
+def formula_name(kind, digit, subtract = False):
+    (sign, back) = ('-', '+') if subtract else ('+', '-')
+    if kind == SMALL_FRIEND:
+        return sign + str(digit) + ' = ' + sign + '5 ' + back + ' ' + str(5 - digit)
+    if kind == BIG_FRIEND:
+        return sign + str(digit) + ' = ' + sign + '10 ' + back + ' ' + str(10 - digit)
+    if kind == MIXED:
+        return sign + str(digit) + ' = ' + sign + '10 ' + back + ' 5 ' + sign + ' ' + str(digit - 5)
+    return None
+
+# all the rules there are: the 5-complement only exists for digits 1 - 4 and
+# the mixed rule only for 6 - 9
+FORMULAS = [formula_name(kind, digit, subtract)
+            for subtract in (False, True)
+            for (kind, digits) in ((SMALL_FRIEND, range(1, 5)), (BIG_FRIEND, range(1, 10)), (MIXED, range(6, 10)))
+            for digit in digits]
+FORMULA_BITS = {name: 1 << bit for (bit, name) in enumerate(FORMULAS)}
+
+#
+# Returns the name in FORMULAS of the formula written as text, which may be
+# spaced differently, e.g. '+4=+5-1' gives '+4 = +5 - 1'. Raises ValueError
+# if there is no such formula.
+#
+def find_formula(text):
+    compact = ''.join(text.split())
+    for name in FORMULAS:
+        if ''.join(name.split()) == compact:
+            return name
+    raise ValueError("Unknown formula " + repr(text) + ", see abacus_formulas.FORMULAS.")
+
+# Can digit be added to a rod showing rod_digit by just moving beads?
+def _can_add_directly(rod_digit, digit):
+    (heaven, earth) = divmod(rod_digit, 5)
+    (digit_heaven, digit_earth) = divmod(digit, 5)
+    return (digit_heaven == 0 or heaven == 0) and earth + digit_earth <= 4
+
+# Can digit be taken from a rod showing rod_digit by just moving beads?
+def _can_subtract_directly(rod_digit, digit):
+    (heaven, earth) = divmod(rod_digit, 5)
+    (digit_heaven, digit_earth) = divmod(digit, 5)
+    return digit_heaven <= heaven and digit_earth <= earth
+
+#
+# Adds (or subtracts) one digit on one rod.
+#
+# rod_digit : what the rod shows, 0 - 9
+# digit : the digit to add or subtract, 1 - 9
+#
+# Returns (kind of step, new digit of the rod, carry), where carry is 1 if 1
+# has to be added to (or taken from) the next rod up.
+#
+def rod_step(rod_digit, digit, subtract = False):
+    if not subtract:
+        if rod_digit + digit <= 9:
+            return (DIRECT if _can_add_directly(rod_digit, digit) else SMALL_FRIEND, rod_digit + digit, 0)
+        return (BIG_FRIEND if _can_subtract_directly(rod_digit, 10 - digit) else MIXED, rod_digit + digit - 10, 1)
+
+    if rod_digit - digit >= 0:
+        return (DIRECT if _can_subtract_directly(rod_digit, digit) else SMALL_FRIEND, rod_digit - digit, 0)
+    return (BIG_FRIEND if _can_add_directly(rod_digit, 10 - digit) else MIXED, rod_digit - digit + 10, 1)
+
+#
+# Transition tables of one rod, worked out once with rod_step:
+# ROD_STEPS[subtract][rod digit][digit] is the (kind, new digit, carry) of the
+# step and ROD_STEP_BITS[subtract][rod digit][digit] its formula bit (0 for
+# direct steps). Digit 0 leaves the rod as it is, so that carries of 0 can go
+# through the same tables.
+#
+ROD_STEPS = [[[rod_step(rod_digit, digit, subtract) if digit > 0 else (DIRECT, rod_digit, 0) for digit in range(10)]
+              for rod_digit in range(10)]
+             for subtract in (False, True)]
+ROD_STEP_BITS = [[[FORMULA_BITS[formula_name(kind, digit, subtract)] if kind != DIRECT else 0
+                   for (digit, (kind, new_digit, carry)) in enumerate(ROD_STEPS[subtract][rod_digit])]
+                  for rod_digit in range(10)]
+                 for subtract in (False, True)]
+
+# mask of all the formulas of each kind of step
+KIND_BITS = {kind: sum(FORMULA_BITS[formula_name(kind, digit, subtract)]
+                       for subtract in (False, True) for digit in range(1, 10)
+                       if formula_name(kind, digit, subtract) in FORMULA_BITS)
+             for kind in KINDS}
+
+#
+# The beads of a soroban: each rod has one heaven bead (worth 5) and four
+# earth beads (worth 1), rods[0] is the ones rod. Numbers are added and
+# subtracted the way it is done by hand: rod by rod from the highest digit of
+# the number down, with carries going to the rods above. Carrying 1 into a rod
+# is a step of its own and can need a rule too.
+#
+# value : the number to start with (not negative)
+#
+class Soroban:
+    def __init__(self, value = 0):
+        if value < 0:
+            raise ValueError("An abacus can't show a negative number.")
+        self.rods = [int(d) for d in reversed(str(value))]
+
+    @property
+    def value(self):
+        return int(''.join(str(d) for d in reversed(self.rods)))
+
+    # (heaven bead down, earth beads up) of each rod, the highest rod first
+    def beads(self):
+        return [divmod(rod_digit, 5) for rod_digit in reversed(self.rods)]
+
+    #
+    # Adds number (subtracts it if it is negative). Returns the steps taken
+    # as a list of (rod, digit, kind) with rod 0 being the ones rod.
+    #
+    def add(self, number):
+        if self.value + number < 0:
+            raise ValueError("An abacus can't show a negative number.")
+        subtract = number < 0
+        digits = [int(d) for d in reversed(str(abs(number)))]
+        self.rods += [0] * (len(digits) + 1 - len(self.rods))
+
+        steps = []
+        for j in reversed(range(len(digits))):
+            if digits[j] == 0:
+                continue
+            (kind, self.rods[j], carry) = ROD_STEPS[subtract][self.rods[j]][digits[j]]
+            steps.append((j, digits[j], kind))
+            k = j + 1
+            while carry:
+                if k == len(self.rods):
+                    self.rods.append(0)
+                (kind, self.rods[k], carry) = ROD_STEPS[subtract][self.rods[k]][1]
+                steps.append((k, 1, kind))
+                k += 1
+
+        # no leading zero rods
+        while len(self.rods) > 1 and self.rods[-1] == 0:
+            self.rods.pop()
+        return steps
+
+#
+# Returns the formula mask of adding number to total on the abacus (see
+# Soroban.add). The abacus can't show negative numbers, so a step from or to
+# a negative total needs no rules.
+#
+@lru_cache(maxsize=65536)
+def step_formulas(total, number):
+    if total < 0 or total + number < 0 or number == 0:
+        return 0
+
+    subtract = number < 0
+    mask = 0
+    for (rod, digit, kind) in Soroban(total).add(number):
+        if kind != DIRECT:
+            mask |= FORMULA_BITS[formula_name(kind, digit, subtract)]
+    return mask
+
+#
+# Returns (formula mask, number of steps that need a rule) of an exercise.
+# The first number is just set on the abacus.
+#
+def row_formulas(numbers):
+    mask = 0
+    steps = 0
+    total = numbers[0] if len(numbers) > 0 else 0
+    for number in numbers[1:]:
+        step_mask = step_formulas(total, number)
+        mask |= step_mask
+        steps += step_mask != 0
+        total += number
+    return (mask, steps)
+
+# The names of the rules in a formula mask.
+def formula_names(mask):
+    return [name for name in FORMULAS if mask & FORMULA_BITS[name]]
+
+#
+# Vectorized step_formulas: the formula masks (uint64) of adding numbers[i]
+# to totals[i] for whole numpy arrays at once, by running the rod transition
+# tables over all the rows together.
+#
+# rods : how many rods to simulate, enough for the largest total by default
+#
+def step_formulas_batch(totals, numbers, rods = None):
+    import numpy as np
+
+    (new_digits, carries, step_bits) = _batch_tables()
+    totals = np.asarray(totals, dtype=np.int64)
+    numbers = np.asarray(numbers, dtype=np.int64)
+    valid = (totals >= 0) & (totals + numbers >= 0) & (numbers != 0)
+    if rods is None:
+        largest = int(max(np.abs(totals).max(initial=0), np.abs(totals + numbers).max(initial=0), np.abs(numbers).max(initial=0)))
+        rods = len(str(largest)) + 1
+
+    # index of each step into the flattened tables: subtract * 100 + rod digit * 10 + digit
+    subtract = np.where(numbers < 0, 100, 0)
+    rod_digits = [(np.maximum(totals, 0) // 10 ** k) % 10 for k in range(rods)]
+    digits = [(np.abs(numbers) // 10 ** k) % 10 for k in range(rods)]
+
+    masks = np.zeros(len(totals), dtype=np.uint64)
+    for j in reversed(range(rods)):
+        carry = digits[j]
+        for k in range(j, rods):
+            # digit 0 (no carry) leaves a rod as it is
+            index = subtract + rod_digits[k] * 10 + carry
+            masks |= step_bits[index]
+            rod_digits[k] = new_digits[index]
+            carry = carries[index]
+    masks[~valid] = 0
+    return masks
+
+# largest table of step masks row_formulas_batch works out in advance
+STEP_TABLE_MAX_SIZE = 1 << 20
+
+#
+# Vectorized row_formulas: returns (formula masks as uint64, rule steps as
+# int16) of every row of a numpy array of rows. The mask of a step only
+# depends on the total before it and the number, so when the totals and the
+# numbers are within small ranges (as in any bank of exercises for children)
+# the masks of all the steps there can be are worked out first and each step
+# is just looked up.
+#
+def row_formulas_batch(rows):
+    import numpy as np
+
+    rows = np.asarray(rows, dtype=np.int64)
+    masks = np.zeros(len(rows), dtype=np.uint64)
+    steps = np.zeros(len(rows), dtype=np.int16)
+    if rows.ndim != 2 or rows.shape[1] < 2 or len(rows) == 0:
+        return (masks, steps)
+
+    totals = np.cumsum(rows, axis=1)[:, :-1]
+    numbers = rows[:, 1:]
+    (total_low, total_high) = (int(totals.min()), int(totals.max()))
+    (number_low, number_high) = (int(numbers.min()), int(numbers.max()))
+    table_width = number_high - number_low + 1
+    if (total_high - total_low + 1) * table_width <= STEP_TABLE_MAX_SIZE:
+        table = step_formulas_batch(np.repeat(np.arange(total_low, total_high + 1), table_width),
+                                    np.tile(np.arange(number_low, number_high + 1), total_high - total_low + 1))
+        lookup = lambda j: table[(totals[:, j] - total_low) * table_width + (numbers[:, j] - number_low)]
+    else:
+        lookup = lambda j: step_formulas_batch(totals[:, j], numbers[:, j])
+
+    for j in range(numbers.shape[1]):
+        step_masks = lookup(j)
+        masks |= step_masks
+        steps += step_masks != 0
+    return (masks, steps)
+
+# ROD_STEPS and ROD_STEP_BITS as flat numpy arrays indexed by subtract * 100 +
+# rod digit * 10 + digit: the new digit, the carry and the formula bit of each step
+@lru_cache(maxsize=1)
+def _batch_tables():
+    import numpy as np
+
+    new_digits = np.array([[[new_digit for (kind, new_digit, carry) in by_digit] for by_digit in by_rod] for by_rod in ROD_STEPS], dtype=np.int64)
+    carries = np.array([[[carry for (kind, new_digit, carry) in by_digit] for by_digit in by_rod] for by_rod in ROD_STEPS], dtype=np.int64)
+    step_bits = np.array(ROD_STEP_BITS, dtype=np.uint64)
+    return (new_digits.ravel(), carries.ravel(), step_bits.ravel())
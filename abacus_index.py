@@ -0,0 +1,151 @@
+#
+# Secondary indexes over an exercise bank, to find the exercises that match a
+# query ("answer below 50, two-digit first number, uses +4 = +5 - 1") without
+# scanning the whole bank:
+#
+#   - the row ids sorted by answer and by first number, so a range of answers
+#     or first numbers is found with a binary search,
+#   - the row ids sorted by how many steps of the exercise need a rule
+#     (a measure of difficulty, see abacus_formulas.row_formulas),
+#   - for each formula, the sorted list of rows that use it.
+#
+# A query costs about as much as the number of rows matching its most
+# selective condition, not the size of the bank.
+#
+
+import numpy as np
+
+from abacus_formulas import FORMULAS, FORMULA_BITS, row_formulas_batch
+import abacus_stats as stats
+
+#
+# Works out the formula mask and the number of rule steps of every row.
+# Returns two arrays (masks as uint64, steps as int16).
+#
+@stats.timed('classify_rows')
+def classify_rows(rows):
+    return row_formulas_batch(rows)
+
+#
+# Indexes of one bank. Build one with BankIndex.build(bank), or load one that
+# was saved with save().
+#
+# masks, answers, first_numbers, steps : formula mask, answer, first number
+#                                       and rule steps of every row
+# answer_order, first_order, steps_order : row ids sorted by answer, first
+#                                          number and rule steps
+# sorted_answers, sorted_first_numbers, sorted_steps : the values in that order
+# formula_rows, formula_offsets : the rows using FORMULAS[i] are
+#                                 formula_rows[formula_offsets[i]:formula_offsets[i + 1]]
+#
+class BankIndex:
+    def __init__(self, masks, answers, first_numbers, steps, answer_order, sorted_answers, first_order,
+                 sorted_first_numbers, steps_order, sorted_steps, formula_rows, formula_offsets):
+        self.masks = masks
+        self.answers = answers
+        self.first_numbers = first_numbers
+        self.steps = steps
+        self.answer_order = answer_order
+        self.sorted_answers = sorted_answers
+        self.first_order = first_order
+        self.sorted_first_numbers = sorted_first_numbers
+        self.steps_order = steps_order
+        self.sorted_steps = sorted_steps
+        self.formula_rows = formula_rows
+        self.formula_offsets = formula_offsets
+
+    @classmethod
+    def build(cls, bank):
+        answers = np.array(bank.answers)
+        first_numbers = np.array(bank.rows[:, 0]) if bank.width > 0 else np.zeros(len(bank), dtype=np.int16)
+        (masks, steps) = classify_rows(bank.rows)
+
+        # int32 row ids are enough for banks of up to 2 ** 31 exercises
+        id_type = np.int32 if len(bank) < 2 ** 31 else np.int64
+        formula_lists = [np.flatnonzero(masks & np.uint64(FORMULA_BITS[name])).astype(id_type) for name in FORMULAS]
+        formula_offsets = np.concatenate([[0], np.cumsum([len(rows) for rows in formula_lists])]).astype(np.int64)
+
+        arrays = [masks, answers, first_numbers, steps]
+        for values in (answers, first_numbers, steps):
+            order = np.argsort(values, kind='stable').astype(id_type)
+            arrays += [order, values[order]]
+        return cls(*arrays, np.concatenate(formula_lists), formula_offsets)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **vars(self))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    # Rows using the formula with the given name, sorted.
+    def rows_with_formula(self, name):
+        if name not in FORMULA_BITS:
+            raise ValueError("Unknown formula " + repr(name) + ", see abacus_formulas.FORMULAS.")
+        i = FORMULAS.index(name)
+        return self.formula_rows[self.formula_offsets[i]:self.formula_offsets[i + 1]]
+
+    #
+    # Returns the ids of the rows (in increasing order) that match all of the
+    # given conditions. Bounds are inclusive and None means no bound.
+    #
+    # min_answer, max_answer : range of the answer
+    # min_first_number, max_first_number : range of the first number
+    # first_number_digit_count : how many digits the first number has
+    # min_steps, max_steps : how many steps need a rule
+    # formulas : names of formulas that must all be used (see FORMULAS)
+    # limit : return at most this many rows (the first ones)
+    #
+    def find(self,
+             min_answer = None,
+             max_answer = None,
+             min_first_number = None,
+             max_first_number = None,
+             first_number_digit_count = None,
+             min_steps = None,
+             max_steps = None,
+             formulas = (),
+             limit = None):
+        if first_number_digit_count is not None:
+            digit_low = 10 ** (first_number_digit_count - 1) if first_number_digit_count > 1 else 1
+            digit_high = 10 ** first_number_digit_count - 1
+            min_first_number = digit_low if min_first_number is None else max(min_first_number, digit_low)
+            max_first_number = digit_high if max_first_number is None else min(max_first_number, digit_high)
+
+        # each condition as (how many rows match it, its sorted rows, a test
+        # of given rows against it)
+        conditions = []
+        for name in formulas:
+            rows = self.rows_with_formula(name)
+            bit = np.uint64(FORMULA_BITS[name])
+            conditions.append((len(rows), lambda rows = rows: rows, lambda ids, bit = bit: (self.masks[ids] & bit) != 0))
+        for (values, sorted_values, order, low, high) in ((self.answers, self.sorted_answers, self.answer_order, min_answer, max_answer),
+                                                          (self.first_numbers, self.sorted_first_numbers, self.first_order, min_first_number, max_first_number),
+                                                          (self.steps, self.sorted_steps, self.steps_order, min_steps, max_steps)):
+            if low is None and high is None:
+                continue
+            start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+            stop = len(order) if high is None else np.searchsorted(sorted_values, high, side='right')
+            low = sorted_values[0] if low is None and len(order) > 0 else low
+            high = sorted_values[-1] if high is None and len(order) > 0 else high
+            conditions.append((stop - start,
+                               lambda order = order, start = start, stop = stop: np.sort(order[start:stop]),
+                               lambda ids, values = values, low = low, high = high: (values[ids] >= low) & (values[ids] <= high)))
+
+        if not conditions:
+            matches = np.arange(len(self))
+        else:
+            # only the rows of the most selective condition are looked at
+            conditions.sort(key=lambda condition: condition[0])
+            matches = conditions[0][1]()
+            for (count, rows, test) in conditions[1:]:
+                matches = matches[test(matches)]
+
+        if limit is not None:
+            matches = matches[:limit]
+        return np.asarray(matches, dtype=np.int64)
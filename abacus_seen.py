@@ -0,0 +1,133 @@
+#
+# Per-student "seen" filters: a Bloom filter of the exercises a student has
+# been given, kept in a small memory-mapped file, so that new worksheets can
+# leave out the exercises the student has done before. Each exercise costs a
+# few bits (about 14 for a false-positive rate of 0.1 %) whatever its numbers,
+# and looking exercises up or adding them only touches their own bits.
+#
+# A filter never forgets an exercise it was given, but it can take a new one
+# for a seen one (at most fp_rate of the time while it holds no more than
+# capacity exercises), so a few exercises that were never given are left out
+# as well.
+#
+# File layout (all little-endian):
+#   preamble : SEEN_MAGIC, version (uint16), number of hashes (uint16),
+#              0 (uint32), number of bits (uint64), capacity (uint64),
+#              exercises added (uint64), fp_rate (float64)
+#   padding  : zeroes up to SEEN_BITS_OFFSET
+#   bits     : the bits of the filter as uint64 words
+#
+
+import math as m
+import os
+import struct
+import numpy as np
+
+from abacus_batch import hash_rows, _mix64
+import abacus_stats as stats
+
+SEEN_MAGIC = b'ABACSEEN'
+SEEN_VERSION = 1
+SEEN_PREAMBLE = struct.Struct('<8sHHIQQQd')
+SEEN_BITS_OFFSET = 64
+
+# what the second hash of a row is mixed with (see SeenFilter._positions)
+SEEN_SALT = np.uint64(0x5EE5EE5EE5EE5EE5)
+
+#
+# Returns (number of bits, number of hashes) of a Bloom filter that holds
+# capacity exercises with the given false-positive rate. The bits are rounded
+# up to whole uint64 words.
+#
+def seen_filter_size(capacity = 100000, fp_rate = 0.001):
+    if capacity <= 0:
+        raise ValueError("capacity must be positive, not " + str(capacity) + ".")
+    if not 0 < fp_rate < 1:
+        raise ValueError("fp_rate must be between 0 and 1, not " + str(fp_rate) + ".")
+    bits = m.ceil(-capacity * m.log(fp_rate) / m.log(2) ** 2)
+    bits = max(64, -(-bits // 64) * 64)
+    hashes = max(1, round(bits / capacity * m.log(2)))
+    return (bits, hashes)
+
+#
+# A seen filter file, created if it doesn't exist yet. The bits are memory-
+# mapped, so opening a filter doesn't read it; changes get to the file on
+# flush() or close() (also at the end of a with block).
+#
+# path : the filter file, e.g. one per student
+# capacity, fp_rate : size of a new filter (see seen_filter_size); an existing
+#                     file keeps the ones it was created with
+#
+class SeenFilter:
+    def __init__(self, path, capacity = 100000, fp_rate = 0.001):
+        self.path = path
+        if not os.path.exists(path):
+            (bits, hashes) = seen_filter_size(capacity, fp_rate)
+            with open(path, 'wb') as f:
+                f.write(SEEN_PREAMBLE.pack(SEEN_MAGIC, SEEN_VERSION, hashes, 0, bits, capacity, 0, fp_rate))
+                f.truncate(SEEN_BITS_OFFSET + bits // 8)
+
+        with open(path, 'rb') as f:
+            preamble = f.read(SEEN_PREAMBLE.size)
+            file_size = f.seek(0, 2)
+        if len(preamble) < SEEN_PREAMBLE.size or preamble[:len(SEEN_MAGIC)] != SEEN_MAGIC:
+            raise ValueError(str(path) + " is not a seen filter.")
+        (magic, version, self.hashes, reserved, self.bits, self.capacity, self.added, self.fp_rate) = SEEN_PREAMBLE.unpack(preamble)
+        if version != SEEN_VERSION:
+            raise ValueError(str(path) + " is a version " + str(version) + " seen filter, only version " +
+                             str(SEEN_VERSION) + " can be read.")
+        if file_size < SEEN_BITS_OFFSET + self.bits // 8:
+            raise ValueError(str(path) + " is shorter than its " + str(self.bits) + " bits, it may not have been written completely.")
+        self.words = np.memmap(path, dtype='<u8', mode='r+', offset=SEEN_BITS_OFFSET, shape=(self.bits // 64,))
+
+    # How many exercises were added (repeats included).
+    def __len__(self):
+        return self.added
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The bits of each row, as an array of shape [rows, hashes] (double hashing).
+    def _positions(self, rows):
+        first = hash_rows(rows)
+        second = _mix64(first ^ SEEN_SALT) | np.uint64(1)
+        with np.errstate(over='ignore'):
+            positions = first[:, None] + np.arange(self.hashes, dtype=np.uint64)[None, :] * second[:, None]
+        return positions % np.uint64(self.bits)
+
+    #
+    # Returns a boolean array telling which of the given rows (numpy array of
+    # shape [rows, numbers]) may have been added before. False is certain, True
+    # is wrong at most fp_rate of the time (see false_positive_rate).
+    #
+    @stats.timed('seen_lookup')
+    def contains(self, rows):
+        positions = self._positions(rows)
+        bits = (self.words[positions >> np.uint64(6)] >> (positions & np.uint64(63))) & np.uint64(1)
+        return bits.all(axis=1)
+
+    # Adds the given rows (numpy array of shape [rows, numbers]).
+    @stats.timed('seen_add')
+    def add(self, rows):
+        positions = self._positions(rows).ravel()
+        np.bitwise_or.at(self.words, positions >> np.uint64(6), np.uint64(1) << (positions & np.uint64(63)))
+        self.added += len(rows)
+
+    # The chance that a row that was never added is taken for a seen one, from
+    # how many of the bits are set.
+    def false_positive_rate(self):
+        set_bits = int(np.unpackbits(self.words.view(np.uint8)).sum())
+        return (set_bits / self.bits) ** self.hashes
+
+    def flush(self):
+        self.words.flush()
+        with open(self.path, 'r+b') as f:
+            f.write(SEEN_PREAMBLE.pack(SEEN_MAGIC, SEEN_VERSION, self.hashes, 0, self.bits, self.capacity, self.added, self.fp_rate))
+
+    def close(self):
+        if self.words is not None:
+            self.flush()
+            self.words = None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+#
+# Local worksheet service: a long-running asyncio HTTP server on localhost that
+# hands out exercises as JSON or xlsx, so that apps asking for worksheets all
+# the time don't pay for starting Python and importing pandas on every request.
+#
+# Start it with: gen_abacus.py serve [--host HOST] [--port PORT] ...
+#
+# Requests:
+#   GET /exercises?n=20&format=json&max_number=5&max_sum=15&...
+#       Any gen_numbers parameter can be given (buffer_prefill as a comma
+#       separated list, use_negative / answer_can_be_negative as true/false),
+#       and formula, formula_count, formula_steps for drill sheets (the
+#       formula url-encoded, e.g. formula=%2B4%3D%2B5-1 for +4=+5-1) and
+#       check_running_totals (true/false).
+#       format is json (default) or xlsx.
+#   GET /health
+#       Sizes of the exercise pools.
+#
+# For every ExerciseSpec asked for, the server keeps a pool of exercises that
+# are already generated (an ExercisePoolCache, so only the max_pools most
+# recently used parameter sets are kept). When a pool drops below its
+# low-water mark, it is topped up in a background thread, so that typical
+# requests are answered straight from memory.
+#
+
+import argparse
+import asyncio
+import io
+import json
+from urllib.parse import urlsplit, parse_qs
+
+from abacus_core import ExerciseSpec, spec_to_dict
+from abacus_batch import ExercisePoolCache
+from abacus_export import write_exercises_streaming
+from gen_abacus import _str_to_bool
+
+# parameters of ExerciseSpec that can be given in a request, with their types
+SPEC_PARAMETERS = {
+    'how_many_numbers': int,
+    'max_number': int,
+    'max_sum': int,
+    'first_number_digit_count': int,
+    'max_digit_in_multi_digit_number': int,
+    'max_answer_digit': int,
+    'buffer_prefill': lambda value: tuple(int(n) for n in value.split(',') if n != ''),
+    'use_negative': _str_to_bool,
+    'answer_can_be_negative': _str_to_bool,
+    'formula': str,
+    'formula_count': int,
+    'formula_steps': lambda value: tuple(int(n) for n in value.split(',') if n != ''),
+    'check_running_totals': _str_to_bool,
+}
+
+# most exercises one request can ask for
+MAX_EXERCISES_PER_REQUEST = 100000
+
+#
+# The HTTP server. Use start() from a running event loop, or run_server().
+#
+# host, port : where to listen (port 0 picks a free port, see self.port)
+# pool_size, pool_low_water : size and low-water mark of each exercise pool
+# prewarm_specs : specs to fill pools for before the first request
+# max_pools : how many exercise pools to keep
+#
+class WorksheetServer:
+    def __init__(self, host = '127.0.0.1', port = 8765, pool_size = 10000, pool_low_water = 2000, prewarm_specs = (), max_pools = 32):
+        self.host = host
+        self.port = port
+        self.prewarm_specs = list(prewarm_specs)
+        self.pools = ExercisePoolCache(max_pools, pool_size, pool_low_water)
+        self.server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for spec in self.prewarm_specs:
+            await loop.run_in_executor(None, self.pools.get_pool(spec).fill)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    # Takes n exercises for spec and keeps the pool topped up. Whatever the pool
+    # does not have is generated in a worker thread, not in the event loop.
+    async def take_exercises(self, spec, n):
+        loop = asyncio.get_running_loop()
+        pool = self.pools.get_pool(spec)
+        rows = await loop.run_in_executor(None, pool.take, n)
+        pool.schedule_refill(loop)
+        return rows
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # skip the headers, nothing in them is needed
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                (status, content_type, body) = (405, 'application/json', _json_body({'error': 'Only GET is supported.'}))
+            else:
+                (status, content_type, body) = await self.respond(request_line[1])
+        except Exception as e:
+            (status, content_type, body) = (500, 'application/json', _json_body({'error': str(e)}))
+
+        writer.write(('HTTP/1.1 ' + str(status) + ' ' + HTTP_REASONS.get(status, '') + '\r\n' +
+                      'Content-Type: ' + content_type + '\r\n' +
+                      'Content-Length: ' + str(len(body)) + '\r\n' +
+                      'Connection: close\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        writer.close()
+
+    # Returns (status, content type, body) for the given request target. Taking
+    # the exercises and writing the body run in worker threads, so a big
+    # request doesn't hold up the other connections.
+    async def respond(self, target):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == '/health':
+            return (200, 'application/json', _json_body({'pools': [{'spec': spec_to_dict(spec), 'ready': len(pool)}
+                                                                   for (spec, pool) in self.pools.items()],
+                                                         'cache': self.pools.stats()}))
+        if url.path != '/exercises':
+            return (404, 'application/json', _json_body({'error': 'Unknown path ' + url.path}))
+
+        try:
+            spec = spec_from_query(query)
+            n = int(query.get('n', ['20'])[0])
+            output_format = query.get('format', ['json'])[0]
+            if n < 0 or n > MAX_EXERCISES_PER_REQUEST:
+                raise ValueError('n must be in range [0, ' + str(MAX_EXERCISES_PER_REQUEST) + '].')
+            if output_format not in ('json', 'xlsx'):
+                raise ValueError('format must be json or xlsx.')
+            rows = await self.take_exercises(spec, n)
+        except ValueError as e:
+            return (400, 'application/json', _json_body({'error': str(e)}))
+
+        loop = asyncio.get_running_loop()
+        if output_format == 'xlsx':
+            return (200, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    await loop.run_in_executor(None, _xlsx_body, rows))
+        return (200, 'application/json', await loop.run_in_executor(None, _exercises_json_body, spec, rows))
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def _json_body(obj):
+    return json.dumps(obj).encode('utf-8')
+
+def _exercises_json_body(spec, rows):
+    return _json_body({'spec': spec_to_dict(spec), 'exercises': [{'numbers': numbers, 'answer': sum(numbers)} for numbers in rows]})
+
+def _xlsx_body(rows):
+    output = io.BytesIO()
+    write_exercises_streaming(rows, output)
+    return output.getvalue()
+
+#
+# Builds an ExerciseSpec from the parsed query string of a request. Parameters
+# that are not given keep the gen_numbers defaults. Raises ValueError for
+# unknown parameters or values that can't be parsed.
+#
+def spec_from_query(query):
+    params = {}
+    for (name, values) in query.items():
+        if name in ('n', 'format'):
+            continue
+        if name not in SPEC_PARAMETERS:
+            raise ValueError('Unknown parameter ' + name)
+        params[name] = SPEC_PARAMETERS[name](values[0])
+    return ExerciseSpec(**params)
+
+async def run_server(host = '127.0.0.1', port = 8765, pool_size = 10000, pool_low_water = 2000, prewarm_specs = (), max_pools = 32):
+    server = WorksheetServer(host, port, pool_size, pool_low_water, prewarm_specs, max_pools)
+    await server.start()
+    print("Serving worksheets on http://" + host + ":" + str(server.port))
+    async with server.server:
+        await server.server.serve_forever()
+
+#
+# Entry point of gen_abacus.py serve.
+#
+def serve_main(argv = None):
+    parser = argparse.ArgumentParser(prog='gen_abacus.py serve', description="Local abacus worksheet service.")
+    parser.add_argument('--host', help='Address to listen on.', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on.', type=int, default=8765)
+    parser.add_argument('--pool_size', help='How many exercises to keep ready for each set of parameters.', type=int, default=10000)
+    parser.add_argument('--pool_low_water', help='Top a pool up when fewer exercises than this are left.', type=int, default=2000)
+    parser.add_argument('--max_pools', help='How many sets of parameters to keep exercise pools for.', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    try:
+        # the default parameters are by far the most common, so have them ready
+        asyncio.run(run_server(args.host, args.port, args.pool_size, args.pool_low_water, [ExerciseSpec()], args.max_pools))
+    except KeyboardInterrupt:
+        pass
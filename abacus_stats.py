@@ -0,0 +1,113 @@
+#
+# Telemetry of a generation run: counters (how often the repair loops went
+# round, how many rows were sampled, how many specs could not be met, ...) and
+# cumulative timers of the stages of a run (building the sampler tables,
+# sampling, writing the output, ...), to find out where the time of a slow
+# parameter set goes.
+#
+# Off by default. When it is off, count() returns straight away and timer()
+# returns a timer that does nothing, and both are only called once per stage
+# or per function call, never in the inner loops, so leaving the calls in costs
+# nothing noticeable. Turn it on with enable() (or --stats on the command line)
+# and get the numbers with snapshot() or write_stats().
+#
+# Only the work done in this process is counted, not the work of the worker
+# processes of a run with workers > 1.
+#
+
+import json
+import time
+from functools import wraps
+
+enabled = False
+counters = {}
+# name -> [calls, seconds]
+timers = {}
+
+#
+# Turns collecting on or off. What was collected so far is kept, see reset().
+#
+def enable(on = True):
+    global enabled
+    enabled = bool(on)
+
+# Forgets everything collected so far.
+def reset():
+    counters.clear()
+    timers.clear()
+
+# Adds n to the counter name.
+def count(name, n = 1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        totals = timers.setdefault(self.name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        return False
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+#
+# Times a stage of the run into the timer name, e.g.
+#
+#   with abacus_stats.timer('sample_rows'):
+#       ...
+#
+# Time spent in the stages inside another stage counts in both of them.
+#
+def timer(name):
+    if enabled:
+        return _Timer(name)
+    return _NO_TIMER
+
+#
+# Decorator that times every call of a function into the timer name. The
+# decorated function only checks whether collecting is on before calling it.
+#
+def timed(name):
+    def decorate(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+#
+# Returns what was collected as a dict of plain values that can be stored as
+# json: {'counters': {name: count}, 'timers': {name: {'calls': .., 'seconds': ..}}}.
+#
+def snapshot():
+    return {'counters': dict(sorted(counters.items())),
+            'timers': {name: {'calls': calls, 'seconds': seconds} for (name, (calls, seconds)) in sorted(timers.items())}}
+
+#
+# Writes snapshot() as json to output_path ('-' for the standard output).
+#
+def write_stats(output_path = '-'):
+    text = json.dumps(snapshot(), indent=2)
+    if output_path == '-':
+        print(text)
+        return
+    with open(output_path, 'w') as f:
+        f.write(text + '\n')
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+#
+# Verifier of generated exercises: generates many rows for a configuration
+# (across a pool of processes), checks every rule of its ExerciseSpec on whole
+# numpy arrays at once and reports how often each rule is broken, with a few
+# of the rows that break it. Run it on the configurations of a term before
+# their banks are printed:
+#
+#   python abacus_verify.py --how_many_numbers 5 --max_sum 44 --rows 10000000 --workers 8
+#
+# Rows can come from the row sampler (what gen_numbers and gen_abacus use),
+# from the old repair-based generation (gen_numbers_repaired) or from an
+# exercise bank.
+#
+
+import argparse
+import json
+import random as r
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from abacus_core import ExerciseSpec, make_spec, spec_to_dict, gen_numbers_repaired, stream_key
+from abacus_batch import digits_within, answers_allowed, gen_chunk
+from abacus_formulas import FORMULA_BITS, step_formulas_batch
+
+# How many rows one task of the process pool generates and checks.
+VERIFY_CHUNK_ROWS = 65536
+
+# where the rows to verify come from
+SOURCES = ('sampler', 'repaired')
+
+#
+# Checks the rows against the rules of spec. Returns a dict of rule name ->
+# boolean array that is True for the rows breaking the rule:
+#
+#   first_number : positive, up to max_number or, for a multi-digit first
+#                  number, first_number_digit_count digits that are all in
+#                  [1, max_digit_in_multi_digit_number] and leave room for the
+#                  rest of the row
+#   terms : the other generated numbers are not 0, at most max_number away
+#           from it and positive unless use_negative
+#   buffer_prefill : the row ends with buffer_prefill
+#   answer_range : the answer is within [min_answer, max_sum]
+#   answer_digits : no digit of the answer is above max_answer_digit
+#   running_totals : (check_running_totals only) every running total keeps to
+#                    the rules of the answer
+#   formula : (drill sheets only) the formula is used formula_count times and
+#             at formula_steps
+#
+# rows : numpy array of shape [n, how_many_numbers]
+#
+def check_rows(spec, rows):
+    rows = np.asarray(rows, dtype=np.int64)
+    width = spec.term_count + len(spec.buffer_prefill)
+    if rows.ndim != 2 or rows.shape[1] != width:
+        raise ValueError("Rows of " + str(width) + " numbers expected for the spec, got shape " + str(rows.shape) + ".")
+    answers = rows.sum(axis=1)
+    violations = {}
+
+    if spec.term_count > 0:
+        first = rows[:, 0]
+        if spec.has_multi_digit_first_number():
+            broken = ((first < spec.first_number_lower_bound) | (first > spec.first_number_upper_bound) |
+                      (first >= 10 ** spec.first_number_digit_count) |
+                      ~digits_within(first, spec.max_digit_in_multi_digit_number))
+            # no digit of it is 0
+            rest = first.copy()
+            for cnt in range(spec.first_number_digit_count):
+                broken |= (rest % 10) == 0
+                rest //= 10
+            violations['first_number'] = broken
+        else:
+            violations['first_number'] = (first < 1) | (first > spec.max_number)
+
+        terms = rows[:, 1:spec.term_count]
+        broken = (terms == 0) | (np.abs(terms) > spec.max_number)
+        if not spec.use_negative:
+            broken |= terms < 0
+        violations['terms'] = broken.any(axis=1)
+
+    violations['buffer_prefill'] = (rows[:, spec.term_count:] != np.array(spec.buffer_prefill, dtype=np.int64)).any(axis=1)
+    violations['answer_range'] = (answers < spec.min_answer) | (answers > spec.max_sum)
+    if 0 < spec.max_answer_digit < 9:
+        violations['answer_digits'] = ~digits_within(answers, spec.max_answer_digit)
+    else:
+        violations['answer_digits'] = np.zeros(len(rows), dtype=bool)
+
+    totals = np.cumsum(rows, axis=1)[:, :-1]
+    if spec.check_running_totals:
+        violations['running_totals'] = ~answers_allowed(spec.answer_index, totals).all(axis=1)
+    if spec.formula:
+        bit = np.uint64(FORMULA_BITS[spec.formula])
+        hits = np.zeros((len(rows), max(width - 1, 0)), dtype=bool)
+        for j in range(width - 1):
+            hits[:, j] = (step_formulas_batch(totals[:, j], rows[:, j + 1]) & bit) != 0
+        broken = hits.sum(axis=1) < spec.formula_count
+        for step in spec.formula_steps:
+            broken |= ~hits[:, step - 1]
+        violations['formula'] = broken
+    return violations
+
+#
+# The result of verifying a configuration.
+#
+# spec : the ExerciseSpec
+# source : where the rows came from (see SOURCES, or the bank file)
+# rows : how many rows were checked
+# violations : rule name -> how many rows break it (see check_rows)
+# examples : rule name -> some of the rows that break it
+# invalid_rows : how many rows break at least one rule
+# seconds : how long generating and checking took
+#
+@dataclass
+class VerificationReport:
+    spec: ExerciseSpec
+    source: str
+    rows: int = 0
+    violations: dict = field(default_factory=dict)
+    examples: dict = field(default_factory=dict)
+    invalid_rows: int = 0
+    seconds: float = 0.0
+
+    # Share of the rows breaking each rule.
+    @property
+    def rates(self):
+        return {name: count / self.rows if self.rows else 0.0 for (name, count) in self.violations.items()}
+
+    # Do all the rows keep to all the rules?
+    @property
+    def ok(self):
+        return self.invalid_rows == 0
+
+    # The report as plain values, e.g. to store it as json.
+    def to_dict(self):
+        return {'spec': spec_to_dict(self.spec), 'source': self.source, 'rows': self.rows, 'ok': self.ok,
+                'invalid_rows': self.invalid_rows, 'violations': self.violations, 'rates': self.rates,
+                'examples': self.examples, 'seconds': self.seconds}
+
+    # Adds the counts of a checked chunk, keeping up to example_limit examples per rule.
+    def add(self, chunk_report, example_limit):
+        self.rows += chunk_report.rows
+        self.invalid_rows += chunk_report.invalid_rows
+        for (name, count) in chunk_report.violations.items():
+            self.violations[name] = self.violations.get(name, 0) + count
+            examples = self.examples.setdefault(name, [])
+            examples += chunk_report.examples[name][:example_limit - len(examples)]
+
+# Sums up the violations (see check_rows) of rows into a VerificationReport.
+def _report_violations(spec, source, rows, violations, example_limit):
+    report = VerificationReport(spec, source, len(rows))
+    invalid = np.zeros(len(rows), dtype=bool)
+    for (name, broken) in violations.items():
+        invalid |= broken
+        report.violations[name] = int(broken.sum())
+        report.examples[name] = rows[broken][:example_limit].tolist()
+    report.invalid_rows = int(invalid.sum())
+    return report
+
+# Rows start .. start + count - 1 of a run of the given source.
+def _gen_rows(spec, source, start, count, seed):
+    if source == 'sampler':
+        return gen_chunk(spec, start, count, seed)
+    # every chunk gets its own random stream, whatever process makes it
+    rng = r.Random(str(stream_key(seed, spec)) + ':' + str(start))
+    with warnings.catch_warnings():
+        # the rows that could not be repaired are counted, no need to warn
+        warnings.simplefilter('ignore')
+        return np.array([gen_numbers_repaired(spec, rng) for cnt in range(count)], dtype=np.int64).reshape(count, -1)
+
+def _verify_task(task):
+    (spec, source, start, count, seed, example_limit) = task
+    rows = _gen_rows(spec, source, start, count, seed)
+    return _report_violations(spec, source, rows, check_rows(spec, rows), example_limit)
+
+def _verify_bank_task(task):
+    (bank, start, stop, example_limit) = task
+    rows = bank.get_range(start, stop)
+    violations = check_rows(bank.spec, rows)
+    # the stored answers must be the sums of the rows
+    violations['answer_column'] = np.asarray(bank.answers[start:stop], dtype=np.int64) != rows.sum(axis=1)
+    return _report_violations(bank.spec, bank.path, rows, violations, example_limit)
+
+# Runs the tasks (in a pool of workers processes if workers > 1) and adds up their reports.
+def _run_tasks(function, tasks, report, workers, example_limit):
+    start_time = time.perf_counter()
+    if workers <= 1 or len(tasks) <= 1:
+        for chunk_report in map(function, tasks):
+            report.add(chunk_report, example_limit)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk_report in pool.map(function, tasks):
+                report.add(chunk_report, example_limit)
+    report.seconds = time.perf_counter() - start_time
+    return report
+
+#
+# Generates count rows for spec and checks them all.
+#
+# count : how many rows to check
+# seed : seed of the run (the same seed checks the same rows)
+# workers : how many processes to generate and check with
+# source : 'sampler' for the rows gen_numbers / gen_abacus make, 'repaired'
+#          for the rows of gen_numbers_repaired
+# example_limit : how many rows breaking each rule to keep in the report
+#
+# Returns a VerificationReport.
+#
+def verify_spec(spec, count = 1000000, seed = 1, workers = 1, source = 'sampler', example_limit = 5):
+    if source not in SOURCES:
+        raise ValueError("source must be one of " + ", ".join(SOURCES) + ", not " + repr(source) + ".")
+    tasks = [(spec, source, start, min(VERIFY_CHUNK_ROWS, count - start), seed, example_limit)
+             for start in range(0, count, VERIFY_CHUNK_ROWS)]
+    return _run_tasks(_verify_task, tasks, VerificationReport(spec, source), workers, example_limit)
+
+#
+# Checks every exercise of an exercise bank (see abacus_bank) against the rules
+# of the spec it was made for, and that its stored answers are right.
+#
+def verify_bank(bank, workers = 1, example_limit = 5):
+    tasks = [(bank, start, min(start + VERIFY_CHUNK_ROWS, len(bank)), example_limit)
+             for start in range(0, len(bank), VERIFY_CHUNK_ROWS)]
+    return _run_tasks(_verify_bank_task, tasks, VerificationReport(bank.spec, bank.path), workers, example_limit)
+
+def _format_report(report):
+    lines = [('OK  ' if report.ok else 'FAIL') + ' ' + str(report.rows) + ' rows from ' + report.source +
+             ' in {:.1f} s, {} invalid'.format(report.seconds, report.invalid_rows),
+             '     ' + json.dumps(spec_to_dict(report.spec), sort_keys=True)]
+    for (name, count) in report.violations.items():
+        if count:
+            lines.append('     {:16s} {:10d} rows ({:.4%}), e.g. {}'.format(name, count, report.rates[name], report.examples[name][:3]))
+    return '\n'.join(lines)
+
+def build_parser():
+    # the parameters of a configuration are the same as those of gen_abacus
+    from gen_abacus import add_spec_arguments
+
+    parser = argparse.ArgumentParser(description="Checks generated exercises against the rules of their parameters.")
+    add_spec_arguments(parser)
+    parser.add_argument('--seed', help='Seed to generate the rows with (1 by default).', type=int, default=None)
+    parser.add_argument('--workers', help='How many processes to generate and check rows with.', type=int, default=1)
+    parser.add_argument('--rows', help='How many rows to generate and check.', type=int, default=1000000)
+    parser.add_argument('--source', help='Check the rows of the row sampler or of the old repair-based generation.',
+                        choices=list(SOURCES), default='sampler')
+    parser.add_argument('--configs', help='json file with a list of parameter sets (gen_numbers parameters) to check instead.', default=None)
+    parser.add_argument('--bank', help='Check the exercises of this bank file instead.', default=None)
+    parser.add_argument('--examples', help='How many rows breaking each rule to show.', type=int, default=5)
+    parser.add_argument('--json', help='Write the reports as json to this file (- for the standard output).', default=None)
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    seed = 1 if args.seed is None else args.seed
+
+    if args.bank is not None:
+        from abacus_bank import ExerciseBank
+        reports = [verify_bank(ExerciseBank(args.bank), args.workers, args.examples)]
+    else:
+        if args.configs is not None:
+            with open(args.configs) as f:
+                specs = [make_spec(**config) for config in json.load(f)]
+        else:
+            specs = [make_spec(args.how_many_numbers, args.max_number, args.max_sum, args.first_number_digit_count,
+                               args.max_digit_in_multi_digit_number, args.max_answer_digit, args.buffer_prefill or [],
+                               args.use_negative, args.answer_can_be_negative, args.formula, args.formula_count,
+                               args.formula_steps, args.check_running_totals)]
+        reports = [verify_spec(spec, args.rows, seed, args.workers, args.source, args.examples) for spec in specs]
+
+    for report in reports:
+        print(_format_report(report))
+    if args.json == '-':
+        print(json.dumps([report.to_dict() for report in reports], indent=2))
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump([report.to_dict() for report in reports], f, indent=2)
+    return 0 if all(report.ok for report in reports) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks of the exercise generator over a grid of parameters. For every
+# workload (see WORKLOADS) and every combination of the grid it measures
+# exercises per second, the p50 / p99 time per exercise and the peak memory,
+# and it can save the results as a json baseline and compare a run with a saved
+# baseline, flagging what got slower or bigger by more than a threshold.
+#
+#   python benchmark_abacus.py --save baseline.json
+#   python benchmark_abacus.py --baseline baseline.json --threshold 0.25
+#
+# The second one exits with status 1 if anything regressed.
+#
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random as r
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+from abacus_core import make_spec, get_row_sampler, gen_numbers_from_spec, gen_numbers_repaired, MAX_SAMPLER_WORK, estimate_sampler_work
+from abacus_batch import iter_row_chunks
+from abacus_export import write_exercises_streaming
+
+RESULTS_VERSION = 1
+
+# the parameters the grid does not change
+BASE_PARAMETERS = {'max_number': 9, 'max_digit_in_multi_digit_number': 8, 'max_answer_digit': 8,
+                   'use_negative': True, 'answer_can_be_negative': False}
+
+# the production grid, every combination of these is run
+DEFAULT_GRID = {'how_many_numbers': [3, 5, 10],
+                'max_sum': [15, 99, 999],
+                'first_number_digit_count': [0, 2],
+                'number_of_exercises': [1000, 100000]}
+
+# a small grid that runs in seconds, to check the harness itself
+QUICK_GRID = {'how_many_numbers': [3, 5],
+              'max_sum': [15, 99],
+              'first_number_digit_count': [0, 2],
+              'number_of_exercises': [200]}
+
+# the metrics that are compared with a baseline and whether higher is better
+METRICS = {'exercises_per_second': True, 'p50_seconds': False, 'p99_seconds': False, 'peak_memory_bytes': False}
+
+#
+# Workloads. Each one takes an ExerciseSpec, a number of exercises and a seed,
+# does the work and returns the timed blocks of it as a list of (number of
+# exercises, seconds) tuples, so that the time per exercise is known for each
+# exercise (the same for all the exercises of a block).
+#
+
+# One row at a time with the exact sampler, the way gen_numbers works.
+def run_gen_numbers(spec, n, seed):
+    rng = r.Random(seed)
+    blocks = []
+    for cnt in range(n):
+        start = time.perf_counter()
+        gen_numbers_from_spec(spec, rng)
+        blocks.append((1, time.perf_counter() - start))
+    return blocks
+
+# Batches of rows with numpy, the way gen_abacus works.
+def run_gen_numbers_batch(spec, n, seed):
+    blocks = []
+    chunks = iter_row_chunks(spec, n, seed)
+    while True:
+        start = time.perf_counter()
+        rows = next(chunks, None)
+        if rows is None:
+            return blocks
+        blocks.append((len(rows), time.perf_counter() - start))
+
+# The enforce_* functions: a random row that is then repaired, the way rows
+# were made before the exact sampler.
+def run_enforce(spec, n, seed):
+    rng = r.Random(seed)
+    blocks = []
+    with warnings.catch_warnings():
+        # rows that can't be repaired fully are part of the workload
+        warnings.simplefilter('ignore')
+        for cnt in range(n):
+            start = time.perf_counter()
+            gen_numbers_repaired(spec, rng)
+            blocks.append((1, time.perf_counter() - start))
+    return blocks
+
+# Writing an Excel workbook of rows generated beforehand (not timed). The time
+# of each row is the time between the writer asking for it and asking for the
+# next one, and closing the workbook is one more block.
+def run_export_xlsx(spec, n, seed):
+    rows = [numbers for chunk in iter_row_chunks(spec, n, seed) for numbers in chunk.tolist()]
+    blocks = []
+
+    def timed_rows():
+        start = time.perf_counter()
+        for numbers in rows:
+            yield numbers
+            now = time.perf_counter()
+            blocks.append((1, now - start))
+            start = now
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        write_exercises_streaming(timed_rows(), os.path.join(tmp_dir, 'res.xlsx'))
+        # what is left is closing the workbook, spread over all the rows
+        close_seconds = time.perf_counter() - start - sum(seconds for (count, seconds) in blocks)
+    return [(count, seconds + close_seconds / max(n, 1)) for (count, seconds) in blocks]
+
+WORKLOADS = {'gen_numbers': run_gen_numbers,
+             'gen_numbers_batch': run_gen_numbers_batch,
+             'enforce': run_enforce,
+             'export_xlsx': run_export_xlsx}
+
+#
+# Returns the time per exercise that fraction q (0 .. 1) of the exercises of
+# the given blocks take at most.
+#
+def block_percentile(blocks, q):
+    per_exercise = sorted((seconds / count, count) for (count, seconds) in blocks if count > 0)
+    total = sum(count for (seconds, count) in per_exercise)
+    if total == 0:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for (seconds, count) in per_exercise:
+        seen += count
+        if seen >= rank:
+            return seconds
+    return per_exercise[-1][0]
+
+#
+# Runs one workload for one combination of parameters and returns its result.
+# The sampler tables of the spec are built (and cached) before timing, so the
+# result is the steady state of a run, and peak memory is measured in a second
+# run with tracemalloc on, so that tracing doesn't slow down the timed one.
+#
+# measure_memory : also measure peak memory (None in the result if not)
+#
+def run_case(workload, parameters, seed = 1, measure_memory = True):
+    parameters = dict(parameters)
+    n = parameters.pop('number_of_exercises')
+    spec = make_spec(**dict(BASE_PARAMETERS, **parameters))
+    get_row_sampler(spec)
+    run = WORKLOADS[workload]
+
+    start = time.perf_counter()
+    blocks = run(spec, n, seed)
+    seconds = time.perf_counter() - start
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            run(spec, n, seed)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'workload': workload,
+            'parameters': dict(parameters, number_of_exercises = n),
+            'exercises': n,
+            'seconds': seconds,
+            'exercises_per_second': n / seconds if seconds > 0 else 0.0,
+            'p50_seconds': block_percentile(blocks, 0.5),
+            'p99_seconds': block_percentile(blocks, 0.99),
+            'peak_memory_bytes': peak_memory}
+
+#
+# Runs every workload over every combination of the grid. Combinations whose
+# sampler would be too big (see MAX_SAMPLER_WORK) are skipped.
+#
+# grid : dict of parameter name -> list of values
+# workloads : names from WORKLOADS
+# log : called with each result as it comes (e.g. to print progress)
+#
+# Returns the results as a dict that can be saved with save_results.
+#
+def run_grid(grid = DEFAULT_GRID, workloads = tuple(WORKLOADS), seed = 1, measure_memory = True, log = None):
+    names = sorted(grid)
+    results = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        parameters = dict(zip(names, values))
+        spec_parameters = {name: value for (name, value) in parameters.items() if name != 'number_of_exercises'}
+        if estimate_sampler_work(make_spec(**dict(BASE_PARAMETERS, **spec_parameters))) > MAX_SAMPLER_WORK:
+            continue
+        for workload in workloads:
+            result = run_case(workload, parameters, seed, measure_memory)
+            results.append(result)
+            if log is not None:
+                log(result)
+    return {'version': RESULTS_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine() + ' ' + platform.platform(),
+            'results': results}
+
+def save_results(results, output_path):
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError(str(path) + " is not a version " + str(RESULTS_VERSION) + " benchmark result.")
+    return results
+
+# What identifies a case when comparing two runs.
+def _case_key(result):
+    return (result['workload'], json.dumps(result['parameters'], sort_keys=True))
+
+#
+# Compares results with a baseline and returns the regressions: the metrics
+# (see METRICS) that got worse by more than threshold (0.25 is 25 %) in a case
+# that is in both. Each regression is a dict with the workload, the
+# parameters, the metric, both values and the relative change.
+#
+def compare_results(results, baseline, threshold = 0.25):
+    baseline_cases = {_case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = baseline_cases.get(_case_key(result))
+        if old is None:
+            continue
+        for (metric, higher_is_better) in METRICS.items():
+            (old_value, new_value) = (old.get(metric), result.get(metric))
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({'workload': result['workload'], 'parameters': result['parameters'], 'metric': metric,
+                                    'baseline': old_value, 'current': new_value, 'change': change})
+    return regressions
+
+def _format_result(result):
+    memory = result['peak_memory_bytes']
+    return (result['workload'].ljust(18) + ' ' + json.dumps(result['parameters'], sort_keys=True) + '\n' +
+            '    {:12.0f} exercises/s   p50 {:9.2f} us   p99 {:9.2f} us   peak {}'.format(
+                result['exercises_per_second'], result['p50_seconds'] * 1e6, result['p99_seconds'] * 1e6,
+                '-' if memory is None else '{:.1f} MB'.format(memory / 2 ** 20)))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks of the abacus exercise generator.")
+    parser.add_argument('--quick', help='Run the small grid instead of the production one.', action='store_true')
+    parser.add_argument('--workloads', nargs='*', help='Workloads to run (all by default).', choices=sorted(WORKLOADS), default=None)
+    parser.add_argument('--seed', help='Seed of the generated exercises.', type=int, default=1)
+    parser.add_argument('--no_memory', help="Don't measure peak memory (halves the running time).", action='store_true')
+    parser.add_argument('--save', help='Save the results as a json baseline to this file.', default=None)
+    parser.add_argument('--baseline', help='Compare the results with this saved baseline.', default=None)
+    parser.add_argument('--threshold', help='Flag metrics that got worse by more than this (0.25 is 25 %%).', type=float, default=0.25)
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    baseline = load_results(args.baseline) if args.baseline else None
+
+    results = run_grid(QUICK_GRID if args.quick else DEFAULT_GRID, args.workloads or tuple(WORKLOADS), args.seed,
+                       not args.no_memory, lambda result: print(_format_result(result), flush=True))
+    if args.save:
+        save_results(results, args.save)
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION {} {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(
+                regression['workload'], json.dumps(regression['parameters'], sort_keys=True), regression['metric'],
+                regression['baseline'], regression['current'], regression['change']))
+        if regressions:
+            return 1
+        print('No regressions past', '{:.0%}'.format(args.threshold), 'against', args.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,397 +1,198 @@
 #!/home/arturs/anaconda3/envs/abacus/bin/python
 
+#
+# Command line abacus exercise generator. The generation itself is in
+# abacus_core (standard library only), abacus_batch (numpy) and abacus_export
+# (csv / json / Excel writers). Everything is also available from here, but the
+# numpy and pandas based parts are only imported when they are first used (see
+# __getattr__ below), so that importing this module or writing csv / json stays
+# quick.
+#
 
 import random as r
-import copy as c
-import math as m
+import argparse
+import sys
+import importlib
+
+from abacus_core import (gen_numbers, gen_numbers_from_spec, gen_numbers_repaired, sanitize_parameters,
+                         cap_max_sum_by_answer_digit, ExerciseSpec, make_spec, enforce_positive_number_first, enforce_given_number_first,
+                         count_multi_digit_numbers_up_to, count_multi_digit_numbers_in_range,
+                         nth_multi_digit_number, gen_multi_digit_number, reduce_sum_of_numbers_by_this,
+                         enforce_min_sum, enforce_max_sum, gen_non_zero, AnswerIndex, get_answer_index, floor_allowed_answer,
+                         RowSampler, get_row_sampler, stream_key, make_seed, spec_to_dict, MAX_REPAIR_ROUNDS,
+                         MAX_SAMPLER_WORK, estimate_sampler_work, FeasibilityReport, InfeasibleSpecError,
+                         analyze_spec, check_feasibility)
+import abacus_stats as stats
+
+# names that are imported from other modules when they are first asked for
+LAZY_NAMES = {
+    'abacus_batch': ['digits_within', 'answers_allowed', 'BATCH_CHUNK_ROWS', 'sample_rows_batch',
+                     'gen_numbers_batch', 'gen_numbers_batch_from_spec', 'counter_uniforms', 'get_range',
+                     'get_exercise', 'iter_exercise_blocks', 'iter_exercises', 'ExercisePool',
+                     'ExercisePoolCache', 'pool_cache', 'draw_exercises', 'PARALLEL_CHUNK_ROWS', 'gen_chunk',
+                     'iter_row_chunks', 'gen_numbers_parallel', 'gen_rows_in_chunks', 'unrank_rows_batch',
+                     'hash_rows', 'row_keys', 'UNIQUE_ENUMERATE_ROWS', 'MAX_EMPTY_CHUNKS', 'gen_unique_rows',
+                     'gen_rows_excluding'],
+    'abacus_export': ['write_exercises_streaming', 'MAX_WIDE_EXERCISES', 'exercises_to_long_frame',
+                      'long_to_wide_frames', 'write_long_workbook', 'write_wide_workbook',
+                      'write_exercises_csv', 'write_exercises_json'],
+    'abacus_bank': ['bank_dtype', 'write_bank', 'gen_bank', 'ExerciseBank'],
+    'abacus_index': ['classify_rows', 'BankIndex'],
+    'abacus_seen': ['seen_filter_size', 'SeenFilter'],
+}
+LAZY_MODULES = {name: module for (module, names) in LAZY_NAMES.items() for name in names}
+
+def __getattr__(name):
+    if name not in LAZY_MODULES:
+        raise AttributeError("module 'gen_abacus' has no attribute " + repr(name))
+    return getattr(importlib.import_module(LAZY_MODULES[name]), name)
 
 #
-# Generates a sequence of numbers that can be then used for creating an abacus
-# exercise.
-#
-# how_many_numbers : how many numbers to generate
-# max_number : maximum giving us numbers in range [-max_number, max_number]
-# max_sum : maximum sum that the generated numbers must add up to
-# first_number_digit_count : how many digits we want in the first number (0 - don't care)
-# max_digit_in_multi_digit_number : what is the maximum digit that we want in the multi digit number (the one at the front of the row)
-# max_answer_digit : maximum digit in the answer (e.g. if this value is 4 and max_sum=100, then max_sum really is 44 and answer can be 34, 32, etc, but not 39 for instance.)
-# buffer_prefill : numbers that must be present in the final list
-# use_negative : do we want to use negative numbers
-# answer_can_be_negative : do we want to have exercises with negative answer
-#
-# NOTE: ATM it is assumed that both max_number and max_sum are positive.
-def gen_numbers(how_many_numbers = 4,
-                max_number = 5,
-                max_sum = 15,
-                first_number_digit_count = 2,
-                max_digit_in_multi_digit_number = 8,
-                max_answer_digit = 8,
-                buffer_prefill = [],
-                use_negative = True,
-                answer_can_be_negative = True):
-    # We'll store numbers here.
-    numbers = []
-
-    # We'll keep track of sum here to make sure that we don't exceed max_sum
-    tmp_sum = 0
-
-    # input sanity
-    if max_number >= max_sum:
-        max_number = max_sum - 1
-    # input sanity
-    if how_many_numbers <= 0:
-        how_many_numbers = 1
-    # input sanity
-    if max_sum <= max_number:
-        max_sum = max_number + 1
-    # sanitize input
-    if max_answer_digit > 9 or max_answer_digit < 0:
-        max_answer_digit = 9
-
-    # if max_answer_digit > 0 then that means we want the answer to consist of
-    # carefully bounded digits. We may need to re-calculate max_sum, because for
-    # example if max_sum == 500, but max_answer_digit == 4, then it's immediately
-    # clear that max_sum cannot be greater than 444. And even then we can't allow
-    # numbers like 395 as digits 9 and 5 would violate the rule.
-    if max_answer_digit > 0:
-        # first find out how many digits we have in max_sum
-        max_sum_digit_count = 0
-        while 10 ** max_sum_digit_count < max_sum:
-            max_sum_digit_count += 1
-
-        # now find the most significant number in the max_sum
-        most_significant_digit_in_max_sum = m.floor(max_sum / (10 ** (max_sum_digit_count - 1)))
-
-        # if most_significant_digit_in_max_sum is greater than max_answer_digit,
-        # then we will reduce the most_significant_digit_in_max_sum to be
-        # max_answer_digit. If it is smaller though, then we need to preserve
-        # it so that the resulting max_sum is something 244, instead of 444, when
-        # max_answer_digit == 4 and most_significant_digit_in_max_sum == 2.
-        if most_significant_digit_in_max_sum > max_answer_digit:
-            # max bound of max_sum if we obey max_answer_digit
-            max_bound_of_max_sum_with_digits = sum([max_answer_digit * 10 ** i for i in range(max_sum_digit_count)])
-        else:
-            max_bound_of_max_sum_with_digits = most_significant_digit_in_max_sum * 10 ** (max_sum_digit_count - 1)
-            max_bound_of_max_sum_with_digits += sum([max_answer_digit * 10 ** i for i in range(max_sum_digit_count - 1)])
-
-        if max_sum > max_bound_of_max_sum_with_digits:
-            max_sum = max_bound_of_max_sum_with_digits
-        # Now our max_sum will be something like 444 if max_answer_digit = 4 and initial max_sum was greater than 444.
-        # Or something like 244 if max_sum was only something like 299. But if max_sum was something like 219, then
-        # we now have 219 as max_sum and of course digit 9 clearly violates the max_answer_digit rule.
-        # In other ways too that doesn't guarantee that our result will obey max_answer_digit. It could be for
-        # instance 349 or 299, so at the moment only the most significant digit will be strictly obeying
-        # max_answer_digit rule. Let's fix that.
-
-        # Explanation via an example: Assume that max_sum_digit_count == 3,
-        # so we'll have 100's, 10's and 1's.
-        # In the beginning we have max_sum, which we divide by 100. We get quotient,
-        # which is the current number in max_sum moving from left to right and we
-        # also get remainder, which is what we divide furhter by 10 this time.
-        # That yields us the next current number in max_sum moving from left to
-        # right. And finally we divide the remainder of that division by 1 and that
-        # is our last digit in the max_sum. We can now compare all the digits and make
-        # adjustments.
-        current_digit_in_max_sum = 0
-        remainder_of_max_sum = max_sum
-        new_max_sum = 0
-        for cnt in reversed(range(max_sum_digit_count)):
-            (current_digit_in_max_sum, remainder_of_max_sum) = divmod(remainder_of_max_sum, 10 ** cnt)
-            if current_digit_in_max_sum > max_answer_digit:
-                new_max_sum += max_answer_digit * 10 ** cnt
-            else:
-                new_max_sum += current_digit_in_max_sum * 10 ** cnt
-
-        max_sum = new_max_sum
-
-    # if we need to have something prefilled in the buffer (e.g. to force end
-    # user to use some abacus formula), then we need to make adjustments to
-    # start variables to take that into account.
-    if (len(buffer_prefill) > 0):
-         max_sum -= sum(buffer_prefill)
-         how_many_numbers -= len(buffer_prefill)
-
-    # Generate required count of numbers
-    for cnt in range(how_many_numbers):
-        numbers.append(gen_non_zero(max_number, use_negative))
-
-    # We have to make sure that our list doesn't start with a negative number.
-    # For that we'll find first positive number and re-make the list so that
-    # the found positive number is at the beginning.
-    numbers = enforce_positive_number_first(numbers, max_number)
-
-    # now that we have all the necessary numbers, all that's left is to
-    # enforce the max_sum constraint.
-    numbers = enforce_max_sum(numbers, max_number, max_answer_digit, max_sum, use_negative, answer_can_be_negative)
-
-    # if we need a specific first number (of specific digit count), then enforcing that
-    # keeping max_sum constraint (the function called will obey max_sum constraint).
-    if first_number_digit_count > 0:
-        numbers = enforce_given_number_first(first_number_digit_count, max_digit_in_multi_digit_number, numbers, max_number, max_sum, max_answer_digit, use_negative, answer_can_be_negative)
-
-    # if we have to have something in the numbers list, then adding that to the
-    # end of the list.
-    if (len(buffer_prefill) > 0):
-        for cnt in range(len(buffer_prefill)):
-            numbers.append(buffer_prefill[cnt])
-
-    return numbers
-
-def enforce_positive_number_first(numbers=[-1,2,3], max_number = 5):
-    # We have to make sure that our list doesn't start with a negative number.
-    # For that we'll find first positive number and re-make the list so that
-    # the found positive number is at the beginning.
-    pos_loc = -1
-    for cnt in range(len(numbers)):
-        if numbers[cnt] > 0:
-            pos_loc = cnt
-            break
-
-    if (pos_loc > -1):
-        numbers = numbers[pos_loc:] + numbers[:pos_loc]
-    else:
-        # if there are no positive numbers at all, then make the first positive
-        # and subtract from all others equally
-        first_num = gen_non_zero(max_number, False)
-        
-        diff = first_num - numbers[0]
-        numbers[0] = first_num
-        
-        cnt = 1
-        while diff > 0:
-            numbers[cnt] -= 1
-            diff -= 1
-            cnt += 1
-            if cnt >= len(numbers): cnt = 1
-        
-    return numbers
-
+# Exercise generator with its own random number generator, so that several of
+# them can run at once (e.g. in a thread pool) without sharing any random state,
+# and so that everything a generator makes can be made again from its seed.
 #
-# Will try to enforce a given first number in the list retaining max_sum constraint.
+# seed : seed of the generator (a random one if None); see AbacusGenerator.seed
 #
-# first_number_digit_count : How many digits we want in the first number
-# max_digit_in_multi_digit_number : what is the maximum digit in the first number
-# numbers : current numbers in the row
-# max_number : maximum number to use
-# max_sum : maximum sum allowed for the whole row
-# max_answer_digit : maximum digit in answer.
-# use_negative : can we use negative numbers?
-# answer_can_be_negative : can answer be negative?
+# The methods take the same parameters as the module functions of the same name.
 #
-def enforce_given_number_first(first_number_digit_count, max_digit_in_multi_digit_number = 8, numbers = [], max_number = 10, max_sum = 100, max_answer_digit = 8, use_negative = False, answer_can_be_negative = False):
-    # if we want the first number to have certain number of digits, then
-    # generate those digits now and try to keep enforcement of max sum.
-    if (first_number_digit_count > 0):
-        # sanitize input
-        if max_digit_in_multi_digit_number > 9 or max_digit_in_multi_digit_number < 0:
-            max_digit_in_multi_digit_number = 9
-
-        prev_first_number = numbers[0]
-        new_first_number = 0
-        # we'll generate a multi-digit number, but to make sure that max_sum remains
-        # enforceable, this new number needs to be less than max_sum and leave at least
-        # a value of 1 (better 5) for each of the remaining numbers.
-        multi_digit_number_upper_bound = max_sum - 1 * (len(numbers) - 1)
-
-        # likewise if we have a limit on max_digit_in_multi_digit_number, then upper
-        # bound is likely lower.
-        multi_digit_number_upper_bound2 = sum([max_digit_in_multi_digit_number * 10 ** i for i in range(first_number_digit_count)])
-
-        multi_digit_number_upper_bound = min(multi_digit_number_upper_bound, multi_digit_number_upper_bound2)
-
-        # and of course the lower bound for multi-digit number must be 10 ^ (first_number_digit_count - 1)
-        # so that for example if we want to generate a 3 digit number, then we generate at least 100.
-        # We may want to change this in the future through a parameter.
-        multi_digit_number_lower_bound = 10 ** (first_number_digit_count - 1)
-
-        #print(multi_digit_number_lower_bound, " : ", multi_digit_number_upper_bound, " : ", len(numbers), " : ", max_sum)
-        # making sure that generation will be sane.
-        if (multi_digit_number_upper_bound > multi_digit_number_lower_bound):
-            # making sure that it will go at least once through the cycle
-            new_first_number = multi_digit_number_upper_bound + 1
-            while new_first_number > multi_digit_number_upper_bound or new_first_number < multi_digit_number_lower_bound:
-                new_first_number = 0
-                for cnt in range(first_number_digit_count):
-                    new_first_number = new_first_number * 10 + gen_non_zero(max_digit_in_multi_digit_number, False)
-
-            numbers[0] = new_first_number
-
-        # The first number is now with the required digit count.
-        # Now we need to enforce the max_sum on this new row of numbers.
-        max_sum_for_remainder_of_row = max_sum + prev_first_number - new_first_number
-        numbers = numbers[:1] + enforce_max_sum(numbers[1:], max_number, max_answer_digit, max_sum_for_remainder_of_row, use_negative, answer_can_be_negative)
-    return numbers
-
-# Reduces the sum of the numbers given in numbers list by the given subtractor
-# For example if we have a list of [9, 8, 7], the sum of which is 24, and
-# we want to reduce that list so that the sum is 4 less, then we will end up
-# with something like [7, 7, 6], giving a sum of 20.
-def reduce_sum_of_numbers_by_this(numbers = [9, 8, 7], reduce_by = 4, use_negative = False):
-    # To avoid eternal cycles, we'll use these vars.
-    row_changed = True
-    number_changed = False
-
-    start_sum = sum(numbers) #8
-    end_sum = start_sum - reduce_by # -17
-    difference = reduce_by # 25
-
-    while (difference > 0 and row_changed):
-        row_changed = False
-        subtractor = m.ceil(difference / len(numbers))
-        for cnt in range(len(numbers)):
-            number_changed = False
-            # if we're not allowed to use negative numbers then make sure that we don't
-            # and only optimize if difference is still there.
-            if difference > 0:
-                numbers[cnt] -= subtractor
-                difference -= subtractor
-                number_changed = True # we just changed a number at index cnt.
-                
-                # if we ended up with 0 and are allowed to use negative numbers, then reduce further
-                # but if negative numbers are not allowed, then make it 1 and carry on.
-                if (numbers[cnt] == 0):
-                    if use_negative:
-                        numbers[cnt] -= 1
-                        difference -= 1
-                    else:
-                        numbers[cnt] += 1
-                        difference += 1
-                        # If subtractor is 1, then we've just restored the row to what was decreased before.
-                        if subtractor == 1:
-                            number_changed = False
-                else: # but if we ended up less than 0 and are not allowed negative numbers, then restore.
-                    if (numbers[cnt] < 0 and not use_negative):
-                        numbers[cnt] += subtractor
-                        difference += subtractor
-                        number_changed = False
-            # if there were changes, then we'll need to rerun it again if we're still below threshold
-            if number_changed:
-                row_changed = True
-
-        # figure out how much is over and subtract equal share from each number in the row.
-        difference = sum(numbers) - end_sum
-    if difference > 0:
-        print("Could not reduce sum fully. It is still ", difference, " too high.")
-        
-    return numbers
+class AbacusGenerator:
+    def __init__(self, seed = None):
+        self.seed = make_seed(seed)
+        self.random = r.Random(self.seed)
+        self._np_random = None
+
+    # numpy generator for gen_numbers_batch, made when first needed so that
+    # using only gen_numbers doesn't import numpy
+    @property
+    def np_random(self):
+        if self._np_random is None:
+            import numpy as np
+            self._np_random = np.random.default_rng(self.seed)
+        return self._np_random
+
+    def gen_numbers(self,
+                    how_many_numbers = 4,
+                    max_number = 5,
+                    max_sum = 15,
+                    first_number_digit_count = 2,
+                    max_digit_in_multi_digit_number = 8,
+                    max_answer_digit = 8,
+                    buffer_prefill = [],
+                    use_negative = True,
+                    answer_can_be_negative = True):
+        return gen_numbers(how_many_numbers,
+                           max_number,
+                           max_sum,
+                           first_number_digit_count,
+                           max_digit_in_multi_digit_number,
+                           max_answer_digit,
+                           buffer_prefill,
+                           use_negative,
+                           answer_can_be_negative,
+                           self.random)
+
+    def gen_numbers_batch(self,
+                          n,
+                          how_many_numbers = 4,
+                          max_number = 5,
+                          max_sum = 15,
+                          first_number_digit_count = 2,
+                          max_digit_in_multi_digit_number = 8,
+                          max_answer_digit = 8,
+                          buffer_prefill = [],
+                          use_negative = True,
+                          answer_can_be_negative = True):
+        from abacus_batch import gen_numbers_batch
+        return gen_numbers_batch(n,
+                                 how_many_numbers,
+                                 max_number,
+                                 max_sum,
+                                 first_number_digit_count,
+                                 max_digit_in_multi_digit_number,
+                                 max_answer_digit,
+                                 buffer_prefill,
+                                 use_negative,
+                                 answer_can_be_negative,
+                                 self.np_random)
+
+    # Each worksheet gets its own seed drawn from this generator (printed by
+    # gen_abacus), so one worksheet can also be made again on its own with
+    # gen_abacus(..., seed = <that seed>).
+    def gen_abacus(self,
+                   number_of_exercises = 3,
+                   how_many_numbers = 4,
+                   max_number = 5,
+                   max_sum = 15,
+                   first_number_digit_count = 2,
+                   max_digit_in_multi_digit_number = 8,
+                   max_answer_digit = 8,
+                   buffer_prefill = [],
+                   use_negative = True,
+                   answer_can_be_negative = False,
+                   output_path = None,
+                   streaming = False,
+                   layout = 'wide',
+                   workers = 1,
+                   output_format = 'xlsx',
+                   formula = '',
+                   formula_count = 1,
+                   formula_steps = (),
+                   check_running_totals = False,
+                   unique = False,
+                   seen_path = None,
+                   seen_fp_rate = 0.001,
+                   seen_capacity = 100000):
+        return gen_abacus(number_of_exercises,
+                          how_many_numbers,
+                          max_number,
+                          max_sum,
+                          first_number_digit_count,
+                          max_digit_in_multi_digit_number,
+                          max_answer_digit,
+                          buffer_prefill,
+                          use_negative,
+                          answer_can_be_negative,
+                          output_path,
+                          streaming,
+                          layout,
+                          self.random.getrandbits(64),
+                          workers,
+                          output_format,
+                          formula,
+                          formula_count,
+                          formula_steps,
+                          check_running_totals,
+                          unique,
+                          seen_path,
+                          seen_fp_rate,
+                          seen_capacity)
 
 #
-# Enforces that the sum of the given list is more than the given minimum
-# numbers : current numbers
-# max_number : maximum number allowed in the row
-# min_sum : lower bound of the sum of the row of numbers.
-def enforce_min_sum(numbers = [], max_number = 10, min_sum = 5):
-    
-    # control variables so that we don't get stuck in an endless loop.
-    row_changed = True
-    number_changed = False
-    cnt = 0
-    difference = min_sum - sum(numbers)
-    
-    # while we have difference between actual sum and minimum sum,
-    # increase one number at a time.
-    while difference > 0 and row_changed:
-        if (numbers[cnt] < max_number):            
-            numbers[cnt] += 1
-            difference -= 1
-            number_changed = True
-            
-        cnt += 1
-        # if we reached the end of the row, then start from the beginning,
-        # but only if we're changing anything. If there's been no number change,
-        # then there's been no row change eihter and then we should stop because
-        # the min sum cannot be enforced with the given constraints.
-        if cnt >= len(numbers): 
-            cnt = 0
-            row_changed = number_changed
-            number_changed = False
-
-    # There is a chance that the enforcement was not possible. Given the
-    # context of usage of this method, it is not worth raising an exception
-    # and denying the output of this method. The result will already be better
-    # even if full enforcement was not possible. But a warning should be issued.
-    if (difference > 0):
-        print("Could not enforce min sum. Sum is ", difference, " less than needed.")
-        
-    return numbers
-
+# Generates number_of_exercises exercises and writes them to output_path.
 #
-# numbers: a row of numbers to optimize
-# max_number : maximum number giving us numbers in range [-max_number, max_number]
-# max_sum : maximum sum that the generated numbers must add up to
-# max_answer_digit : highest digit that is allowed in the answer.
-# use_negative : do we want to use negative numbers
-# answer_can_be_negative : do we want to have exercises with negative answer
+# output_path : the file to write, 'res.' + output_format if None
+# streaming : write the exercises while generating them (see
+#             write_exercises_streaming) instead of building the whole
+#             worksheet in memory first. Meant for very large worksheets, so
+#             the exercises are not printed either.
+# output_format : xlsx (a workbook in the given layout), csv or json (one
+#                 exercise per line / object, written while generating and
+#                 without pandas) or bank (see abacus_bank)
+# formula, formula_count, formula_steps : make a drill sheet for one abacus
+#                                         rule, e.g. '+4 = +5 - 1' (see
+#                                         ExerciseSpec)
+# check_running_totals : hold every running total to the rules of the answer
+# unique : never repeat an exercise (see gen_unique_rows); fails up front if
+#          there aren't number_of_exercises different ones. The exercises are
+#          generated in this process, whatever workers is.
+# seen_path : a seen filter file (see abacus_seen, e.g. one per student),
+#             created if it doesn't exist. Exercises that are in it are left
+#             out, and the written ones are added to it.
+# seen_fp_rate, seen_capacity : false-positive rate and capacity of a new seen
+#                               filter
 #
-def enforce_max_sum(numbers = [], max_number = 10, max_answer_digit = 8, max_sum = 100, use_negative = False, answer_can_be_negative = False):
-    # sanitize input
-    if max_answer_digit > 9 or max_answer_digit < 0:
-        max_answer_digit = 9
-
-    # first let's establish the minimum bound
-    if answer_can_be_negative:
-        min_sum = -1 * max_sum
-    else:
-        min_sum = 0
-
-    # first reduce the sum to comply with the max_sum parameter
-    numbers = reduce_sum_of_numbers_by_this(numbers, sum(numbers) - max_sum, use_negative)
-    # now get it above the lower bound
-    numbers = enforce_min_sum(numbers, max_number, min_sum)
-
-    # now all that's left is to enforce max_answer_digit in the answer.
-    # So how much are we over if we want to enforce the max_answer_digit?
-    if max_answer_digit > 0:
-        # first find out what digits we have in the current sum
-        cur_sum = sum(numbers)
-        cur_sum_digit_count = 0
-        cur_sum_digits = []
-        while 10 ** cur_sum_digit_count < cur_sum:
-            cur_sum_digit_count += 1
-
-        # Now let's split the current sum into its digits:
-        #
-        # Explanation via an example: Assume that cur_sum_digit_count == 3,
-        # so we'll have 100's, 10's and 1's.
-        # In the beginning we have cur_sum, which we divide by 100. We get quotient,
-        # which is the current number in cur_sum moving from left to right and we
-        # also get remainder, which is what we divide furhter by 10 this time.
-        # That yields us the next current number in cur_sum moving from left to
-        # right. And finally we divide the remainder of that division by 1 and that
-        # is our last digit in the cur_sum. We can now compare all the digits and make
-        # adjustments.
-        current_digit_in_cur_sum = 0
-        remainder_of_cur_sum = cur_sum
-        for cnt in reversed(range(cur_sum_digit_count)):
-            (current_digit_in_cur_sum, remainder_of_cur_sum) = divmod(remainder_of_cur_sum, 10 ** cnt)
-            cur_sum_digits.append(current_digit_in_cur_sum)
-
-        # now how much are we over?
-        over_by = 0
-        rev_range = [a for a in reversed(range(cur_sum_digit_count))]
-        for cnt in range(cur_sum_digit_count):
-            if cur_sum_digits[cnt] > max_answer_digit:
-                over_by += (cur_sum_digits[cnt] - max_answer_digit * 10 ** rev_range[cnt])
-
-    # finally reduce the whole list by what is over
-    numbers = reduce_sum_of_numbers_by_this(numbers, over_by, use_negative)
-
-    return numbers
-
-def gen_non_zero(max_number, use_negative = False):
-    # We don't normally want to generate 0-es, so if we get one, then
-    # let's re-generate.
-    tmp_num = 0
-    while tmp_num == 0:
-        if use_negative:
-            #print (-1 * max_number, " : ", max_number)
-            tmp_num = r.randint(-1 * max_number, max_number)
-        else:
-            tmp_num = r.randint(1, max_number)
-    return tmp_num
-
-import pandas as pd
-
+@stats.timed('gen_abacus')
 def gen_abacus(number_of_exercises = 3,
                 how_many_numbers = 4,
                 max_number = 5,
@@ -401,21 +202,108 @@ def gen_abacus(number_of_exercises = 3,
                 max_answer_digit = 8,
                 buffer_prefill = [],
                 use_negative = True,
-                answer_can_be_negative = False):
+                answer_can_be_negative = False,
+                output_path = None,
+                streaming = False,
+                layout = 'wide',
+                seed = None,
+                workers = 1,
+                output_format = 'xlsx',
+                formula = '',
+                formula_count = 1,
+                formula_steps = (),
+                check_running_totals = False,
+                unique = False,
+                seen_path = None,
+                seen_fp_rate = 0.001,
+                seen_capacity = 100000):
     
-    exercises = {}
-    answers = {}
-    col_names = []
+    if output_format not in ('xlsx', 'csv', 'json', 'bank'):
+        raise ValueError("output_format must be xlsx, csv, json or bank, not " + repr(output_format) + ".")
+    if output_path is None:
+        output_path = 'res.' + output_format
+
+    spec = make_spec(how_many_numbers,
+                     max_number,
+                     max_sum,
+                     first_number_digit_count,
+                     max_digit_in_multi_digit_number,
+                     max_answer_digit,
+                     buffer_prefill,
+                     use_negative,
+                     answer_can_be_negative,
+                     formula,
+                     formula_count,
+                     formula_steps,
+                     check_running_totals)
+    # fail before writing anything if the parameters can't be met
+    check_feasibility(spec)
+    seed = make_seed(seed)
+    print("Seed:", seed)
+
+    from abacus_batch import gen_unique_rows, gen_rows_excluding
+
+    if seen_path is None:
+        rows = gen_unique_rows(spec, number_of_exercises, seed) if unique else None
+        write_worksheet(spec, rows, number_of_exercises, seed, output_path, streaming, layout, workers, output_format)
+        return
+
+    from abacus_seen import SeenFilter
+
+    with SeenFilter(seen_path, seen_capacity, seen_fp_rate) as seen:
+        if unique:
+            rows = gen_unique_rows(spec, number_of_exercises, seed, seen.contains)
+        else:
+            rows = gen_rows_excluding(spec, number_of_exercises, seed, seen.contains)
+        write_worksheet(spec, rows, number_of_exercises, seed, output_path, streaming, layout, workers, output_format)
+        seen.add(rows)
+
+#
+# Writes a worksheet of exercises for gen_abacus (see there for the
+# parameters). rows are the exercises as a numpy array, or None to generate
+# number_of_exercises of them from seed while writing.
+#
+def write_worksheet(spec, rows, number_of_exercises, seed, output_path = 'res.xlsx', streaming = False, layout = 'wide', workers = 1,
+                    output_format = 'xlsx'):
+    from abacus_batch import gen_rows_in_chunks, gen_numbers_parallel
+
+    if output_format == 'bank':
+        from abacus_bank import gen_bank, write_bank
+        if rows is not None:
+            write_bank([rows], spec, seed, output_path)
+        else:
+            gen_bank(spec, number_of_exercises, seed, output_path, workers)
+        return
+
+    if output_format in ('csv', 'json'):
+        from abacus_export import write_exercises_csv, write_exercises_json
+        writer = write_exercises_csv if output_format == 'csv' else write_exercises_json
+        writer(rows.tolist() if rows is not None else gen_rows_in_chunks(spec, number_of_exercises, seed, workers), output_path)
+        return
+
+    from abacus_export import (write_exercises_streaming, MAX_WIDE_EXERCISES, exercises_to_long_frame,
+                               long_to_wide_frames, write_long_workbook, write_wide_workbook)
+
+    if streaming:
+        write_exercises_streaming(rows.tolist() if rows is not None else gen_rows_in_chunks(spec, number_of_exercises, seed, workers),
+                                  output_path)
+        return
+
+    if layout == 'wide' and number_of_exercises > MAX_WIDE_EXERCISES:
+        raise ValueError("A sheet can only hold " + str(MAX_WIDE_EXERCISES) + " exercises in the wide layout, use the long layout for " +
+                         str(number_of_exercises) + ".")
+
+    if rows is None:
+        rows = gen_numbers_parallel(spec, number_of_exercises, seed, workers)
+    long_df = exercises_to_long_frame(rows)
+
+    if layout == 'long':
+        print(long_df)
+        write_long_workbook(long_df, output_path)
+        return
+
     for i in range(number_of_exercises):
-        numbers = gen_numbers(how_many_numbers,
-                            max_number,
-                            max_sum,
-                            first_number_digit_count,
-                            max_digit_in_multi_digit_number,
-                            max_answer_digit,
-                            buffer_prefill,
-                            use_negative,
-                            answer_can_be_negative)
+        numbers = rows[i].tolist()
         print("-------------------")
 
         for cnt in range(len(numbers)):
@@ -423,55 +311,12 @@ def gen_abacus(number_of_exercises = 3,
 
         print("-------------------")
         print(sum(numbers))
-        
-        exercises.update({'Exercise ' + str(i + 1) : numbers})
-        answers.update({'Exercise ' + str(i + 1) : [sum(numbers)]})
-        col_names.append('Exercise ' + str(i + 1))
-        
-        #print(answers)
-    ex_df = pd.DataFrame(exercises)
-    ans_df = pd.DataFrame(answers)
-    
-    #ex_df.set_index("Exercise 1", inplace=True)
-    #ans_df.set_index("Exercise 1", inplace=True)
+
+    (ex_df, ans_df) = long_to_wide_frames(long_df)
     
     print(ex_df)
     print(ans_df)
-    #df.to_csv("res.csv")
-    with pd.ExcelWriter('res.xlsx', engine='xlsxwriter') as writer:
-        # Turn off the default header and skip one row to allow us to insert a
-        # user defined header.
-        ex_df.to_excel(writer, sheet_name='Exercises', startrow=1, header=False, index=False)
-        ans_df.to_excel(writer, sheet_name='Answers', index=False)
-
-        # Get the xlsxwriter workbook and worksheet objects.
-        workbook  = writer.book
-        ex_worksheet = writer.sheets['Exercises']
-        ans_worksheet = writer.sheets['Answers']
-        
-        # Add a header format.
-        header_format = workbook.add_format({
-            'bold': True,
-            'text_wrap': True,
-            'valign': 'top',
-            'fg_color': '#D7E4BC',
-            'border': 1})
-        
-        idx = 0
-        # Write the column headers with the defined format.
-        for col_num, value in enumerate(ex_df.columns.values):
-            ex_worksheet.write(0, col_num, value, header_format)
-            ex_worksheet.set_column(idx, idx, 12)
-            ans_worksheet.set_column(idx, idx, 12)
-            idx += 1
-        
-        writer.save()
-        
-        #print(writer.sheets['Exercises'].column_dimensions.)
-        
-        #for ndx in range(len(col_names)):
-        #    writer.sheets['Exercises'].column_dimensions[col_names[ndx]].width = 15
-
+    write_wide_workbook(ex_df, ans_df, output_path)
 
 #print(gen_abacus(3, 2, 4, 4, [], True, False))
 
@@ -489,40 +334,70 @@ def gen_abacus(number_of_exercises = 3,
 # DONE: first number is positive
 # specify count of double digit numbers
 
-import argparse
-import sys
-
 def _str_to_bool(s):
     """Convert string to bool (in argparse context)."""
     if s.lower() not in ['true', 'false']:
         raise ValueError('Need bool; got %r' % s)
     return {'true': True, 'false': False}[s.lower()]
 
-parser = argparse.ArgumentParser(description="Abacus exercise generator.")
-parser.add_argument('--number_of_exercises', help='The number of exercises to generate.', type=int, default=3)
-parser.add_argument('-hmn', '--how_many_numbers', help='How many numbers in each exercise.', type=int, default=4)
-parser.add_argument('--max_number', help='Maximum number to add or subtract.', type=int, default=5)
-parser.add_argument('--max_sum', help='Maximum sum for all numbers to add up to.', type=int, default=15)
-parser.add_argument('--first_number_digit_count', help='How many digits in the first number.', type=int, default=2)
-parser.add_argument('--max_digit_in_multi_digit_number', help='Highest digit in the first number.', type=int, default=8)
-parser.add_argument('--max_answer_digit', help='Highest digit in the answer.', type=int, default=8)
-
-parser.add_argument('--buffer_prefill', nargs='*', help='End with these numbers in the exercise.', type=int)
-#parser.add_argument('--buffer_prefill', help='Start with these numbers in the exercise.', type=int, default=[])
-#parser.add_argument('--buffer_prefill2', action='append', help='Start with these numbers in the exercise.', required=True)
-
-#use_negative_feature = parser.add_mutually_exclusive_group(required=False)
-#use_negative_feature.add_argument('--use_negative', nargs='?', help='Shall we use negative numbers in exercises?')
-#use_negative_feature.add_argument('--nouse_negative', dest=use_negative, action='store_false')
-#use_negative_feature.add_argument('--use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_true')
-#use_negative_feature.add_argument('--not_use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_false')
-#parser.set_defaults(use_negative=False)
-
-parser.add_argument('--use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_true')
-parser.add_argument('--answer_can_be_negative', help='Can answer be a negative numbers?', dest='answer_can_be_negative', action='store_true')
+#
+# Adds the arguments of an ExerciseSpec (the gen_numbers parameters plus the
+# formula ones) to parser. Shared with the tools that take the same parameters.
+#
+def add_spec_arguments(parser):
+    parser.add_argument('-hmn', '--how_many_numbers', help='How many numbers in each exercise.', type=int, default=4)
+    parser.add_argument('--max_number', help='Maximum number to add or subtract.', type=int, default=5)
+    parser.add_argument('--max_sum', help='Maximum sum for all numbers to add up to.', type=int, default=15)
+    parser.add_argument('--first_number_digit_count', help='How many digits in the first number.', type=int, default=2)
+    parser.add_argument('--max_digit_in_multi_digit_number', help='Highest digit in the first number.', type=int, default=8)
+    parser.add_argument('--max_answer_digit', help='Highest digit in the answer.', type=int, default=8)
+
+    parser.add_argument('--buffer_prefill', nargs='*', help='End with these numbers in the exercise.', type=int)
+    #parser.add_argument('--buffer_prefill', help='Start with these numbers in the exercise.', type=int, default=[])
+    #parser.add_argument('--buffer_prefill2', action='append', help='Start with these numbers in the exercise.', required=True)
+
+    #use_negative_feature = parser.add_mutually_exclusive_group(required=False)
+    #use_negative_feature.add_argument('--use_negative', nargs='?', help='Shall we use negative numbers in exercises?')
+    #use_negative_feature.add_argument('--nouse_negative', dest=use_negative, action='store_false')
+    #use_negative_feature.add_argument('--use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_true')
+    #use_negative_feature.add_argument('--not_use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_false')
+    #parser.set_defaults(use_negative=False)
+
+    parser.add_argument('--use_negative', help='Shall we use negative numbers in exercises?', dest='use_negative', action='store_true')
+    parser.add_argument('--answer_can_be_negative', help='Can answer be a negative numbers?', dest='answer_can_be_negative', action='store_true')
+    parser.add_argument('--formula', help='Abacus rule to drill, e.g. --formula=+4=+5-1 or --formula=-7=-10+3.', default='')
+    parser.add_argument('--formula_count', help='In how many steps of each exercise at least to use the rule.', type=int, default=1)
+    parser.add_argument('--formula_steps', nargs='*', help='Steps that must use the rule (1 is adding the second number).', type=int, default=[])
+    parser.add_argument('--check_running_totals', help='Keep every running total within the rules of the answer, not just the answer.', action='store_true')
+    return parser
+
+#
+# Builds the command line parser. Done only when main() runs, not on import.
+#
+def build_parser():
+    parser = argparse.ArgumentParser(description="Abacus exercise generator.")
+    parser.add_argument('--number_of_exercises', help='The number of exercises to generate.', type=int, default=3)
+    add_spec_arguments(parser)
+    parser.add_argument('--output', help='Where to write the exercises (res.<format> by default).', default=None)
+    parser.add_argument('--streaming', help='Write exercises while generating them (for very large worksheets).', action='store_true')
+    parser.add_argument('--seed', help='Seed to generate with; the same seed gives the same exercises.', type=int, default=None)
+    parser.add_argument('--workers', help='How many processes to generate exercises with.', type=int, default=1)
+    parser.add_argument('--layout', help='One column per exercise (wide) or one row per exercise (long).', choices=['wide', 'long'], default='wide')
+    parser.add_argument('--format', help='Write an Excel workbook (xlsx), csv, json or an exercise bank.', dest='output_format', choices=['xlsx', 'csv', 'json', 'bank'], default='xlsx')
+    parser.add_argument('--unique', help='Never repeat an exercise in the worksheet.', action='store_true')
+    parser.add_argument('--seen', help="Seen filter file of a student: leave out the exercises in it and add the new ones.", dest='seen_path', default=None)
+    parser.add_argument('--seen_fp_rate', help='False-positive rate of a new seen filter.', type=float, default=0.001)
+    parser.add_argument('--seen_capacity', help='How many exercises a new seen filter is sized for.', type=int, default=100000)
+    parser.add_argument('--stats', help='Write counters and timings of the run as json to this file (- for the standard output).', default=None)
+    return parser
 
 def main():
-    args = parser.parse_args()
+    # gen_abacus.py serve [...] runs the worksheet service instead
+    if sys.argv[1:2] == ['serve']:
+        from abacus_server import serve_main
+        return serve_main(sys.argv[2:])
+
+    args = build_parser().parse_args()
     
     print(args.use_negative, " ## ", args.answer_can_be_negative, " ;; ", args.buffer_prefill)
 
@@ -531,16 +406,61 @@ def main():
     else:
         buffer_prefill = args.buffer_prefill
     
-    gen_abacus(args.number_of_exercises,
-                args.how_many_numbers,
-                args.max_number,
-                args.max_sum,
-                args.first_number_digit_count,
-                args.max_digit_in_multi_digit_number,
-                args.max_answer_digit,
-                buffer_prefill,
-                args.use_negative,
-                args.answer_can_be_negative)
+    if args.stats is not None:
+        stats.enable()
+
+    # parameters that ExerciseSpec rejects (e.g. an unknown formula) end the
+    # run with a message before anything is generated
+    try:
+        make_spec(args.how_many_numbers,
+                  args.max_number,
+                  args.max_sum,
+                  args.first_number_digit_count,
+                  args.max_digit_in_multi_digit_number,
+                  args.max_answer_digit,
+                  buffer_prefill,
+                  args.use_negative,
+                  args.answer_can_be_negative,
+                  args.formula,
+                  args.formula_count,
+                  args.formula_steps,
+                  args.check_running_totals)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    try:
+        gen_abacus(args.number_of_exercises,
+                    args.how_many_numbers,
+                    args.max_number,
+                    args.max_sum,
+                    args.first_number_digit_count,
+                    args.max_digit_in_multi_digit_number,
+                    args.max_answer_digit,
+                    buffer_prefill,
+                    args.use_negative,
+                    args.answer_can_be_negative,
+                    args.output,
+                    args.streaming,
+                    args.layout,
+                    args.seed,
+                    args.workers,
+                    args.output_format,
+                    args.formula,
+                    args.formula_count,
+                    args.formula_steps,
+                    args.check_running_totals,
+                    args.unique,
+                    args.seen_path,
+                    args.seen_fp_rate,
+                    args.seen_capacity)
+    except InfeasibleSpecError as e:
+        # parameters that can't be met (see check_feasibility)
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        if args.stats is not None:
+            stats.write_stats(args.stats)
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
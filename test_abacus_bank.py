@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+from abacus_core import make_spec
+from abacus_batch import gen_numbers_parallel
+from abacus_batch import get_exercise
+from abacus_bank import bank_dtype
+from abacus_bank import write_bank
+from abacus_bank import gen_bank
+from abacus_bank import ExerciseBank
+
+class TestAbacusBank(unittest.TestCase):
+
+    def test_bank_dtype(self):
+        self.assertEqual(bank_dtype(make_spec(5, 5, 44, 2, 3, 4, [], True, False)), np.int16)
+        self.assertEqual(bank_dtype(make_spec(3, 9, 99999, 5, 9, 9, [], True, True)), np.int32)
+
+    def test_gen_bank(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [3], True, False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.bank')
+            self.assertEqual(gen_bank(spec, 3000, 17, output_path), 3000)
+
+            bank = ExerciseBank(output_path)
+            self.assertEqual((len(bank), bank.width, bank.seed), (3000, 5, 17))
+            self.assertEqual(bank.spec, spec)
+            self.assertIsInstance(bank.table, np.memmap)
+
+            # the same exercises as a full run, read by index
+            full_run = gen_numbers_parallel(spec, 3000, 17)
+            self.assertTrue(np.array_equal(bank.rows, full_run))
+            self.assertTrue(np.array_equal(bank.answers, full_run.sum(axis=1)))
+            self.assertEqual(bank[2500], get_exercise(17, spec, 2500))
+            self.assertTrue(np.array_equal(bank.get_range(10, 20), full_run[10:20]))
+
+            # other processes get the file, not a copy of the table
+            self.assertLess(len(pickle.dumps(bank)), 1000)
+            self.assertEqual(pickle.loads(pickle.dumps(bank))[2500], bank[2500])
+            del bank
+
+    def test_write_bank_errors(self):
+        spec = make_spec(3, 5, 15, 0, 8, 8, [], True, False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.bank')
+
+            # an empty bank can still be opened
+            self.assertEqual(write_bank([], spec, None, output_path), 0)
+            self.assertEqual(len(ExerciseBank(output_path)), 0)
+
+            # rows that don't fit the type of the spec
+            with self.assertRaises(ValueError):
+                write_bank([np.array([[40000, 1, 1]])], spec, None, output_path)
+
+            # a cut off bank and something that is not a bank at all
+            write_bank([np.array([[1, 2, 3], [3, 2, 1]])], spec, None, output_path)
+            with open(output_path, 'r+b') as f:
+                f.truncate(os.path.getsize(output_path) - 2)
+            with self.assertRaises(ValueError):
+                ExerciseBank(output_path)
+            with open(output_path, 'wb') as f:
+                f.write(b'exercise,term_1\n')
+            with self.assertRaises(ValueError):
+                ExerciseBank(output_path)
+
+if __name__ == '__main__':
+    unittest.main()
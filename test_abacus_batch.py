@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import itertools
+import tracemalloc
+import numpy as np
+import abacus_batch
+from abacus_core import ExerciseSpec
+from abacus_core import make_spec
+from abacus_batch import digits_within
+from abacus_batch import gen_numbers_batch
+from abacus_batch import gen_numbers_parallel
+from abacus_batch import get_exercise
+from abacus_batch import get_range
+from abacus_batch import counter_uniforms
+from abacus_batch import iter_exercises
+from abacus_batch import iter_exercise_blocks
+from abacus_batch import ExercisePool
+from abacus_batch import ExercisePoolCache
+from abacus_batch import unrank_rows_batch
+from abacus_batch import row_keys
+from abacus_batch import gen_unique_rows
+from abacus_batch import gen_rows_excluding
+from abacus_batch import hash_rows
+from abacus_core import get_row_sampler
+from abacus_core import RowSampler
+from abacus_core import estimate_sampler_work
+from abacus_core import MAX_SAMPLER_WORK
+from abacus_core import InfeasibleSpecError
+from abacus_verify import check_rows
+
+class TestAbacusBatch(unittest.TestCase):
+    def test_digits_within(self):
+        self.assertEqual(digits_within([0, 8, 9, 18, 81, 88, 108, -19, -44], 8).tolist(),
+                         [True, True, False, True, True, True, True, False, True])
+
+    def test_gen_numbers_batch(self):
+        how_many_numbers = 4
+        max_number = 5
+        max_sum = 44
+        first_number_digit_count = 2
+        max_digit_in_multi_digit_number = 3
+        max_answer_digit = 4
+        buffer_prefill = [4]
+        use_negative = True
+        answer_can_be_negative = False
+
+        rows = gen_numbers_batch(1000,
+                        how_many_numbers,
+                        max_number,
+                        max_sum,
+                        first_number_digit_count,
+                        max_digit_in_multi_digit_number,
+                        max_answer_digit,
+                        buffer_prefill,
+                        use_negative,
+                        answer_can_be_negative,
+                        rng = np.random.default_rng(5))
+
+        self.assertEqual(rows.shape, (1000, how_many_numbers))
+        # prefill at the end of each row
+        self.assertTrue(np.all(rows[:, -1] == 4))
+        # no zeroes and all the middle numbers within max_number
+        self.assertTrue(np.all(rows != 0))
+        self.assertTrue(np.all(np.abs(rows[:, 1:-1]) <= max_number))
+        # two digit first number with digits no more than 3
+        self.assertTrue(np.all((rows[:, 0] >= 11) & (rows[:, 0] <= 33)))
+        self.assertTrue(np.all(digits_within(rows[:, 0], max_digit_in_multi_digit_number)))
+        # answers within [0, max_sum] and obeying max_answer_digit
+        answers = rows.sum(axis=1)
+        self.assertTrue(np.all((answers >= 0) & (answers <= max_sum)))
+        self.assertTrue(np.all(digits_within(answers, max_answer_digit)))
+
+    def test_gen_numbers_parallel(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+        # small chunks so that the work really gets split between processes
+        chunk_rows = abacus_batch.PARALLEL_CHUNK_ROWS
+        abacus_batch.PARALLEL_CHUNK_ROWS = 100
+        try:
+            one_worker = gen_numbers_parallel(spec, 450, 1234, workers = 1)
+            two_workers = gen_numbers_parallel(spec, 450, 1234, workers = 2)
+        finally:
+            abacus_batch.PARALLEL_CHUNK_ROWS = chunk_rows
+
+        self.assertEqual(one_worker.shape, (450, 5))
+        self.assertTrue(np.array_equal(one_worker, two_workers))
+        self.assertFalse(np.array_equal(one_worker, gen_numbers_parallel(spec, 450, 4321)))
+
+    def test_wide_numbers(self):
+        # specs the work estimate lets through don't need more memory for
+        # batches than for the sampler (wide max_number, 5-digit first number)
+        for spec in [make_spec(12, 600, 7000, 0, 8, 9, [], True, False), make_spec(3, 9, 99999, 5, 9, 9, [], True, False)]:
+            self.assertLess(estimate_sampler_work(spec), MAX_SAMPLER_WORK)
+            get_row_sampler(spec)
+            tracemalloc.start()
+            try:
+                rows = gen_numbers_parallel(spec, 3, 1)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(rows.shape, (3, spec.how_many_numbers))
+            self.assertLess(peak, 64 * 2 ** 20)
+
+    def test_get_exercise(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+        full_run = gen_numbers_parallel(spec, 1000, 99)
+
+        # any exercise or range of exercises comes out the same as in a full run
+        self.assertEqual(get_exercise(99, spec, 0), full_run[0].tolist())
+        self.assertEqual(get_exercise(99, spec, 777), full_run[777].tolist())
+        self.assertTrue(np.array_equal(get_range(99, spec, 300, 420), full_run[300:420]))
+        self.assertEqual(get_range(99, spec, 5, 5).shape, (0, 5))
+
+        # another seed or another spec gives other exercises
+        self.assertFalse(np.array_equal(get_range(98, spec, 0, 100), full_run[:100]))
+        other_spec = make_spec(5, 5, 44, 2, 3, 4, [], True, True)
+        self.assertFalse(np.array_equal(get_range(99, other_spec, 0, 100), full_run[:100]))
+
+        uniforms = counter_uniforms(12345, 0, 10000, 4)
+        self.assertTrue(np.all((uniforms >= 0) & (uniforms < 1)))
+        self.assertAlmostEqual(uniforms.mean(), 0.5, delta=0.01)
+
+    def test_iter_exercises(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+        expected = get_range(7, spec, 0, 25)
+
+        exercises = list(iter_exercises(spec, 25, seed = 7, block_size = 10))
+        self.assertEqual([numbers for (numbers, answer) in exercises], expected.tolist())
+        self.assertEqual([answer for (numbers, answer) in exercises], expected.sum(axis=1).tolist())
+
+        blocks = list(iter_exercise_blocks(spec, 10, 25, seed = 7))
+        self.assertEqual([len(rows) for (rows, answers) in blocks], [10, 10, 5])
+
+        # without n it just goes on
+        endless = iter_exercises(spec, seed = 7, block_size = 10)
+        self.assertEqual(len(list(itertools.islice(endless, 35))), 35)
+
+    def test_exercise_pool(self):
+        spec = ExerciseSpec(5, 5, 44, 2, 3, 4, (), True, False)
+        pool = ExercisePool(spec, size = 100, low_water = 20, seed = 3)
+        pool.fill()
+        self.assertEqual(len(pool), 100)
+
+        # taken exercises leave the pool and never come back
+        first = pool.take(30)
+        self.assertEqual(len(first), 30)
+        self.assertEqual(len(pool), 70)
+        # asking for more than there is still gives everything asked for
+        rest = pool.take(120)
+        self.assertEqual(len(rest), 120)
+        self.assertEqual(len(pool), 0)
+        for numbers in first + rest:
+            self.assertTrue(0 <= sum(numbers) <= 44)
+
+    def test_exercise_pool_cache(self):
+        cache = ExercisePoolCache(max_pools = 2, pool_size = 50, pool_low_water = 10)
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+
+        first = cache.draw(spec, 30)
+        # the same parameters before normalization (max_sum 50 is capped to 44)
+        second = cache.draw(make_spec(5, 5, 50, 2, 3, 4, [], True, False), 30)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        self.assertEqual(len(first + second), 60)
+
+        # the least recently used pool goes first
+        cache.draw(make_spec(max_sum = 20), 1)
+        cache.get_pool(spec)
+        cache.draw(make_spec(max_sum = 30), 1)
+        self.assertIn(spec, cache)
+        self.assertNotIn(make_spec(max_sum = 20), cache)
+        self.assertEqual(cache.stats(), {'pools': 2, 'hits': 2, 'misses': 3, 'evictions': 1})
+
+    def test_unrank_rows_batch(self):
+        for spec in [make_spec(3, 5, 44, 2, 3, 4, [2], True, False),
+                     make_spec(5, 3, 12, 0, 8, 8, [], True, False, '+2=+5-3', 2, [2])]:
+            sampler = get_row_sampler(spec)
+            rows = unrank_rows_batch(sampler, np.arange(sampler.total))
+            # every valid row once, in order
+            self.assertEqual(rows.tolist(), sorted(rows.tolist()))
+            self.assertEqual(len(set(map(tuple, rows.tolist()))), sampler.total)
+            self.assertFalse(any(mask.any() for mask in check_rows(spec, rows).values()))
+
+        with self.assertRaises(ValueError):
+            unrank_rows_batch(sampler, [sampler.total])
+
+        # more runs of numbers than MAX_TABLE_INTERVALS after the first position
+        domains = [[1, 2, 3, 4], [number for number in range(400) if number % 3 != 1], [1, 2, 3, 4]]
+        sampler = RowSampler(domains, range(300))
+        expected = sorted(list(row) for row in itertools.product(*domains) if sum(row) < 300)
+        self.assertEqual(unrank_rows_batch(sampler, np.arange(sampler.total)).tolist(), expected)
+        rows = abacus_batch.sample_rows_batch(sampler, np.random.default_rng(2).random((5000, 3)))
+        self.assertTrue(set(map(tuple, rows.tolist())) <= set(map(tuple, expected)))
+
+        # counts past 64 bits at some position, though the rows are fewer
+        sampler = RowSampler([[0, 100]] + [list(range(-9, 10))] * 14, range(201))
+        rows = unrank_rows_batch(sampler, [0, sampler.total - 1])
+        self.assertEqual(rows[0].tolist(), [0] + [-9] * 7 + [9] * 7)
+        self.assertTrue(0 <= rows[1].sum() <= 200)
+
+    def test_row_keys(self):
+        spec = make_spec(4, 5, 15, 0, 8, 8, [], True, False)
+        sampler = get_row_sampler(spec)
+        keys = row_keys(spec, unrank_rows_batch(sampler, np.arange(sampler.total)))
+        self.assertEqual(len(np.unique(keys)), sampler.total)
+
+        # the hash doesn't depend on the spec
+        self.assertTrue(np.array_equal(hash_rows([[1, 2, 3], [3, 2, 1]]), hash_rows(np.array([[1, 2, 3], [3, 2, 1]]))))
+        self.assertNotEqual(hash_rows([[1, 2, 3]])[0], hash_rows([[1, 2, 3, 0]])[0])
+
+        # too many numbers to pack, so the keys are hashes
+        spec = make_spec(25, 9, 999, 2, 8, 8, [], True, False)
+        rows = get_range(1, spec, 0, 1000)
+        keys = row_keys(spec, rows)
+        self.assertEqual(len(np.unique(keys)), len(np.unique(rows, axis=0)))
+        self.assertTrue(np.array_equal(row_keys(spec, rows[::-1]), keys[::-1]))
+
+        with self.assertRaises(ValueError):
+            row_keys(spec, rows[:, :3])
+
+    def test_gen_unique_rows(self):
+        # few valid rows: drawn from all of them
+        spec = make_spec(3, 5, 15, 0, 8, 8, [], True, False)
+        total = get_row_sampler(spec).total
+        rows = gen_unique_rows(spec, total, 5)
+        self.assertEqual(len(set(map(tuple, rows.tolist()))), total)
+        self.assertTrue(np.array_equal(rows, gen_unique_rows(spec, total, 5)))
+        with self.assertRaises(InfeasibleSpecError):
+            gen_unique_rows(spec, total + 1, 5)
+
+        # many valid rows: the run's stream without the repeats
+        enumerate_rows = abacus_batch.UNIQUE_ENUMERATE_ROWS
+        abacus_batch.UNIQUE_ENUMERATE_ROWS = 0
+        try:
+            spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+            rows = gen_unique_rows(spec, 3000, 5)
+        finally:
+            abacus_batch.UNIQUE_ENUMERATE_ROWS = enumerate_rows
+        self.assertEqual(len(set(map(tuple, rows.tolist()))), 3000)
+        stream = get_range(5, spec, 0, abacus_batch.PARALLEL_CHUNK_ROWS).tolist()
+        first_seen = [list(row) for row in dict.fromkeys(map(tuple, stream))]
+        self.assertEqual(rows.tolist(), first_seen[:3000])
+
+    def test_gen_rows_excluding(self):
+        def has_five(rows):
+            return (rows == 5).any(axis=1)
+
+        for enumerate_rows in [abacus_batch.UNIQUE_ENUMERATE_ROWS, 0]:
+            saved = abacus_batch.UNIQUE_ENUMERATE_ROWS
+            abacus_batch.UNIQUE_ENUMERATE_ROWS = enumerate_rows
+            try:
+                spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+                rows = gen_rows_excluding(spec, 2000, 3, has_five)
+                unique_rows = gen_unique_rows(spec, 2000, 3, has_five)
+            finally:
+                abacus_batch.UNIQUE_ENUMERATE_ROWS = saved
+            self.assertEqual((len(rows), len(unique_rows)), (2000, 2000))
+            self.assertFalse(has_five(rows).any() or has_five(unique_rows).any())
+            self.assertEqual(len(set(map(tuple, unique_rows.tolist()))), 2000)
+
+        # a few rows come from the stream; the valid rows are only all
+        # enumerated when most of them are excluded
+        sizes = []
+        def excluded(rows):
+            sizes.append(len(rows))
+            return has_five(rows)
+        self.assertEqual(len(gen_unique_rows(spec, 20, 3, excluded)), 20)
+        self.assertEqual(max(sizes), abacus_batch.PARALLEL_CHUNK_ROWS)
+        sizes = []
+        def mostly_excluded(rows):
+            sizes.append(len(rows))
+            return rows[:, 0] != 12
+        rows = gen_unique_rows(spec, 20, 3, mostly_excluded)
+        self.assertTrue(np.all(rows[:, 0] == 12))
+        self.assertEqual(max(sizes), get_row_sampler(spec).total)
+
+        # nothing left to draw from
+        with self.assertRaises(InfeasibleSpecError):
+            gen_rows_excluding(spec, 10, 3, lambda rows: np.ones(len(rows), dtype=bool))
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import json
+import csv
+import tempfile
+import numpy as np
+import pandas as pd
+from abacus_export import write_exercises_streaming
+from abacus_export import exercises_to_long_frame
+from abacus_export import long_to_wide_frames
+from abacus_export import write_exercises_csv
+from abacus_export import write_exercises_json
+
+class TestAbacusExport(unittest.TestCase):
+    def test_write_exercises_streaming(self):
+        rows = [[12, -1, 3], [11, 2, -2], [13, 1, 1]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'stream.xlsx')
+            self.assertEqual(write_exercises_streaming(iter(rows), output_path), 3)
+
+            ex_df = pd.read_excel(output_path, sheet_name='Exercises')
+            ans_df = pd.read_excel(output_path, sheet_name='Answers')
+            self.assertEqual(list(ex_df.columns), ['Exercise', 'Number 1', 'Number 2', 'Number 3'])
+            self.assertEqual(ex_df.iloc[:, 1:].values.tolist(), rows)
+            self.assertEqual(ans_df['Answer'].tolist(), [14, 11, 15])
+
+    def test_long_and_wide_layout(self):
+        rows = np.array([[12, -1, 3], [11, 2, -2]])
+        long_df = exercises_to_long_frame(rows)
+        self.assertEqual(list(long_df.columns), ['term_1', 'term_2', 'term_3', 'answer'])
+        self.assertEqual(list(long_df.index), [1, 2])
+        self.assertEqual(long_df['answer'].tolist(), [14, 11])
+
+        (ex_df, ans_df) = long_to_wide_frames(long_df)
+        self.assertEqual(list(ex_df.columns), ['Exercise 1', 'Exercise 2'])
+        self.assertEqual(ex_df['Exercise 2'].tolist(), [11, 2, -2])
+        self.assertEqual(ans_df.values.tolist(), [[14, 11]])
+
+    def test_write_exercises_csv_and_json(self):
+        rows = [[12, -1, 3], [11, 2, -2]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, 'res.csv')
+            self.assertEqual(write_exercises_csv(iter(rows), csv_path), 2)
+            with open(csv_path, newline='') as f:
+                self.assertEqual(list(csv.reader(f)), [['exercise', 'term_1', 'term_2', 'term_3', 'answer'],
+                                                       ['1', '12', '-1', '3', '14'],
+                                                       ['2', '11', '2', '-2', '11']])
+
+            json_path = os.path.join(tmp_dir, 'res.json')
+            self.assertEqual(write_exercises_json(np.array(rows), json_path), 2)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f), [{'numbers': [12, -1, 3], 'answer': 14},
+                                                {'numbers': [11, 2, -2], 'answer': 11}])
+
+            # nothing to write is still valid json
+            self.assertEqual(write_exercises_json([], json_path), 0)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f), [])
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
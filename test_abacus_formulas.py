@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import random
+import numpy as np
+import abacus_formulas
+from abacus_formulas import FORMULAS
+from abacus_formulas import FORMULA_BITS
+from abacus_formulas import rod_step
+from abacus_formulas import step_formulas
+from abacus_formulas import row_formulas
+from abacus_formulas import formula_names
+from abacus_formulas import Soroban
+from abacus_formulas import KIND_BITS
+from abacus_formulas import step_formulas_batch
+from abacus_formulas import row_formulas_batch
+from abacus_formulas import DIRECT, SMALL_FRIEND, BIG_FRIEND, MIXED
+
+class TestAbacusFormulas(unittest.TestCase):
+
+    def test_rod_step(self):
+        self.assertEqual(rod_step(2, 2), (DIRECT, 4, 0))
+        self.assertEqual(rod_step(2, 4), (SMALL_FRIEND, 6, 0))
+        self.assertEqual(rod_step(7, 4), (BIG_FRIEND, 1, 1))
+        self.assertEqual(rod_step(5, 6), (MIXED, 1, 1))
+        self.assertEqual(rod_step(7, 2, True), (DIRECT, 5, 0))
+        self.assertEqual(rod_step(6, 3, True), (SMALL_FRIEND, 3, 0))
+        self.assertEqual(rod_step(3, 4, True), (BIG_FRIEND, 9, 1))
+        self.assertEqual(rod_step(1, 6, True), (MIXED, 5, 1))
+
+        # the new digit is always right, whatever the rule
+        for rod_digit in range(10):
+            for digit in range(1, 10):
+                (kind, new_digit, carry) = rod_step(rod_digit, digit)
+                self.assertEqual(new_digit + 10 * carry, rod_digit + digit)
+                (kind, new_digit, carry) = rod_step(rod_digit, digit, True)
+                self.assertEqual(new_digit - 10 * carry, rod_digit - digit)
+
+    def test_step_formulas(self):
+        self.assertEqual(len(FORMULAS), 34)
+        self.assertEqual(formula_names(step_formulas(2, 4)), ['+4 = +5 - 1'])
+        self.assertEqual(formula_names(step_formulas(5, 6)), ['+6 = +10 - 5 + 1'])
+        self.assertEqual(formula_names(step_formulas(15, -6)), ['-6 = -10 + 4'])
+        self.assertEqual(formula_names(step_formulas(13, -6)), ['-6 = -10 + 5 - 1'])
+        self.assertEqual(step_formulas(1, 3), 0)
+        # carrying into the tens rod needs a rule of its own
+        self.assertEqual(formula_names(step_formulas(49, 1)), ['+1 = +5 - 4', '+1 = +10 - 9'])
+        # two digit numbers are done rod by rod
+        self.assertEqual(formula_names(step_formulas(33, 24)), ['+2 = +5 - 3', '+4 = +5 - 1'])
+        # nothing is shown for negative totals
+        self.assertEqual(step_formulas(3, -4), 0)
+
+    def test_row_formulas(self):
+        (mask, steps) = row_formulas([12, 3, -4, 9, 1])
+        self.assertEqual(formula_names(mask), ['+3 = +5 - 2', '+9 = +10 - 1', '-4 = -5 + 1'])
+        self.assertEqual(steps, 3)
+        self.assertEqual(mask, FORMULA_BITS['+3 = +5 - 2'] | FORMULA_BITS['-4 = -5 + 1'] | FORMULA_BITS['+9 = +10 - 1'])
+        self.assertEqual(row_formulas([11, 1, 2]), (0, 0))
+
+    def test_soroban(self):
+        soroban = Soroban(49)
+        self.assertEqual(soroban.beads(), [(0, 4), (1, 4)])
+        # +1 on the ones rod is +10 - 9, the 10 is +1 = +5 - 4 on the tens rod
+        self.assertEqual(soroban.add(1), [(0, 1, BIG_FRIEND), (1, 1, SMALL_FRIEND)])
+        self.assertEqual(soroban.value, 50)
+        self.assertEqual(soroban.beads(), [(1, 0), (0, 0)])
+        self.assertEqual(soroban.add(-26), [(1, 2, SMALL_FRIEND), (0, 6, BIG_FRIEND), (1, 1, DIRECT)])
+        self.assertEqual(soroban.value, 24)
+        with self.assertRaises(ValueError):
+            soroban.add(-25)
+
+        # any number of steps ends at the right value
+        rng = random.Random(8)
+        soroban = Soroban()
+        total = 0
+        for cnt in range(500):
+            number = rng.randint(-total, 999)
+            soroban.add(number)
+            total += number
+            self.assertEqual(soroban.value, total)
+
+        self.assertEqual(KIND_BITS[DIRECT], 0)
+        self.assertEqual(sum(KIND_BITS.values()), 2 ** len(FORMULAS) - 1)
+
+    def test_row_formulas_batch(self):
+        rng = random.Random(4)
+        rows = np.array([[rng.randint(1, 99)] + [rng.randint(-120, 500) for cnt in range(4)] for cnt in range(3000)])
+        expected = [row_formulas(numbers) for numbers in rows.tolist()]
+
+        (masks, steps) = row_formulas_batch(rows)
+        self.assertEqual(list(zip(masks.tolist(), steps.tolist())), expected)
+        self.assertEqual(step_formulas_batch([49, 15, 3], [1, -6, -4]).tolist(),
+                         [step_formulas(49, 1), step_formulas(15, -6), 0])
+
+        # without the table of all the steps
+        table_size = abacus_formulas.STEP_TABLE_MAX_SIZE
+        abacus_formulas.STEP_TABLE_MAX_SIZE = 10
+        try:
+            (masks, steps) = row_formulas_batch(rows)
+        finally:
+            abacus_formulas.STEP_TABLE_MAX_SIZE = table_size
+        self.assertEqual(list(zip(masks.tolist(), steps.tolist())), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
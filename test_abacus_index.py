@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import tempfile
+import numpy as np
+from abacus_core import make_spec
+from abacus_bank import gen_bank
+from abacus_bank import ExerciseBank
+from abacus_formulas import row_formulas
+from abacus_formulas import FORMULA_BITS
+from abacus_index import classify_rows
+from abacus_index import BankIndex
+
+class TestAbacusIndex(unittest.TestCase):
+
+    def test_classify_rows(self):
+        rows = np.array([[12, 3, -4, 9, 1], [11, 1, 2, -1, 1]])
+        (masks, steps) = classify_rows(rows)
+        self.assertEqual(masks.tolist(), [row_formulas(numbers)[0] for numbers in rows.tolist()])
+        self.assertEqual(steps.tolist(), [3, 0])
+
+    def test_bank_index(self):
+        spec = make_spec(5, 9, 99, 2, 8, 8, [], True, False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bank_path = os.path.join(tmp_dir, 'res.bank')
+            gen_bank(spec, 5000, 23, bank_path)
+            bank = ExerciseBank(bank_path)
+            index = BankIndex.build(bank)
+            self.assertEqual(len(index), 5000)
+
+            # the same rows as checking every exercise
+            rows = bank.rows.tolist()
+            classified = [row_formulas(numbers) for numbers in rows]
+            formula = '+4 = +5 - 1'
+            expected = [i for (i, numbers) in enumerate(rows)
+                        if sum(numbers) < 50 and 10 <= numbers[0] <= 99 and
+                        classified[i][0] & FORMULA_BITS[formula] and classified[i][1] >= 2]
+            self.assertTrue(len(expected) > 0)
+            found = index.find(max_answer = 49, first_number_digit_count = 2, formulas = [formula], min_steps = 2)
+            self.assertEqual(found.tolist(), expected)
+            self.assertEqual(index.find(max_answer = 49, first_number_digit_count = 2, formulas = [formula], min_steps = 2, limit = 3).tolist(),
+                             expected[:3])
+
+            answers = [sum(numbers) for numbers in rows]
+            self.assertEqual(index.find(min_answer = 20, max_answer = 30).tolist(),
+                             [i for (i, answer) in enumerate(answers) if 20 <= answer <= 30])
+            self.assertEqual(index.find().tolist(), list(range(5000)))
+            self.assertEqual(len(index.find(min_answer = 1000)), 0)
+            with self.assertRaises(ValueError):
+                index.find(formulas = ['+4 = +4'])
+
+            # a saved index finds the same rows
+            index_path = os.path.join(tmp_dir, 'res.idx')
+            index.save(index_path)
+            self.assertEqual(BankIndex.load(index_path).find(max_answer = 49, formulas = [formula]).tolist(),
+                             index.find(max_answer = 49, formulas = [formula]).tolist())
+            del bank
+
+    def test_empty_bank_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bank_path = os.path.join(tmp_dir, 'res.bank')
+            gen_bank(make_spec(), 0, 23, bank_path)
+            bank = ExerciseBank(bank_path)
+            index = BankIndex.build(bank)
+            self.assertEqual(len(index), 0)
+            self.assertEqual(index.find().tolist(), [])
+            self.assertEqual(index.find(min_answer = 3).tolist(), [])
+            self.assertEqual(index.find(max_answer = 49, min_first_number = 10, formulas = ['+4 = +5 - 1'], min_steps = 1).tolist(), [])
+            del bank
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import json
+import tempfile
+import gen_abacus
+from abacus_core import make_spec
+from abacus_core import get_row_sampler
+from abacus_core import InfeasibleSpecError
+from abacus_batch import get_range
+from abacus_seen import seen_filter_size
+from abacus_seen import SeenFilter
+
+class TestAbacusSeen(unittest.TestCase):
+
+    def test_seen_filter_size(self):
+        # about 9.6 bits and 7 hashes an exercise for 1 %
+        self.assertEqual(seen_filter_size(1000, 0.01), (9600, 7))
+        self.assertEqual(seen_filter_size(1, 0.5), (64, 44))
+        with self.assertRaises(ValueError):
+            seen_filter_size(1000, 1.5)
+
+    def test_seen_filter(self):
+        spec = make_spec(10, 9, 999, 2, 8, 8, [], True, False)
+        rows = get_range(1, spec, 0, 5000)
+        others = get_range(2, spec, 0, 20000)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'student.seen')
+            with SeenFilter(path, 5000, 0.01) as seen:
+                self.assertFalse(seen.contains(rows).any())
+                seen.add(rows)
+                self.assertTrue(seen.contains(rows).all())
+            self.assertEqual(os.path.getsize(path), 64 + 47936 // 8)
+
+            # the next session finds the same exercises, whatever size it asks for
+            with SeenFilter(path, 10, 0.5) as seen:
+                self.assertEqual((len(seen), seen.bits, seen.hashes, seen.fp_rate), (5000, 47936, 7, 0.01))
+                self.assertTrue(seen.contains(rows).all())
+                self.assertAlmostEqual(seen.contains(others).mean(), 0.01, delta=0.005)
+                self.assertAlmostEqual(seen.false_positive_rate(), 0.01, delta=0.002)
+
+            with open(path, 'wb') as f:
+                f.write(b'not a filter')
+            with self.assertRaises(ValueError):
+                SeenFilter(path)
+
+    def test_gen_abacus_seen(self):
+        spec = make_spec(3, 5, 15, 0, 8, 8, [], True, False)
+        total = get_row_sampler(spec).total
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.json')
+            seen_path = os.path.join(tmp_dir, 'student.seen')
+            given = set()
+            # a worksheet a day never repeats an earlier day's exercise
+            for day in range(3):
+                gen_abacus.gen_abacus(50, 3, 5, 15, 0, 8, 8, [], True, False, output_path, output_format = 'json', unique = True,
+                                      seen_path = seen_path)
+                with open(output_path) as f:
+                    numbers = set(tuple(exercise['numbers']) for exercise in json.load(f))
+                self.assertEqual(len(numbers), 50)
+                self.assertFalse(numbers & given)
+                given |= numbers
+
+            # only the ones not given yet are left
+            with self.assertRaises(InfeasibleSpecError):
+                gen_abacus.gen_abacus(total - 100, 3, 5, 15, 0, 8, 8, [], True, False, output_path, output_format = 'json',
+                                      unique = True, seen_path = seen_path)
+            with SeenFilter(seen_path) as seen:
+                self.assertEqual(len(seen), 150)
+
+if __name__ == '__main__':
+    unittest.main()
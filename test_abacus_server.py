@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import asyncio
+import io
+import json
+import threading
+import pandas as pd
+from abacus_server import WorksheetServer
+from abacus_server import spec_from_query
+from gen_abacus import ExerciseSpec
+
+# Sends a GET request to the server and returns (status, headers, body).
+async def http_get(port, target):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET ' + target + ' HTTP/1.1\r\nHost: localhost\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    (head, body) = response.split(b'\r\n\r\n', 1)
+    lines = head.decode('latin-1').split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines[1:])
+    return (int(lines[0].split()[1]), headers, body)
+
+class TestAbacusServer(unittest.TestCase):
+
+    def test_spec_from_query(self):
+        spec = spec_from_query({'max_number': ['4'], 'buffer_prefill': ['4,-4'], 'use_negative': ['false'], 'n': ['5']})
+        self.assertEqual(spec, ExerciseSpec(max_number = 4, buffer_prefill = (4, -4), use_negative = False))
+        with self.assertRaises(ValueError):
+            spec_from_query({'max_numbr': ['4']})
+
+        spec = spec_from_query({'formula': ['+4=+5-1'], 'formula_steps': ['1,2'], 'check_running_totals': ['true']})
+        self.assertTrue(spec.check_running_totals)
+        self.assertEqual((spec.formula, spec.formula_count, spec.formula_steps), ('+4 = +5 - 1', 1, (1, 2)))
+        with self.assertRaises(ValueError):
+            spec_from_query({'formula': [' 4= 5-1']})
+
+    def test_server(self):
+        async def run():
+            server = WorksheetServer(port = 0, pool_size = 200, pool_low_water = 50, prewarm_specs = [ExerciseSpec()])
+            await server.start()
+            try:
+                # the prewarmed pool answers from memory
+                (status, headers, body) = await http_get(server.port, '/exercises?n=10')
+                self.assertEqual(status, 200)
+                result = json.loads(body)
+                self.assertEqual(len(result['exercises']), 10)
+                self.assertEqual(len(server.pools.peek(ExerciseSpec())), 190)
+                for exercise in result['exercises']:
+                    self.assertEqual(sum(exercise['numbers']), exercise['answer'])
+
+                # below the low-water mark the pool gets topped up in the background
+                await http_get(server.port, '/exercises?n=180')
+                await server.pools.peek(ExerciseSpec()).refill
+                self.assertEqual(len(server.pools.peek(ExerciseSpec())), 200)
+
+                (status, headers, body) = await http_get(server.port, '/exercises?n=3&format=xlsx&max_sum=44&use_negative=false')
+                self.assertEqual(status, 200)
+                self.assertEqual(len(pd.read_excel(io.BytesIO(body), sheet_name='Answers')), 3)
+
+                (status, headers, body) = await http_get(server.port, '/exercises?max_numbr=3')
+                self.assertEqual(status, 400)
+                (status, headers, body) = await http_get(server.port, '/nothing')
+                self.assertEqual(status, 404)
+                (status, headers, body) = await http_get(server.port, '/health')
+                self.assertEqual(len(json.loads(body)['pools']), 2)
+
+                # taking exercises runs in a thread, so other requests don't wait for it
+                pool = server.pools.get_pool(ExerciseSpec(max_sum = 30))
+                (release, take) = (threading.Event(), pool.take)
+                pool.take = lambda n: (release.wait(5), take(n))[1]
+                slow = asyncio.ensure_future(http_get(server.port, '/exercises?n=5&max_sum=30'))
+                await asyncio.sleep(0.1)
+                (status, headers, body) = await asyncio.wait_for(http_get(server.port, '/health'), 2)
+                self.assertEqual(status, 200)
+                self.assertFalse(slow.done())
+                release.set()
+                self.assertEqual(len(json.loads((await slow)[2])['exercises']), 5)
+            finally:
+                await server.close()
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
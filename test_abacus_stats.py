@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import json
+import warnings
+import tempfile
+import numpy as np
+import abacus_stats as stats
+from abacus_core import make_spec, get_row_sampler, enforce_min_sum, reduce_sum_of_numbers_by_this
+from abacus_batch import sample_rows_batch
+
+class TestAbacusStats(unittest.TestCase):
+
+    def tearDown(self):
+        stats.enable(False)
+        stats.reset()
+
+    def test_count(self):
+        # nothing is collected while it is off
+        stats.count('rows')
+        self.assertEqual(stats.counters, {})
+
+        stats.enable()
+        stats.count('rows')
+        stats.count('rows', 4)
+        self.assertEqual(stats.counters, {'rows': 5})
+
+        # the repair loops count their rounds and their failures
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            enforce_min_sum([1, 2, 3], 10, 31)
+            reduce_sum_of_numbers_by_this([9, 1, 7], 25, False)
+        self.assertEqual(stats.counters['enforce_min_sum_increments'], 24)
+        self.assertEqual(stats.counters['enforce_min_sum_failures'], 1)
+        self.assertEqual(stats.counters['reduce_sum_failures'], 1)
+        self.assertGreater(stats.counters['reduce_sum_rounds'], 0)
+
+    def test_timer(self):
+        with stats.timer('stage'):
+            pass
+        self.assertEqual(stats.timers, {})
+
+        stats.enable()
+        for cnt in range(3):
+            with stats.timer('stage'):
+                pass
+        self.assertEqual(stats.timers['stage'][0], 3)
+        self.assertGreaterEqual(stats.timers['stage'][1], 0)
+
+    def test_timed(self):
+        @stats.timed('double')
+        def double(x):
+            return 2 * x
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(stats.timers, {})
+        stats.enable()
+        self.assertEqual(double(x = 3), 6)
+        self.assertEqual(stats.timers['double'][0], 1)
+
+        # the stages of generation are timed
+        sampler = get_row_sampler(make_spec(4, 5, 15, 0, 8, 8, [], True, False))
+        sample_rows_batch(sampler, np.random.default_rng(1).random((100, 4)))
+        self.assertEqual(stats.timers['sample_rows'][0], 1)
+        self.assertEqual(stats.counters['rows_sampled'], 100)
+
+    def test_write_stats(self):
+        stats.enable()
+        stats.count('rows', 2)
+        with stats.timer('stage'):
+            pass
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'stats.json')
+            stats.write_stats(output_path)
+            with open(output_path) as f:
+                written = json.load(f)
+        self.assertEqual(written, stats.snapshot())
+        self.assertEqual(written['counters'], {'rows': 2})
+        self.assertEqual(written['timers']['stage']['calls'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
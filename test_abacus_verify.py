@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import tempfile
+import numpy as np
+from abacus_core import make_spec
+from abacus_bank import write_bank
+from abacus_bank import gen_bank
+from abacus_bank import ExerciseBank
+from abacus_verify import check_rows
+from abacus_verify import verify_spec
+from abacus_verify import verify_bank
+from abacus_verify import build_parser
+
+class TestAbacusVerify(unittest.TestCase):
+
+    def test_check_rows(self):
+        spec = make_spec(4, 5, 44, 2, 3, 4, [2], False, False)
+        rows = np.array([[12, 5, 5, 2],     # fine
+                         [14, 3, 5, 2],     # first number digit above 3
+                         [13, -3, 2, 2],    # negative number
+                         [12, 5, 4, 3],     # not ending with buffer_prefill
+                         [33, 5, 5, 2],     # answer above max_sum (and a digit above 4)
+                         [23, 5, 5, 2]])    # answer digit above 4
+        violations = check_rows(spec, rows)
+        broken = {name: np.flatnonzero(mask).tolist() for (name, mask) in violations.items()}
+        self.assertEqual(broken, {'first_number': [1], 'terms': [2], 'buffer_prefill': [3],
+                                  'answer_range': [4], 'answer_digits': [4, 5]})
+
+        # drill sheets and running totals
+        spec = make_spec(3, 5, 15, 0, 8, 8, [], True, False, '+4=+5-1', 1, [], True)
+        violations = check_rows(spec, np.array([[1, 4, 2], [4, 1, 2], [3, -4, 2]]))
+        self.assertEqual(violations['formula'].tolist(), [False, True, True])
+        self.assertEqual(violations['running_totals'].tolist(), [False, False, True])
+
+        with self.assertRaises(ValueError):
+            check_rows(spec, np.zeros((2, 4)))
+
+    def test_verify_spec(self):
+        # the row sampler keeps to every rule
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], False, False)
+        report = verify_spec(spec, 20000, seed = 3)
+        self.assertEqual(report.rows, 20000)
+        self.assertTrue(report.ok)
+        self.assertEqual(set(report.rates.values()), {0.0})
+
+        # the repair-based rows don't, and the same rows are checked however
+        # many workers there are
+        report = verify_spec(spec, 3000, seed = 3, source = 'repaired', example_limit = 2)
+        self.assertFalse(report.ok)
+        self.assertGreater(report.violations['answer_digits'], 0)
+        self.assertEqual(len(report.examples['answer_digits']), 2)
+        self.assertTrue(check_rows(spec, np.array(report.examples['answer_digits']))['answer_digits'].all())
+        self.assertEqual(verify_spec(spec, 3000, seed = 3, workers = 2, source = 'repaired').violations, report.violations)
+
+        with self.assertRaises(ValueError):
+            verify_spec(spec, 10, source = 'pandas')
+
+    def test_verify_bank(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], False, False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.bank')
+            gen_bank(spec, 5000, 7, output_path)
+            report = verify_bank(ExerciseBank(output_path))
+            self.assertEqual((report.rows, report.invalid_rows), (5000, 0))
+            self.assertEqual(report.violations['answer_column'], 0)
+
+            write_bank([np.array([[12, 3, 1, 2, 2], [19, 3, 1, 2, 1]])], spec, None, output_path)
+            report = verify_bank(ExerciseBank(output_path))
+            self.assertEqual(report.invalid_rows, 1)
+            self.assertEqual(report.examples['first_number'], [[19, 3, 1, 2, 1]])
+
+    def test_build_parser(self):
+        # the spec arguments of gen_abacus, but none of its output arguments
+        args = build_parser().parse_args(['--max_sum', '44', '--formula', '+4=+5-1', '--rows', '10', '--seed', '3'])
+        self.assertEqual((args.max_sum, args.formula, args.rows, args.seed), (44, '+4=+5-1', 10, 3))
+        options = build_parser()._option_string_actions
+        for option in ['--output', '--streaming', '--layout', '--format', '--unique', '--seen', '--stats']:
+            self.assertNotIn(option, options)
+
+if __name__ == '__main__':
+    unittest.main()
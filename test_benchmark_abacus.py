@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import copy
+import tempfile
+from benchmark_abacus import block_percentile
+from benchmark_abacus import run_grid
+from benchmark_abacus import save_results
+from benchmark_abacus import load_results
+from benchmark_abacus import compare_results
+from benchmark_abacus import WORKLOADS
+
+class TestBenchmarkAbacus(unittest.TestCase):
+
+    def test_block_percentile(self):
+        # 90 exercises at 1 second each and 10 in one block of 100 seconds
+        blocks = [(1, 1.0)] * 90 + [(10, 100.0)]
+        self.assertEqual(block_percentile(blocks, 0.5), 1.0)
+        self.assertEqual(block_percentile(blocks, 0.9), 1.0)
+        self.assertEqual(block_percentile(blocks, 0.99), 10.0)
+        self.assertEqual(block_percentile([], 0.5), 0.0)
+
+    def test_run_grid(self):
+        grid = {'how_many_numbers': [3], 'max_sum': [15, 99], 'first_number_digit_count': [2], 'number_of_exercises': [30]}
+        results = run_grid(grid, tuple(WORKLOADS))
+        self.assertEqual(len(results['results']), 2 * len(WORKLOADS))
+        for result in results['results']:
+            self.assertEqual(result['exercises'], 30)
+            self.assertGreater(result['exercises_per_second'], 0)
+            self.assertLessEqual(result['p50_seconds'], result['p99_seconds'])
+            self.assertGreater(result['peak_memory_bytes'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'baseline.json')
+            save_results(results, output_path)
+            self.assertEqual(load_results(output_path), results)
+
+    def test_compare_results(self):
+        baseline = {'version': 1, 'results': [
+            {'workload': 'gen_numbers', 'parameters': {'max_sum': 15}, 'exercises_per_second': 1000.0,
+             'p50_seconds': 0.001, 'p99_seconds': 0.002, 'peak_memory_bytes': 1000},
+            {'workload': 'gen_numbers', 'parameters': {'max_sum': 99}, 'exercises_per_second': 1000.0,
+             'p50_seconds': 0.001, 'p99_seconds': 0.002, 'peak_memory_bytes': None}]}
+        self.assertEqual(compare_results(baseline, baseline), [])
+
+        # slower and bigger past the threshold, faster is fine
+        results = copy.deepcopy(baseline)
+        results['results'][0].update({'exercises_per_second': 700.0, 'p99_seconds': 0.0021, 'peak_memory_bytes': 2000})
+        results['results'][1].update({'exercises_per_second': 5000.0, 'peak_memory_bytes': 10 ** 9})
+        regressions = compare_results(results, baseline, 0.25)
+        self.assertEqual([(regression['parameters']['max_sum'], regression['metric']) for regression in regressions],
+                         [(15, 'exercises_per_second'), (15, 'peak_memory_bytes')])
+        self.assertAlmostEqual(regressions[0]['change'], -0.3)
+        self.assertEqual(len(compare_results(results, baseline, 0.01)), 3)
+
+if __name__ == '__main__':
+    unittest.main()
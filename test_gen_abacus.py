@@ -13,6 +13,36 @@ from gen_abacus import enforce_min_sum
 from gen_abacus import enforce_max_sum
 from gen_abacus import enforce_given_number_first
 from gen_abacus import gen_numbers
+from gen_abacus import gen_numbers_repaired
+from gen_abacus import count_multi_digit_numbers_in_range
+from gen_abacus import gen_multi_digit_number
+from gen_abacus import RowSampler
+from gen_abacus import get_row_sampler
+from gen_abacus import ExerciseSpec
+from gen_abacus import make_spec
+from gen_abacus import AnswerIndex
+from gen_abacus import floor_allowed_answer
+from gen_abacus import stream_key
+from gen_abacus import analyze_spec
+from gen_abacus import check_feasibility
+from gen_abacus import InfeasibleSpecError
+from abacus_core import FormulaRowSampler
+from abacus_formulas import step_formulas
+from abacus_formulas import FORMULA_BITS
+import gen_abacus
+from gen_abacus import AbacusGenerator
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import subprocess
+import sys
+import json
+from abacus_batch import sample_rows_batch
+from abacus_batch import answers_allowed
+import itertools
+import random
+import time
+import numpy as np
 
 class TestGenAbacusMethods(unittest.TestCase):
 
@@ -21,6 +51,11 @@ class TestGenAbacusMethods(unittest.TestCase):
         for cnt in range(1000):
             gen_num = gen_non_zero(500, use_negative = True)
             self.assertFalse(gen_num == 0)
+
+        # both signs come up, and nothing is drawn when there is no non-zero number
+        self.assertEqual(set(gen_non_zero(2, True) for cnt in range(500)), {-2, -1, 1, 2})
+        with self.assertRaises(ValueError):
+            gen_non_zero(0, use_negative = True)
         
     def test_reduce_sum_of_numbers_by_this(self):
         old_row = [9, 8, 7]
@@ -98,6 +133,11 @@ class TestGenAbacusMethods(unittest.TestCase):
             self.assertTrue(new_row[0] <= max_num)
             self.assertTrue(sum(new_row) == sum(old_row_copy))
 
+        # a single negative number just becomes positive
+        new_row = enforce_positive_number_first([-3], max_num)
+        self.assertEqual(len(new_row), 1)
+        self.assertTrue(0 < new_row[0] <= max_num)
+
     def test_enforce_min_sum(self):
         # first checking that it doesn't do unneccessary work
         old_row = [1, 2, 3]
@@ -307,5 +347,336 @@ class TestGenAbacusMethods(unittest.TestCase):
         self.assertTrue(new_row[0] >= 10)
         self.assertTrue(new_row[0] <= 99)
         
+    def test_row_sampler(self):
+        domains = [[1, 2, 3], [-2, -1, 1, 2], [-2, -1, 1, 2]]
+        allowed_answers = [0, 1, 2, 4]
+        sampler = RowSampler(domains, allowed_answers)
+
+        # does it count the valid rows right?
+        valid_rows = [list(row) for row in itertools.product(*domains) if sum(row) in allowed_answers]
+        self.assertEqual(sampler.total, len(valid_rows))
+
+        # does it only ever draw valid rows, and all of them?
+        rng = random.Random(3)
+        drawn = set()
+        for cnt in range(2000):
+            row = sampler.sample(rng)
+            self.assertIn(row, valid_rows)
+            drawn.add(tuple(row))
+        self.assertEqual(len(drawn), len(valid_rows))
+
+        # same for the vectorized version
+        rows = sample_rows_batch(sampler, np.random.default_rng(3).random((2000, 3)))
+        self.assertEqual(set(map(tuple, rows.tolist())), drawn)
+
+        # nothing to draw from
+        with self.assertRaises(ValueError):
+            RowSampler(domains, [100]).sample(rng)
+
+    def test_gen_numbers_tight_parameters(self):
+        # parameters that the repair loops could not always satisfy
+        sampler = get_row_sampler(ExerciseSpec(6, 3, 12, 0, 8, 1, [], True, False))
+        for cnt in range(200):
+            row = sampler.sample()
+            self.assertTrue(row[0] > 0)
+            self.assertTrue(all(0 < abs(n) <= 3 for n in row))
+            self.assertTrue(sum(row) in [0, 1, 10, 11])
+
+    def test_gen_multi_digit_number(self):
+        # do we count the same as checking every number?
+        for (digit_count, max_digit, lower_bound, upper_bound) in [(1, 8, 1, 9), (2, 3, 10, 99), (3, 1, 100, 115), (3, 5, 120, 560), (2, 9, 50, 40)]:
+            expected = [v for v in range(lower_bound, upper_bound + 1)
+                        if len(str(v)) == digit_count and all(1 <= int(d) <= max_digit for d in str(v))]
+            self.assertEqual(count_multi_digit_numbers_in_range(digit_count, max_digit, lower_bound, upper_bound), len(expected))
+
+            if expected:
+                drawn = set(gen_multi_digit_number(digit_count, max_digit, lower_bound, upper_bound) for cnt in range(500))
+                self.assertTrue(drawn <= set(expected))
+            else:
+                with self.assertRaises(ValueError):
+                    gen_multi_digit_number(digit_count, max_digit, lower_bound, upper_bound)
+
+        # a tight range that used to take very long to hit by re-generating
+        self.assertEqual(gen_multi_digit_number(6, 1, 111111, 111111), 111111)
+
+    def test_exercise_spec(self):
+        spec = ExerciseSpec(how_many_numbers = 5, max_number = 5, max_sum = 100, first_number_digit_count = 2,
+                            max_digit_in_multi_digit_number = 3, max_answer_digit = 4, buffer_prefill = [4, -4],
+                            use_negative = True, answer_can_be_negative = False)
+        # normalized once: max_sum capped by max_answer_digit, prefill made a tuple
+        self.assertEqual(spec.max_sum, 44)
+        self.assertEqual(spec.buffer_prefill, (4, -4))
+        self.assertEqual(spec.term_count, 3)
+        self.assertEqual(spec.budget, 44)
+        self.assertEqual(spec.min_answer, 0)
+        self.assertEqual((spec.first_number_lower_bound, spec.first_number_upper_bound), (10, 42))
+        self.assertEqual(spec.answer_index.answers[-3:], [42, 43, 44])
+        self.assertNotIn(5, spec.answer_index)
+
+        # equal parameters after normalization give equal (and equally hashed) specs
+        same_spec = make_spec(5, 5, 44, 2, 3, 4, [4, -4], True, False)
+        self.assertEqual(spec, same_spec)
+        self.assertEqual(hash(spec), hash(same_spec))
+        self.assertIs(get_row_sampler(spec), get_row_sampler(same_spec))
+
+        # no room for a two digit first number
+        self.assertFalse(ExerciseSpec(4, 5, 12, 2).has_multi_digit_first_number())
+
+    def test_answer_index(self):
+        index = AnswerIndex(-30, 120, 2)
+        expected = [a for a in range(-30, 121) if all(int(d) <= 2 for d in str(abs(a)))]
+        self.assertEqual(index.answers, expected)
+        self.assertIn(-22, index)
+        self.assertNotIn(13, index)
+        self.assertEqual(index.floor(19), 12)
+        self.assertEqual(index.ceil(13), 20)
+        self.assertEqual(index.nearest(17), 20)
+        self.assertEqual(index.nearest(16), 12)
+        self.assertIsNone(index.floor(-31))
+        self.assertIsNone(index.ceil(121))
+        self.assertEqual(answers_allowed(index, [-22, -23, 0, 13, 112, 130]).tolist(),
+                         [True, False, True, False, True, False])
+
+        # no limit on digits
+        self.assertEqual(list(AnswerIndex(-2, 3, 0).answers), [-2, -1, 0, 1, 2, 3])
+        self.assertEqual(answers_allowed(AnswerIndex(-2, 3, 0), [-3, -2, 3, 4]).tolist(), [False, True, True, False])
+
+        # nothing is listed for membership or the nearest answer, however wide the range
+        start = time.time()
+        spec = ExerciseSpec(4, 5, 4999999, 0, 8, 9, (), True, True)
+        wide = AnswerIndex(-10 ** 12, 10 ** 12, 8)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIn(4999999, spec.answer_index)
+        self.assertEqual(spec.answer_index.floor(10 ** 7), 4999999)
+        self.assertEqual(wide.ceil(-10 ** 12 + 1), -888888888888)
+        self.assertEqual(wide.floor(1234567890), 1234567888)
+        self.assertNotIn(1234567890, wide)
+
+    def test_floor_allowed_answer(self):
+        self.assertEqual(floor_allowed_answer(395, 0, 444, 4), 344)
+        self.assertEqual(floor_allowed_answer(-395, -444, 444, 4), -400)
+        self.assertIsNone(floor_allowed_answer(-5, 0, 44, 4))
+        # the same answers as picking from the listed AnswerIndex answers
+        for (min_answer, max_answer, max_answer_digit) in [(0, 500, 4), (-300, 250, 2), (-50, -5, 8), (12, 40, 0)]:
+            index = AnswerIndex(min_answer, max_answer, max_answer_digit)
+            answers = list(index.answers)
+            for answer in range(-400, 600):
+                below = [a for a in answers if a <= answer]
+                above = [a for a in answers if a >= answer]
+                self.assertEqual(floor_allowed_answer(answer, min_answer, max_answer, max_answer_digit),
+                                 below[-1] if below else None)
+                self.assertEqual(index.ceil(answer), above[0] if above else None)
+                self.assertEqual(answer in index, answer in answers)
+
+    def test_abacus_generator(self):
+        params = (5, 5, 44, 2, 3, 4, [], True, False)
+
+        # the same seed gives the same rows
+        rows = [AbacusGenerator(42).gen_numbers(*params) for cnt in range(2)]
+        self.assertEqual(rows[0], rows[1])
+        self.assertTrue(np.array_equal(AbacusGenerator(42).gen_numbers_batch(50, *params),
+                                       AbacusGenerator(42).gen_numbers_batch(50, *params)))
+
+        # generators running in threads don't get in each other's way
+        def gen_many(seed):
+            generator = AbacusGenerator(seed)
+            return [generator.gen_numbers(*params) for cnt in range(200)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            threaded = list(pool.map(gen_many, [1, 2, 3, 4]))
+        self.assertEqual(threaded, [gen_many(seed) for seed in [1, 2, 3, 4]])
+
+    def test_formula_row_sampler(self):
+        spec = make_spec(5, 3, 12, 0, 8, 8, [], True, False, '+2=+5-3', 2, [2])
+        self.assertEqual(spec.formula, '+2 = +5 - 3')
+        sampler = get_row_sampler(spec)
+        self.assertIsInstance(sampler, FormulaRowSampler)
+
+        # the rows using +2 = +5 - 3 at least twice, one of them at step 2
+        def uses(row):
+            hits = []
+            total = row[0]
+            for number in row[1:]:
+                hits.append(step_formulas(total, number) & FORMULA_BITS[spec.formula] != 0)
+                total += number
+            return hits
+        valid_rows = [list(row) for row in itertools.product(*sampler.domains)
+                      if sum(row) in spec.answer_index and sum(uses(row)) >= 2 and uses(row)[1]]
+        self.assertEqual(sampler.total, len(valid_rows))
+
+        # only valid rows and all of them, one by one and in a batch
+        rng = random.Random(5)
+        drawn = set(tuple(sampler.sample(rng)) for cnt in range(1000))
+        self.assertEqual(drawn, set(map(tuple, valid_rows)))
+        rows = sample_rows_batch(sampler, np.random.default_rng(5).random((1000, 5)))
+        self.assertEqual(set(map(tuple, rows.tolist())), drawn)
+
+        # specs without a formula are unchanged
+        self.assertEqual(make_spec(4, 3, 12, 0, 8, 8, [], True, False, '', 2, [2]), make_spec(4, 3, 12, 0, 8, 8, [], True, False))
+        with self.assertRaises(ValueError):
+            make_spec(formula = '+4 = +5 - 2')
+        with self.assertRaises(ValueError):
+            make_spec(4, formula = '+4 = +5 - 1', formula_steps = [4])
+
+    def test_check_running_totals(self):
+        # answers are fine, but on the way the totals go negative or have
+        # digits above 4
+        spec = make_spec(4, 5, 15, 0, 8, 4, [], True, False, check_running_totals = True)
+        sampler = get_row_sampler(spec)
+        valid_rows = [row for row in itertools.product(*sampler.domains)
+                      if all(sum(row[:k]) in spec.answer_index for k in range(1, 5))]
+        self.assertEqual(sampler.total, len(valid_rows))
+        self.assertLess(sampler.total, get_row_sampler(make_spec(4, 5, 15, 0, 8, 4, [], True, False)).total)
+
+        rows = sample_rows_batch(sampler, np.random.default_rng(2).random((20000, 4)))
+        self.assertEqual(set(map(tuple, rows.tolist())), set(valid_rows))
+        rng = random.Random(2)
+        for cnt in range(200):
+            self.assertIn(tuple(sampler.sample(rng)), valid_rows)
+
+        # together with a formula
+        spec = make_spec(5, 4, 14, 0, 8, 8, [], True, False, '+2=+5-3', 1, [], True)
+        for row in sample_rows_batch(get_row_sampler(spec), np.random.default_rng(3).random((2000, 5))).tolist():
+            self.assertTrue(all(0 <= sum(row[:k]) <= 14 for k in range(1, 6)))
+
+        # specs that don't check running totals keep their random streams
+        self.assertEqual(stream_key(1, make_spec(check_running_totals = False)), stream_key(1, ExerciseSpec()))
+        self.assertNotEqual(stream_key(1, make_spec(check_running_totals = True)), stream_key(1, ExerciseSpec()))
+
+    def test_gen_numbers_repaired(self):
+        spec = make_spec(5, 5, 44, 2, 3, 4, [2], True, False)
+        rng = random.Random(4)
+        for cnt in range(200):
+            row = gen_numbers_repaired(spec, rng)
+            self.assertEqual(len(row), 5)
+            self.assertEqual(row[-1], 2)
+            self.assertTrue(row[0] > 0)
+        self.assertEqual(gen_numbers_repaired(spec, random.Random(1)), gen_numbers_repaired(spec, random.Random(1)))
+        self.assertEqual(gen_numbers_repaired(make_spec(2, 5, 15, 0, 8, 8, [3, 4]), rng), [3, 4])
+
+    def test_analyze_spec(self):
+        # the bounds are those of the valid rows
+        spec = make_spec(3, 5, 44, 2, 3, 4, [2], True, False)
+        sampler = get_row_sampler(spec)
+        valid_rows = [row for row in itertools.product(*sampler.domains) if sum(row) in spec.answer_index]
+        report = analyze_spec(spec)
+        self.assertTrue(report.feasible)
+        self.assertEqual(report.row_count, len(valid_rows))
+        self.assertEqual((report.min_answer, report.max_answer), (min(map(sum, valid_rows)), max(map(sum, valid_rows))))
+        self.assertEqual((report.min_first_number, report.max_first_number),
+                         (min(row[0] for row in valid_rows), max(row[0] for row in valid_rows)))
+
+        # and for a drill sheet, whose running totals are checked too
+        spec = make_spec(5, 4, 14, 0, 8, 8, [], True, False, '+2=+5-3', 1, [], True)
+        rows = sample_rows_batch(get_row_sampler(spec), np.random.default_rng(4).random((20000, 5)))
+        report = analyze_spec(spec)
+        self.assertEqual((report.min_answer, report.max_answer), (rows.sum(axis=1).min(), rows.sum(axis=1).max()))
+
+        # why nothing can be generated
+        report = analyze_spec(make_spec(3, 5, 10, 0, 8, 8, [9, 9], True, False))
+        self.assertFalse(report.feasible)
+        self.assertEqual(report.row_count, 0)
+        self.assertIn('more than max_sum', report.reasons[0])
+        report = analyze_spec(make_spec(4, 9, 30, 0, 8, 8, [], False, False, '-7=-10+3'))
+        self.assertIn('use_negative', report.reasons[0])
+        self.assertIn('first number', analyze_spec(make_spec(3, 5, 15, 3)).notes[0])
+
+        # parameters that would take too long are refused up front
+        report = analyze_spec(make_spec(60, 3000, 3001, 0, 8, 9))
+        self.assertIsNone(report.row_count)
+        self.assertIn('MAX_SAMPLER_WORK', report.reasons[0])
+        # drill sheets count their formula counts and formula lookups as well
+        report = analyze_spec(make_spec(20, 60, 9999, 0, 8, 9, [], True, True, '+4=+5-1'))
+        self.assertIsNone(report.row_count)
+        # but a wide max_sum alone is fine when the numbers can't reach it
+        report = analyze_spec(make_spec(4, 5, 10 ** 9, 0, 8, 9))
+        self.assertTrue(report.feasible)
+        self.assertEqual((report.min_answer, report.max_answer), (-14, 20))
+
+    def test_check_feasibility(self):
+        self.assertEqual(check_feasibility(make_spec()).row_count, get_row_sampler(make_spec()).total)
+
+        spec = make_spec(4, 9, 30, 0, 8, 8, [], False, False, '-7=-10+3')
+        with self.assertRaises(InfeasibleSpecError) as context:
+            check_feasibility(spec)
+        self.assertEqual(context.exception.spec, spec)
+        self.assertEqual(context.exception.reasons, analyze_spec(spec).reasons)
+        with self.assertRaises(InfeasibleSpecError):
+            gen_numbers(3, 5, 10, 0, 8, 8, [9, 9])
+
+        # nothing is written for a spec that can't be met
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.csv')
+            with self.assertRaises(InfeasibleSpecError):
+                gen_abacus.gen_abacus(3, 3, 5, 10, 0, 8, 8, [9, 9], True, False, output_path, output_format = 'csv')
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_main_infeasible(self):
+        # parameters that can't be met end the run with a message, not a traceback
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.csv')
+            result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_abacus.py'),
+                                     '--max_sum', '1', '--format', 'csv', '--output', output_path], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn('no allowed term values', result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+            self.assertFalse(os.path.exists(output_path))
+
+            # and so do parameters that ExerciseSpec rejects
+            result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_abacus.py'),
+                                     '--formula', '+9=+5-1', '--format', 'csv', '--output', output_path], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn('Unknown formula', result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+            self.assertFalse(os.path.exists(output_path))
+
+            # a max_sum far above what the numbers can add up to is not an error
+            result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_abacus.py'),
+                                     '--max_sum', '100000000', '--first_number_digit_count', '0', '--format', 'csv',
+                                     '--output', output_path], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertTrue(os.path.exists(output_path))
+
+    def test_import_is_light(self):
+        # the core and the csv / json output must not need pandas
+        code = ("import sys, gen_abacus; gen_abacus.build_parser(); "
+                "print('pandas' in sys.modules, 'numpy' in sys.modules, 'xlsxwriter' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ['False', 'False', 'False'])
+
+    def test_gen_abacus_output_format(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.json')
+            code = ("import sys, gen_abacus; "
+                    "gen_abacus.gen_abacus(5, 5, 5, 44, 2, 3, 4, [], True, False, sys.argv[1], seed = 11, output_format = 'json'); "
+                    "print('pandas' in sys.modules)")
+            output = subprocess.run([sys.executable, '-c', code, output_path], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout
+            self.assertEqual(output.split()[-1], 'False')
+            with open(output_path) as f:
+                exercises = json.load(f)
+
+        spec = make_spec(5, 5, 44, 2, 3, 4, [], True, False)
+        self.assertEqual([exercise['numbers'] for exercise in exercises], gen_abacus.get_range(11, spec, 0, 5).tolist())
+        with self.assertRaises(ValueError):
+            gen_abacus.gen_abacus(output_format = 'pdf')
+
+    def test_gen_abacus_unique(self):
+        spec = make_spec(3, 5, 15, 0, 8, 8, [], True, False)
+        total = get_row_sampler(spec).total
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, 'res.json')
+            gen_abacus.gen_abacus(total, 3, 5, 15, 0, 8, 8, [], True, False, output_path, seed = 2, output_format = 'json', unique = True)
+            with open(output_path) as f:
+                exercises = json.load(f)
+            self.assertEqual(len(set(tuple(exercise['numbers']) for exercise in exercises)), total)
+
+            # more than there are fails before writing anything
+            os.remove(output_path)
+            with self.assertRaises(InfeasibleSpecError):
+                gen_abacus.gen_abacus(total + 1, 3, 5, 15, 0, 8, 8, [], True, False, output_path, output_format = 'json', unique = True)
+            self.assertFalse(os.path.exists(output_path))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file